@@ -0,0 +1,303 @@
+"""
+Offline benchmark for bot.py.
+
+Builds the bot application on top of OfflineRequest (no Telegram connection),
+feeds it synthetic updates through the registered handlers and reports
+throughput, handler latency, database growth and the bytes the process wrote.
+
+Scenarios:
+    text     a flood of text messages spread over many chats and users
+    mixed    the same flood with admin commands (/stats, /show_data, /search, ...)
+             interleaved every --command-every updates
+    restore  /restore of a generated backup with --restore-rows messages
+
+Usage:
+    python bench.py [--scenario text|mixed|restore|all] [--messages N] [--chats N]
+                    [--users N] [--command-every N] [--restore-rows N] [--json] [--keep]
+
+The bot runs in a temporary directory with its own database, so the benchmark
+never touches bot_data.db. The directory is removed afterwards unless --keep
+is given. Outbound rate limits are lifted unless
+--keep-rate-limits is given, since they would measure Telegram's limits
+instead of the bot.
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import logging
+import sqlite3
+import shutil
+import argparse
+import tempfile
+import importlib
+
+ADMIN_COMMANDS = ["/stats", "/stats 7", "/show_data", "/search hello", "/list_admins", "/help"]
+WORDS = ["hello", "salam", "bot", "message", "test", "data", "telegram", "chat", "group", "search"]
+
+def percentile_ms(values: list, fraction: float) -> float:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return round(ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] * 1000, 3)
+
+def process_bytes_written() -> int:
+    """
+    Bytes this process has passed to write() so far (Linux), or None elsewhere.
+    This covers every file the process writes (database, WAL, logs, backups),
+    not just the database.
+    """
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                if line.startswith("wchar:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+def db_files_size(db_path: str) -> int:
+    return sum(os.path.getsize(db_path + suffix) for suffix in ("", "-wal", "-shm")
+               if os.path.exists(db_path + suffix))
+
+class UpdateFactory:
+    """
+    Builds Update objects in the shape Telegram sends them.
+    Private chats use the sender's ID; group chats have negative IDs.
+    """
+
+    def __init__(self, bot, chats: int, users: int, seed: int = 1) -> None:
+        self.bot = bot
+        self.random = random.Random(seed)
+        self.chats = [-(1000000000000 + n) for n in range(chats)]
+        self.users = list(range(100000, 100000 + users))
+        self.update_id = 0
+        self.message_id = 0
+
+    def _message(self, user_id: int, chat_id: int, **fields) -> dict:
+        self.update_id += 1
+        self.message_id += 1
+        chat = {"id": chat_id, "type": "private", "first_name": f"user{user_id}"} if chat_id > 0 \
+            else {"id": chat_id, "type": "supergroup", "title": f"group{-chat_id}"}
+        message = {
+            "message_id": self.message_id,
+            "date": int(time.time()),
+            "chat": chat,
+            "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}", "username": f"user{user_id}"},
+        }
+        message.update(fields)
+        return {"update_id": self.update_id, "message": message}
+
+    def text(self):
+        from telegram import Update
+        user_id = self.random.choice(self.users)
+        chat_id = self.random.choice(self.chats + [user_id])
+        text = " ".join(self.random.choices(WORDS, k=self.random.randint(1, 12)))
+        return Update.de_json(self._message(user_id, chat_id, text=text), self.bot)
+
+    def command(self, user_id: int, text: str):
+        from telegram import Update
+        command = text.split()[0]
+        entities = [{"type": "bot_command", "offset": 0, "length": len(command)}]
+        return Update.de_json(self._message(user_id, user_id, text=text, entities=entities), self.bot)
+
+    def document(self, user_id: int, file_id: str, file_name: str, caption: str):
+        from telegram import Update
+        command = caption.split()[0]
+        document = {"file_id": file_id, "file_unique_id": file_id, "file_name": file_name}
+        entities = [{"type": "bot_command", "offset": 0, "length": len(command)}]
+        data = self._message(user_id, user_id, document=document, caption=caption, caption_entities=entities)
+        return Update.de_json(data, self.bot)
+
+def make_backup(path: str, rows: int, chats: int, users: int) -> None:
+    """
+    Write a backup database with the current messages schema and the given
+    number of rows.
+    """
+    conn = sqlite3.connect(path)
+    conn.execute("""
+        CREATE TABLE messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER, username TEXT, chat_id INTEGER,
+            message_id INTEGER, message TEXT, date INTEGER
+        )
+    """)
+    rng = random.Random(2)
+    now = int(time.time())
+    with conn:
+        conn.executemany(
+            "INSERT INTO messages (user_id, username, chat_id, message_id, message, date) VALUES (?, ?, ?, ?, ?, ?)",
+            ((user_id, f"user{user_id}", -(2000000000000 + n % chats), n,
+              " ".join(rng.choices(WORDS, k=rng.randint(1, 12))), now - (rows - n))
+             for n in range(rows) for user_id in [100000 + n % users])
+        )
+    conn.close()
+
+class Benchmark:
+    """
+    Runs the scenarios against one offline application and collects results.
+    """
+
+    def __init__(self, bot_module, config, args) -> None:
+        self.bot_module = bot_module
+        self.config = config
+        self.args = args
+        self.request = bot_module.OfflineRequest(config.token)
+        self.application = bot_module.create_application(config, self.request)
+        self.factory = UpdateFactory(self.application.bot, args.chats, args.users)
+        self.results = []
+
+    async def _process(self, update, latencies: list) -> None:
+        started = time.perf_counter()
+        await self.application.process_update(update)
+        latencies.append(time.perf_counter() - started)
+
+    async def _measure(self, name: str, updates, count_key: str = "messages") -> dict:
+        bot_module = self.bot_module
+        updates = list(updates)
+        written_before = process_bytes_written()
+        size_before = db_files_size(self.config.db_path)
+        calls_before = sum(self.request.calls.values())
+        latencies, command_latencies = [], {}
+        started = time.perf_counter()
+        messages = 0
+        for kind, update in updates:
+            if kind == "text":
+                await self._process(update, latencies)
+                messages += 1
+            else:
+                await self._process(update, command_latencies.setdefault(kind, []))
+        await bot_module.writer.flush()
+        elapsed = time.perf_counter() - started
+        written_after = process_bytes_written()
+        result = {
+            "scenario": name,
+            "seconds": round(elapsed, 3),
+            count_key: messages,
+            f"{count_key}_per_sec": round(messages / elapsed, 1) if elapsed else 0.0,
+            "p50_ms": percentile_ms(latencies, 0.50),
+            "p99_ms": percentile_ms(latencies, 0.99),
+            "process_bytes_written": (written_after - written_before) if written_before is not None else None,
+            "db_growth": db_files_size(self.config.db_path) - size_before,
+            "api_calls": sum(self.request.calls.values()) - calls_before,
+            "commands": {
+                command: {"count": len(values),
+                          "p50_ms": percentile_ms(values, 0.50),
+                          "p99_ms": percentile_ms(values, 0.99)}
+                for command, values in command_latencies.items()
+            },
+        }
+        self.results.append(result)
+        return result
+
+    def _text_stream(self, count: int, command_every: int = 0):
+        admin_id = self.config.main_admin
+        for n in range(count):
+            yield "text", self.factory.text()
+            if command_every and (n + 1) % command_every == 0:
+                text = ADMIN_COMMANDS[(n // command_every) % len(ADMIN_COMMANDS)]
+                yield text.split()[0], self.factory.command(admin_id, text)
+
+    async def run_text(self) -> dict:
+        return await self._measure("text", self._text_stream(self.args.messages))
+
+    async def run_mixed(self) -> dict:
+        return await self._measure("mixed", self._text_stream(self.args.messages, self.args.command_every))
+
+    async def run_restore(self) -> dict:
+        rows = self.args.restore_rows
+        path = os.path.join(tempfile.mkdtemp(prefix="bench_backup_", dir="."), "backup_bench.db")
+        make_backup(path, rows, self.args.chats, self.args.users)
+        file_id = self.request.add_file(path)
+        update = self.factory.document(self.config.main_admin, file_id, "backup_bench.db", "/restore")
+        result = await self._measure("restore", [("/restore", update)], count_key="rows")
+        seconds = result["seconds"]
+        result["rows"] = rows
+        result["rows_per_sec"] = round(rows / seconds, 1) if seconds else 0.0
+        return result
+
+    async def run(self, scenarios: list) -> list:
+        await self.application.initialize()
+        await self.application.post_init(self.application)
+        try:
+            for scenario in scenarios:
+                await getattr(self, f"run_{scenario}")()
+        finally:
+            await self.application.post_shutdown(self.application)
+            await self.application.shutdown()
+        return self.results
+
+def format_result(result: dict) -> str:
+    count_key = "rows" if result["scenario"] == "restore" else "messages"
+    written = result["process_bytes_written"]
+    lines = [
+        f"[{result['scenario']}] {result[count_key]} {count_key} in {result['seconds']}s "
+        f"-> {result[f'{count_key}_per_sec']} {count_key}/s",
+    ]
+    if result["p50_ms"] is not None:
+        lines.append(f"  handler latency: p50={result['p50_ms']}ms p99={result['p99_ms']}ms")
+    lines += [
+        f"  DB growth: {result['db_growth']}, bytes written by the process: "
+        f"{written if written is not None else 'n/a'}, Bot API calls: {result['api_calls']}",
+    ]
+    for command, stats in sorted(result["commands"].items()):
+        lines.append(f"  {command}: {stats['count']}x p50={stats['p50_ms']}ms p99={stats['p99_ms']}ms")
+    return "\n".join(lines)
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Offline throughput benchmark for bot.py")
+    parser.add_argument("--scenario", choices=["text", "mixed", "restore", "all"], default="all")
+    parser.add_argument("--messages", type=int, default=20000, help="text messages per scenario")
+    parser.add_argument("--chats", type=int, default=50, help="number of group chats")
+    parser.add_argument("--users", type=int, default=500, help="number of distinct senders")
+    parser.add_argument("--command-every", type=int, default=100, help="text messages between admin commands")
+    parser.add_argument("--restore-rows", type=int, default=200000, help="rows in the restored backup")
+    parser.add_argument("--keep-rate-limits", action="store_true", help="keep the outbound rate limits")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    parser.add_argument("--keep", action="store_true", help="keep the temporary working directory")
+    args = parser.parse_args()
+
+    source_dir = os.path.dirname(os.path.abspath(__file__))
+    original_dir = os.getcwd()
+    work_dir = tempfile.mkdtemp(prefix="bench_")
+    # Relative paths in the bot's settings (ARTIFACT_DIR, MEDIA_DIR) resolve inside work_dir.
+    os.chdir(work_dir)
+    logging.basicConfig(format="%(asctime)s - %(levelname)s - %(message)s", level=logging.WARNING)
+    sys.path.insert(0, source_dir)
+    bot_module = importlib.import_module("bot")
+    config = bot_module.Config(
+        token=os.getenv("TOKEN", "123456:BENCHMARK"),
+        db_path=os.path.join(work_dir, "bot_data.db"),
+        main_admin=bot_module.MAIN_ADMIN_ID,
+        admins=bot_module.DEFAULT_ADMINS,
+        mode="polling",
+        concurrent_updates=bot_module.CONCURRENT_UPDATES,
+        worker_processes=0,
+        webhook_offline=True,
+    )
+    if not args.keep_rate_limits:
+        # A rate of 0 means no limit.
+        limiter = bot_module.rate_limiter
+        limiter.global_bucket = bot_module.TokenBucket(0, 1.0)
+        limiter.chat_rate = limiter.group_rate = 0
+
+    scenarios = ["text", "mixed", "restore"] if args.scenario == "all" else [args.scenario]
+    try:
+        results = asyncio.run(Benchmark(bot_module, config, args).run(scenarios))
+    finally:
+        os.chdir(original_dir)
+        if not args.keep:
+            # The restore scenario's backup directory lives inside work_dir too.
+            shutil.rmtree(work_dir, ignore_errors=True)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        if args.keep:
+            print(f"Working directory: {work_dir}")
+        for result in results:
+            print(format_result(result))
+
+if __name__ == "__main__":
+    main()
@@ -1,88 +1,4152 @@
+import time
+# Taken before the other imports, so the startup report includes their cost.
+IMPORT_STARTED = time.perf_counter()
 import os
+import asyncio
 import logging
 import sqlite3
-import shutil
 import re
-from datetime import datetime
-from telegram import Update
+import html
+import json
+import zlib
+import hashlib
+import tempfile
+import threading
+import uuid
+import random
+import functools
+import contextlib
+import contextvars
+import signal
+import shutil
+import gzip
+import csv
+import io
+import importlib.util
+import multiprocessing
+import multiprocessing.connection
+import pickle
+import queue
+import heapq
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
+try:
+    import zstandard
+except ImportError:  # zstd compression is optional
+    zstandard = None
+# pyarrow (/export parquet), openpyxl (/export xlsx), aiohttp (webhook mode and
+# the metrics endpoint) and matplotlib (/chart) are imported where they are
+# used, so a start that needs none of them does not pay for importing them.
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.constants import ParseMode
-from telegram.error import BadRequest
+from telegram.error import BadRequest, RetryAfter, TelegramError
+from telegram.request import BaseRequest
 from telegram.ext import (
-    Application, CommandHandler, MessageHandler, filters, CallbackContext
+    Application, ApplicationHandlerStop, BaseRateLimiter, CommandHandler, MessageHandler,
+    CallbackQueryHandler, TypeHandler, filters, CallbackContext
+)
+
+# ---------------- Logging Configuration ----------------
+def configure_logging() -> None:
+    """
+    Set up the root logger of a bot process (the main process and every child).
+    Importing bot.py leaves logging alone.
+    """
+    logging.basicConfig(
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+        level=logging.INFO
+    )
+    logging.getLogger().addHandler(LogCounter(LOG_MESSAGES))
+
+# ---------------- Retrieve Bot Token ----------------
+# Checked by Config.from_env(), not at import.
+TOKEN = os.getenv("TOKEN", "")
+
+DB_PATH = os.getenv("DB_PATH", "bot_data.db")
+
+# ---------------- Run Mode Settings ----------------
+# "polling" (default) or "webhook".
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+# Public base URL registered with setWebhook; leave empty to skip registration (e.g. behind a proxy that already set it).
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("PORT", "8443"))
+# Serve webhooks without contacting Telegram; outgoing requests are answered locally and logged.
+WEBHOOK_OFFLINE = os.getenv("WEBHOOK_OFFLINE", "0") == "1"
+# Number of updates processed concurrently.
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "8" if BOT_MODE == "webhook" else "1"))
+
+# ---------------- Worker Process Settings ----------------
+# Number of worker processes; 0 runs the whole bot in one process. With workers,
+# the main process only receives updates and hands them out by chat, and a
+# separate writer process performs every database write.
+WORKER_PROCESSES = int(os.getenv("WORKER_PROCESSES", "0"))
+# Updates waiting per worker (and writer calls waiting overall) before the
+# receiver stops fetching new updates from Telegram.
+WORKER_QUEUE_SIZE = int(os.getenv("WORKER_QUEUE_SIZE", "1000"))
+# Seconds a worker waits for the writer process to answer a database write.
+WORKER_CALL_TIMEOUT = float(os.getenv("WORKER_CALL_TIMEOUT", "60"))
+# Seconds a worker gets to finish its queued updates when stopped or restarted.
+WORKER_STOP_TIMEOUT = float(os.getenv("WORKER_STOP_TIMEOUT", "30"))
+
+# ---------------- Update Deduplication Settings ----------------
+# Recent (chat_id, message_id) pairs remembered to drop messages delivered twice
+# under different update IDs; also how far below the stored offset an update ID
+# still counts as already handled.
+UPDATE_DEDUP_WINDOW = int(os.getenv("UPDATE_DEDUP_WINDOW", "10000"))
+# Seconds a missing update ID may hold back the stored offset. Updates finish
+# out of order, and a worker process never sees the IDs of other workers' chats.
+UPDATE_GAP_TIMEOUT = float(os.getenv("UPDATE_GAP_TIMEOUT", "60"))
+
+# ---------------- Admin Settings ----------------
+# The main admin can never be removed.
+MAIN_ADMIN_ID = int(os.getenv("MAIN_ADMIN_ID", "381200758"))
+# Comma-separated user IDs registered as admins (with the main admin) when the
+# database is first created; later changes are stored in the database.
+ADMIN_IDS = os.getenv("ADMIN_IDS", "1156819072")
+DEFAULT_ADMINS = frozenset({MAIN_ADMIN_ID} | {int(user_id) for user_id in ADMIN_IDS.split(",") if user_id.strip()})
+# How often (seconds) the admin list version is checked for changes made by other processes.
+ADMINS_POLL_INTERVAL = float(os.getenv("ADMINS_POLL_INTERVAL", "5"))
+
+# ---------------- Write Queue Settings ----------------
+# Messages are buffered and written in one transaction when either limit is hit.
+WRITE_BATCH_SIZE = int(os.getenv("WRITE_BATCH_SIZE", "200"))
+WRITE_FLUSH_INTERVAL = float(os.getenv("WRITE_FLUSH_INTERVAL", "1.0"))
+WRITE_MAX_PENDING = int(os.getenv("WRITE_MAX_PENDING", "50000"))
+WRITE_MAX_RETRIES = int(os.getenv("WRITE_MAX_RETRIES", "3"))
+
+# Number of reader threads used for queries issued by handlers.
+DB_READERS = int(os.getenv("DB_READERS", "2"))
+
+# Per-connection SQLite tuning (cache_size in KiB, mmap_size in bytes).
+DB_CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", "16384"))
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", str(256 * 1024 * 1024)))
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+
+# ---------------- Backup Settings ----------------
+# Telegram bots can upload documents up to 50 MB but only download files up to
+# 20 MB, so parts are kept below 20 MB to make them usable with /restore.
+BACKUP_PART_SIZE = int(os.getenv("BACKUP_PART_SIZE", str(19 * 1024 * 1024)))
+BACKUP_PAGES_PER_STEP = int(os.getenv("BACKUP_PAGES_PER_STEP", "1024"))
+BACKUP_COMPRESSION = os.getenv("BACKUP_COMPRESSION", "gzip").lower()  # "gzip" or "zstd"
+UPLOAD_TIMEOUT = float(os.getenv("UPLOAD_TIMEOUT", "300"))
+# Rows merged per writer transaction during /restore.
+RESTORE_BATCH_SIZE = int(os.getenv("RESTORE_BATCH_SIZE", "5000"))
+# Seconds to wait for the files of a /restore sent without a document.
+RESTORE_WAIT_TIMEOUT = float(os.getenv("RESTORE_WAIT_TIMEOUT", "900"))
+
+# ---------------- File Settings ----------------
+# Backups, exports, archives and charts are written here; the files table
+# catalogs them (size, mtime, SHA-256 and the Telegram file_id once uploaded).
+# Matching files left in the working directory are moved in at startup.
+ARTIFACT_DIR = os.getenv("ARTIFACT_DIR", "artifacts")
+# Files listed per /list_files page.
+FILES_PAGE_SIZE = int(os.getenv("FILES_PAGE_SIZE", "30"))
+# Largest file /get_file uploads; the Bot API accepts documents up to 50 MB.
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", str(50 * 1024 * 1024)))
+
+# ---------------- Export Settings ----------------
+# Bots can upload documents up to 50 MB; larger exports are split into several files.
+EXPORT_PART_SIZE = int(os.getenv("EXPORT_PART_SIZE", str(45 * 1024 * 1024)))
+# Rows fetched from SQLite per batch while exporting.
+EXPORT_FETCH_SIZE = int(os.getenv("EXPORT_FETCH_SIZE", "5000"))
+
+# ---------------- Chart Settings ----------------
+# Worker processes that render /chart images.
+CHART_WORKERS = int(os.getenv("CHART_WORKERS", "1"))
+CHART_CACHE_SIZE = int(os.getenv("CHART_CACHE_SIZE", "32"))
+# A cached chart is re-rendered once this many new messages have arrived in its chat.
+CHART_REFRESH_MESSAGES = int(os.getenv("CHART_REFRESH_MESSAGES", "100"))
+CHART_MAX_DAYS = 365
+
+# ---------------- Media Settings ----------------
+# Media metadata is always recorded; with MEDIA_DOWNLOAD=1 the files are also
+# downloaded into MEDIA_DIR, one copy per file_unique_id.
+MEDIA_DOWNLOAD = os.getenv("MEDIA_DOWNLOAD", "0") == "1"
+MEDIA_DIR = os.getenv("MEDIA_DIR", "media")
+# Least recently seen files are deleted once the store grows beyond this size.
+MEDIA_QUOTA_BYTES = int(os.getenv("MEDIA_QUOTA_BYTES", str(1024 * 1024 * 1024)))
+MEDIA_DOWNLOAD_WORKERS = int(os.getenv("MEDIA_DOWNLOAD_WORKERS", "2"))
+# Files waiting for a download worker; newer files are skipped while it is full.
+MEDIA_QUEUE_SIZE = int(os.getenv("MEDIA_QUEUE_SIZE", "1000"))
+# Bots can only download files up to 20 MB.
+MEDIA_MAX_FILE_SIZE = 20 * 1024 * 1024
+
+# ---------------- Search Settings ----------------
+SEARCH_PAGE_SIZE = int(os.getenv("SEARCH_PAGE_SIZE", "10"))
+SEARCH_MAX_PAGES = 50
+# Rows indexed per batch while existing messages are added to the search index.
+FTS_BACKFILL_BATCH = int(os.getenv("FTS_BACKFILL_BATCH", "5000"))
+FTS_BACKFILL_INTERVAL = float(os.getenv("FTS_BACKFILL_INTERVAL", "0.5"))
+
+# ---------------- Retention Settings ----------------
+# Messages older than RETENTION_DAYS are moved out of the main database into
+# monthly archive files (archive_YYYY_MM.db); 0 keeps every message in place.
+RETENTION_DAYS = int(os.getenv("RETENTION_DAYS", "0"))
+# Seconds between retention runs, rows moved per batch and the pause between batches.
+RETENTION_INTERVAL = float(os.getenv("RETENTION_INTERVAL", "3600"))
+RETENTION_BATCH_SIZE = int(os.getenv("RETENTION_BATCH_SIZE", "5000"))
+RETENTION_BATCH_PAUSE = float(os.getenv("RETENTION_BATCH_PAUSE", "0.1"))
+# "none", "gzip" or "zstd". Months that can no longer receive rows are compressed;
+# queries unpack them into a temporary cache when needed.
+ARCHIVE_COMPRESSION = os.getenv("ARCHIVE_COMPRESSION", "none").lower()
+
+# ---------------- Username Resolver Settings ----------------
+RESOLVER_CACHE_SIZE = int(os.getenv("RESOLVER_CACHE_SIZE", "1024"))
+RESOLVER_TTL = float(os.getenv("RESOLVER_TTL", "3600"))
+RESOLVER_NEGATIVE_TTL = float(os.getenv("RESOLVER_NEGATIVE_TTL", "300"))
+
+# ---------------- Outbound Rate Limit Settings ----------------
+# Telegram allows about 30 messages/second overall, 1/second per private chat
+# and 20/minute per group. A rate of 0 removes the limit.
+OUTBOUND_GLOBAL_RATE = float(os.getenv("OUTBOUND_GLOBAL_RATE", "30"))
+OUTBOUND_CHAT_RATE = float(os.getenv("OUTBOUND_CHAT_RATE", "1"))
+OUTBOUND_GROUP_RATE = float(os.getenv("OUTBOUND_GROUP_RATE", str(20 / 60)))
+OUTBOUND_MAX_RETRIES = int(os.getenv("OUTBOUND_MAX_RETRIES", "3"))
+# When enabled, reply-mode replies still waiting for their turn in a chat are
+# merged into one reply to the newest message.
+REPLY_MERGE = os.getenv("REPLY_MERGE", "0") == "1"
+
+# ---------------- Message Browsing Settings ----------------
+SHOW_DATA_PAGE_SIZE = int(os.getenv("SHOW_DATA_PAGE_SIZE", "50"))
+# Telegram rejects text messages longer than 4096 characters.
+MESSAGE_LIMIT = 4096
+# Newest messages kept in memory per chat and overall, so the first /show_data
+# page is answered without SQLite; RECENT_PER_CHAT=0 disables the cache.
+# A chat needs more than SHOW_DATA_PAGE_SIZE cached messages to be served.
+RECENT_PER_CHAT = int(os.getenv("RECENT_PER_CHAT", "100"))
+RECENT_OVERALL = int(os.getenv("RECENT_OVERALL", "1000"))
+# Approximate memory cap; the least recently active chats are dropped first.
+RECENT_MAX_BYTES = int(os.getenv("RECENT_MAX_BYTES", str(32 * 1024 * 1024)))
+
+# ---------------- Metrics Settings ----------------
+# Port of the local Prometheus /metrics endpoint; 0 disables it.
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+
+# ---------------- Profiling Settings ----------------
+# Fraction of updates (and of background message batch writes) whose handler,
+# database and Bot API time is recorded as folded stacks; 0 disables profiling.
+# /profile changes it at runtime.
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+# SQL statements of profiled calls that run longer than this are logged.
+PROFILE_SLOW_QUERY_MS = float(os.getenv("PROFILE_SLOW_QUERY_MS", "100"))
+# SQLite VM instructions between checks for a slow statement that is still running.
+PROFILE_PROGRESS_STEPS = int(os.getenv("PROFILE_PROGRESS_STEPS", "100000"))
+
+# ---------------- Configuration ----------------
+class Config(namedtuple("Config", [
+    "token", "db_path", "main_admin", "admins", "mode", "concurrent_updates", "worker_processes",
+    "webhook_offline",
+])):
+    """
+    The settings that decide how the bot is put together: its token, database,
+    main admin, the admins a new database starts with, and run mode.
+    create_application() builds the bot from one; every other setting stays a
+    module-level constant.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_env(cls) -> "Config":
+        if not TOKEN:
+            raise ValueError("TOKEN is not set. Please set the TOKEN environment variable with your bot token.")
+        return cls(TOKEN, DB_PATH, MAIN_ADMIN_ID, DEFAULT_ADMINS, BOT_MODE, CONCURRENT_UPDATES, WORKER_PROCESSES,
+                   WEBHOOK_OFFLINE)
+
+# ---------------- Metrics ----------------
+# Histogram bucket upper bounds in seconds.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+def _escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Counter:
+    """
+    Monotonic counter, one value per combination of label values.
+    Safe to update from the DB threads.
+    """
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labels: tuple = ()) -> None:
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount: float = 1) -> None:
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def items(self) -> list:
+        with self._lock:
+            return list(self._values.items())
+
+    def samples(self) -> list:
+        return [(self.name, _format_labels(self.labels, key), value) for key, value in self.items()]
+
+class Histogram:
+    """
+    Latency histogram with fixed buckets, one series per combination of label
+    values. Quantiles are estimated from the buckets like Prometheus'
+    histogram_quantile().
+    """
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS) -> None:
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: float, *label_values) -> None:
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                # Per-bucket counts (the last one is +Inf), sum, count.
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            index = 0
+            while index < len(self.buckets) and seconds > self.buckets[index]:
+                index += 1
+            series[0][index] += 1
+            series[1] += seconds
+            series[2] += 1
+
+    def items(self) -> list:
+        """
+        [(label_values, (bucket_counts, sum, count))] with non-cumulative bucket counts.
+        """
+        with self._lock:
+            return [(key, (list(series[0]), series[1], series[2])) for key, series in self._series.items()]
+
+    def quantile(self, q: float, bucket_counts: list) -> float:
+        total = sum(bucket_counts)
+        if not total:
+            return 0.0
+        rank = q * total
+        seen, lower = 0, 0.0
+        for bound, count in zip(self.buckets, bucket_counts):
+            if count and seen + count >= rank:
+                return lower + (bound - lower) * (rank - seen) / count
+            seen += count
+            lower = bound
+        return self.buckets[-1]
+
+    def samples(self) -> list:
+        samples = []
+        for key, (bucket_counts, total, count) in self.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ("+Inf",), bucket_counts):
+                cumulative += bucket_count
+                samples.append((f"{self.name}_bucket", _format_labels(self.labels, key, f'le="{bound}"'), cumulative))
+            samples.append((f"{self.name}_sum", _format_labels(self.labels, key), total))
+            samples.append((f"{self.name}_count", _format_labels(self.labels, key), count))
+        return samples
+
+class CallbackMetric:
+    """
+    Gauge or counter whose value is read from fn() at scrape time. fn returns a
+    number, or a dict mapping label value tuples to numbers.
+    """
+
+    def __init__(self, name: str, help_text: str, fn, kind: str = "gauge", labels: tuple = ()) -> None:
+        self.name = name
+        self.help = help_text
+        self.fn = fn
+        self.kind = kind
+        self.labels = labels
+
+    def samples(self) -> list:
+        try:
+            value = self.fn()
+        except Exception as e:
+            logging.error(f"Error reading metric {self.name}: {e}")
+            return []
+        if isinstance(value, dict):
+            return [(self.name, _format_labels(self.labels, key), number) for key, number in value.items()]
+        return [(self.name, "", value)]
+
+class MetricsRegistry:
+    """
+    Collection of metrics rendered in the Prometheus text exposition format.
+    Registering a metric under an existing name replaces it.
+    """
+
+    def __init__(self) -> None:
+        self._metrics = {}
+        self.started = time.time()
+
+    def register(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help_text: str, labels: tuple = ()) -> Counter:
+        return self.register(Counter(name, help_text, labels))
+
+    def histogram(self, name: str, help_text: str, labels: tuple = ()) -> Histogram:
+        return self.register(Histogram(name, help_text, labels))
+
+    def callback(self, name: str, help_text: str, fn, kind: str = "gauge", labels: tuple = ()) -> CallbackMetric:
+        return self.register(CallbackMetric(name, help_text, fn, kind, labels))
+
+    def render(self) -> str:
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{labels} {value}")
+        return "\n".join(lines) + "\n"
+
+class LogCounter(logging.Handler):
+    """
+    Counts log records of WARNING and above. Most handlers catch their errors
+    and only log them, so this is where those errors show up.
+    """
+
+    def __init__(self, counter: Counter) -> None:
+        super().__init__(logging.WARNING)
+        self.counter = counter
+
+    def emit(self, record: logging.LogRecord) -> None:
+        self.counter.inc(record.levelname)
+
+metrics = MetricsRegistry()
+metrics.callback("bot_uptime_seconds", "Seconds since the bot process started.", lambda: round(time.time() - metrics.started, 3))
+HANDLER_CALLS = metrics.counter("bot_handler_calls_total", "Handler invocations.", ("handler",))
+HANDLER_SECONDS = metrics.histogram("bot_handler_seconds", "Handler run time.", ("handler",))
+ERRORS = metrics.counter("bot_errors_total", "Exceptions raised by handlers and database calls.", ("source", "exception"))
+LOG_MESSAGES = metrics.counter("bot_log_messages_total", "Log records at WARNING level and above.", ("level",))
+DB_SECONDS = metrics.histogram("bot_db_seconds", "Time spent running database calls on the DB threads.", ("kind", "call"))
+DB_COMMIT_SECONDS = metrics.histogram("bot_db_commit_seconds", "Duration of message batch transactions, including the commit.")
+
+# ---------------- Startup Report ----------------
+class StartupReport:
+    """
+    How long this process took to get going, in seconds: "import" (bot.py and
+    its imports) and "ready" (initialized, getMe included) are measured from
+    the start of the import, "database" is opening and migrating the database,
+    and "first_update" is when the first update reached a handler.
+    """
+
+    def __init__(self, started: float) -> None:
+        self.started = started
+        self.phases = {}
+        self.waiting = True
+
+    def record(self, phase: str, seconds: float) -> None:
+        self.phases[phase] = round(seconds, 3)
+
+    def mark(self, phase: str) -> None:
+        self.record(phase, time.perf_counter() - self.started)
+
+    def first_update(self) -> None:
+        self.waiting = False
+        self.mark("first_update")
+        logging.info(f"First update handled {self.phases['first_update']}s after start.")
+
+    def summary(self) -> str:
+        return ", ".join(f"{phase}={seconds}s" for phase, seconds in self.phases.items())
+
+startup = StartupReport(IMPORT_STARTED)
+metrics.callback(
+    "bot_startup_seconds", "Startup phases of this process.",
+    lambda: {(phase,): seconds for phase, seconds in startup.phases.items()}, labels=("phase",)
+)
+
+# ---------------- Profiling ----------------
+SQL_LITERAL_RE = re.compile(r"[xX]?'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+SQL_LIST_RE = re.compile(r"\?(?:\s*,\s*\?)+")
+
+class ProfileFrame:
+    """
+    A running span of a profiled call: its folded stack ("handler;db.read fn")
+    and the time spent in its child spans so far.
+    """
+    __slots__ = ("stack", "children")
+
+    def __init__(self, stack: str) -> None:
+        self.stack = stack
+        self.children = 0.0
+
+class Profiler:
+    """
+    Sampling profiler for updates. A sampled handler call becomes a root frame;
+    database calls, their SQL statements (via the sqlite3 trace callback) and
+    Bot API requests made while it runs become child frames. The self time of
+    every frame is summed per stack and dumped in the folded format that
+    flamegraph.pl, speedscope and inferno read, in microseconds.
+    The current frame is kept in a context variable, so tasks started by a
+    profiled handler are attributed to it as well.
+    """
+    # Distinct stacks kept; later new stacks are summed under "<root>;(other)".
+    MAX_STACKS = 5000
+    SQL_FRAME_LENGTH = 120
+
+    def __init__(self, rate: float, slow_query_ms: float, progress_steps: int) -> None:
+        self.rate = rate
+        self.slow_query = slow_query_ms / 1000
+        self.progress_steps = progress_steps
+        self.current = contextvars.ContextVar("profile_frame", default=None)
+        self._stacks = {}
+        self._lock = threading.Lock()
+        self.started = time.time()
+        # Counters
+        self.samples = 0
+        self.slow_queries = 0
+
+    def start(self, rate: float) -> None:
+        """
+        Profile the given fraction of updates from now on, dropping what was collected so far.
+        """
+        with self._lock:
+            self._stacks.clear()
+        self.rate = rate
+        self.started = time.time()
+        self.samples = 0
+        self.slow_queries = 0
+
+    def sampled(self, key: int = None) -> bool:
+        """
+        Whether to profile the call with the given key (an update_id, so every
+        handler of an update makes the same choice), or a random call.
+        """
+        if not self.rate:
+            return False
+        if key is None:
+            return random.random() < self.rate
+        return (key * 2654435761) % 4294967296 < self.rate * 4294967296
+
+    def sample(self, name: str, key: int = None):
+        """
+        Context manager that profiles its body as a root frame called name, if sampled.
+        """
+        if not self.sampled(key):
+            return contextlib.nullcontext()
+        self.samples += 1
+        return self._span(ProfileFrame(name), None, "total")
+
+    def span(self, name: str, stage: str):
+        """
+        Context manager that records its body as a child frame of the current
+        profiled call; does nothing outside of one. Yields the frame or None.
+        """
+        parent = self.current.get()
+        if parent is None:
+            return contextlib.nullcontext()
+        return self._span(ProfileFrame(f"{parent.stack};{name}"), parent, stage)
+
+    @contextlib.contextmanager
+    def _span(self, frame: ProfileFrame, parent: ProfileFrame, stage: str):
+        token = self.current.set(frame)
+        started = time.perf_counter()
+        try:
+            yield frame
+        finally:
+            elapsed = time.perf_counter() - started
+            self.current.reset(token)
+            self.add(frame, elapsed, parent, stage)
+
+    def add(self, frame: ProfileFrame, elapsed: float, parent: ProfileFrame, stage: str) -> None:
+        """
+        Record elapsed seconds for frame (its self time is what its children did not use).
+        """
+        if parent is not None:
+            parent.children += elapsed
+        root = frame.stack.split(";", 1)[0]
+        PROFILE_SECONDS.observe(elapsed, root, stage)
+        micros = int(max(elapsed - frame.children, 0.0) * 1000000)
+        with self._lock:
+            stack = frame.stack
+            if stack not in self._stacks and len(self._stacks) >= self.MAX_STACKS:
+                stack = f"{root};(other)"
+            self._stacks[stack] = self._stacks.get(stack, 0) + micros
+
+    def sql_frame(self, sql: str) -> str:
+        """
+        Frame name for a statement: literals replaced by ?, so statements only
+        differing in their parameters share a frame (and no message text ends
+        up in the profile).
+        """
+        sql = SQL_LIST_RE.sub("?, ...", SQL_LITERAL_RE.sub("?", " ".join(sql.split())))
+        return "sql " + sql[:self.SQL_FRAME_LENGTH].replace(";", ",")
+
+    def top(self, count: int) -> list:
+        """
+        The count stacks with the most self time, as (stack, seconds).
+        """
+        with self._lock:
+            items = sorted(self._stacks.items(), key=lambda item: -item[1])[:count]
+        return [(stack, micros / 1000000) for stack, micros in items]
+
+    def dump(self, path: str) -> int:
+        """
+        Write the collected stacks to path in the folded format. Returns the number of stacks.
+        """
+        with self._lock:
+            items = sorted(self._stacks.items())
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, micros in items:
+                f.write(f"{stack} {micros}\n")
+        return len(items)
+
+class SqlTrace:
+    """
+    Times the SQL statements one profiled database call runs. The sqlite3 trace
+    callback fires when a statement starts, so a statement lasts until the next
+    one starts or the call ends. The progress handler logs a statement that is
+    still running after the slow query threshold.
+    """
+
+    def __init__(self, profiler: Profiler, conn: sqlite3.Connection, frame: ProfileFrame) -> None:
+        self.profiler = profiler
+        self.conn = conn
+        self.frame = frame
+        self._sql = None
+        self._started = 0.0
+        self._reported = False
+        conn.set_trace_callback(self._statement)
+        conn.set_progress_handler(self._progress, profiler.progress_steps)
+
+    def _finish(self, now: float) -> None:
+        if self._sql is None:
+            return
+        elapsed = now - self._started
+        name = self.profiler.sql_frame(self._sql)
+        stage = "commit" if name == "sql COMMIT" else "sql"
+        self.profiler.add(ProfileFrame(f"{self.frame.stack};{name}"), elapsed, self.frame, stage)
+        if elapsed > self.profiler.slow_query:
+            self.profiler.slow_queries += 1
+            logging.warning(f"Slow query ({elapsed * 1000:.0f} ms) in {self.frame.stack}: {name[4:]}")
+
+    def _statement(self, sql: str) -> None:
+        now = time.perf_counter()
+        self._finish(now)
+        self._sql = sql
+        self._started = now
+        self._reported = False
+
+    def _progress(self) -> int:
+        if not self._reported and self._sql is not None:
+            elapsed = time.perf_counter() - self._started
+            if elapsed > self.profiler.slow_query:
+                self._reported = True
+                logging.warning(f"Slow query still running after {elapsed * 1000:.0f} ms in "
+                                f"{self.frame.stack}: {self.profiler.sql_frame(self._sql)[4:]}")
+        return 0
+
+    def close(self) -> None:
+        self._finish(time.perf_counter())
+        self.conn.set_trace_callback(None)
+        self.conn.set_progress_handler(None, 0)
+
+PROFILE_SECONDS = metrics.histogram(
+    "bot_profile_stage_seconds", "Time of profiled calls by stage (total, db, sql, commit, api, wait).", ("root", "stage")
+)
+profiler = Profiler(PROFILE_SAMPLE_RATE, PROFILE_SLOW_QUERY_MS, PROFILE_PROGRESS_STEPS)
+metrics.callback("bot_profile_sample_rate", "Fraction of updates being profiled.", lambda: profiler.rate)
+metrics.callback("bot_slow_queries_total", "Slow SQL statements seen in profiled calls.", lambda: profiler.slow_queries, "counter")
+
+# ---------------- Database Access Layer ----------------
+def _shared(name: str):
+    return globals()[name]
+
+class SharedInstance:
+    """
+    Base for module-level singletons whose methods are run by the writer process
+    (see RemoteWriter). They pickle as a reference to the global of the same
+    name, so writer._write_batch sent from a worker runs on the writer process's
+    own writer.
+    """
+
+    def __reduce__(self):
+        for name, value in globals().items():
+            if value is self:
+                return _shared, (name,)
+        raise TypeError(f"{type(self).__name__} is not a module-level instance and cannot be shared")
+
+class Database:
+    """
+    Runs all SQLite work off the event loop.
+    Writes go through a single writer thread and reads through a small pool of
+    reader threads. Every thread owns its own connection.
+    In a worker process, remote is set and writes are sent to the writer process instead.
+    """
+
+    def __init__(self, path: str, readers: int = 2) -> None:
+        self.path = path
+        self.readers = max(readers, 1)
+        self._open_executors()
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+        self.remote = None
+
+    def _open_executors(self) -> None:
+        # Threads are only started by the first call.
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+        self._readers = ThreadPoolExecutor(max_workers=self.readers, thread_name_prefix="db-reader")
+
+    def connect(self) -> sqlite3.Connection:
+        """
+        Open a new connection to the database file.
+        """
+        # Each connection is only ever used by the thread that opened it; the flag
+        # just allows close() to run from the shutting-down thread.
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute(f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute(f"PRAGMA cache_size = -{DB_CACHE_SIZE_KB}")
+        conn.execute(f"PRAGMA mmap_size = {DB_MMAP_SIZE}")
+        conn.execute("PRAGMA temp_store = MEMORY")
+        return conn
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self.connect()
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    def _call(self, kind: str, fn, args, frame: ProfileFrame = None):
+        started = time.perf_counter()
+        conn = self._connection()
+        # Profiled calls time their SQL statements.
+        sql_trace = SqlTrace(profiler, conn, frame) if frame is not None else None
+        try:
+            return fn(conn, *args)
+        except Exception as e:
+            ERRORS.inc("db", type(e).__name__)
+            raise
+        finally:
+            if sql_trace is not None:
+                sql_trace.close()
+            DB_SECONDS.observe(time.perf_counter() - started, kind, getattr(fn, "__name__", "call"))
+
+    async def read(self, fn, *args):
+        """
+        Run fn(conn, *args) on a reader thread and return its result.
+        """
+        with profiler.span(f"db.read {getattr(fn, '__name__', 'call')}", "db") as frame:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._readers, self._call, "read", fn, args, frame)
+
+    async def write(self, fn, *args):
+        """
+        Run fn(conn, *args) on the writer thread and return its result.
+        """
+        with profiler.span(f"db.write {getattr(fn, '__name__', 'call')}", "db") as frame:
+            if self.remote is not None:
+                return await self.remote.call(fn, args)
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._writer, self._call, "write", fn, args, frame)
+
+    @staticmethod
+    def _fetchall(conn: sqlite3.Connection, sql: str, params: tuple) -> list:
+        return conn.execute(sql, params).fetchall()
+
+    @staticmethod
+    def _fetchone(conn: sqlite3.Connection, sql: str, params: tuple):
+        return conn.execute(sql, params).fetchone()
+
+    async def fetchall(self, sql: str, params: tuple = ()) -> list:
+        return await self.read(self._fetchall, sql, params)
+
+    async def fetchone(self, sql: str, params: tuple = ()):
+        return await self.read(self._fetchone, sql, params)
+
+    def file_sizes(self) -> dict:
+        """
+        Size in bytes of the database file and its WAL, keyed by ("db",) and ("wal",).
+        """
+        sizes = {}
+        for label, suffix in (("db", ""), ("wal", "-wal")):
+            try:
+                sizes[(label,)] = os.path.getsize(self.path + suffix)
+            except OSError:
+                sizes[(label,)] = 0
+        return sizes
+
+    def close(self) -> None:
+        """
+        Wait for queued work to finish and close every connection. The
+        database stays usable: the next call opens new threads and connections,
+        so a later application in the same process can start again.
+        """
+        self._writer.shutdown(wait=True)
+        self._readers.shutdown(wait=True)
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+        self._open_executors()
+
+# ---------------- Schema Migrations ----------------
+def _migrate_v1(conn: sqlite3.Connection) -> None:
+    """
+    v1: the original messages table.
+    """
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            username TEXT,
+            chat_id INTEGER,
+            message TEXT,
+            date TEXT
+        )
+    """)
+
+def _migrate_v2(conn: sqlite3.Connection) -> None:
+    """
+    v2: store the date as integer epoch seconds (UTC), add message_id with a
+    unique key per chat, and index user_id and date. The unique
+    (chat_id, message_id) index also serves lookups by chat_id.
+    """
+    conn.execute("""
+        CREATE TABLE messages_v2 (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            username TEXT,
+            chat_id INTEGER,
+            message_id INTEGER,
+            message TEXT,
+            date INTEGER
+        )
+    """)
+    # v1 dates were written as "%Y-%m-%d %H:%M:%S" in UTC; keep any value
+    # that cannot be parsed as it was rather than losing it.
+    conn.execute("""
+        INSERT INTO messages_v2 (id, user_id, username, chat_id, message, date)
+        SELECT id, user_id, username, chat_id, message,
+               COALESCE(CAST(strftime('%s', date) AS INTEGER), date)
+        FROM messages
+    """)
+    conn.execute("DROP TABLE messages")
+    conn.execute("ALTER TABLE messages_v2 RENAME TO messages")
+    conn.execute("CREATE UNIQUE INDEX idx_messages_chat_message ON messages (chat_id, message_id)")
+    conn.execute("CREATE INDEX idx_messages_user_id ON messages (user_id)")
+    conn.execute("CREATE INDEX idx_messages_date ON messages (date)")
+
+def rebuild_stats(conn: sqlite3.Connection) -> None:
+    """
+    Recompute the statistics tables from the messages table.
+    Must run inside a transaction; the triggers keep them up to date afterwards.
+    """
+    conn.execute("DELETE FROM user_stats")
+    conn.execute("DELETE FROM chat_stats")
+    conn.execute("DELETE FROM daily_stats")
+    conn.execute("""
+        INSERT INTO user_stats (user_id, username, msg_count, last_date)
+        SELECT m.user_id,
+               (SELECT username FROM messages WHERE user_id = m.user_id ORDER BY id DESC LIMIT 1),
+               COUNT(*), MAX(m.date)
+        FROM messages m
+        WHERE m.user_id IS NOT NULL
+        GROUP BY m.user_id
+    """)
+    conn.execute("""
+        INSERT INTO chat_stats (chat_id, msg_count, last_date)
+        SELECT chat_id, COUNT(*), MAX(date) FROM messages
+        WHERE chat_id IS NOT NULL
+        GROUP BY chat_id
+    """)
+    conn.execute("""
+        INSERT INTO daily_stats (day, chat_id, msg_count)
+        SELECT date / 86400, chat_id, COUNT(*) FROM messages
+        WHERE chat_id IS NOT NULL
+        GROUP BY date / 86400, chat_id
+    """)
+    conn.execute("""
+        INSERT OR REPLACE INTO totals (id, messages, users)
+        VALUES (1, (SELECT COUNT(*) FROM messages), (SELECT COUNT(*) FROM user_stats))
+    """)
+
+def _migrate_v3(conn: sqlite3.Connection) -> None:
+    """
+    v3: per-user, per-chat and per-day counters plus global totals, maintained
+    by triggers in the same transaction as every insert into messages.
+    """
+    conn.execute("""
+        CREATE TABLE user_stats (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            msg_count INTEGER NOT NULL DEFAULT 0,
+            last_date INTEGER
+        )
+    """)
+    conn.execute("CREATE INDEX idx_user_stats_msg_count ON user_stats (msg_count)")
+    conn.execute("""
+        CREATE TABLE chat_stats (
+            chat_id INTEGER PRIMARY KEY,
+            msg_count INTEGER NOT NULL DEFAULT 0,
+            last_date INTEGER
+        )
+    """)
+    # day is the number of whole days since the epoch (date / 86400).
+    conn.execute("""
+        CREATE TABLE daily_stats (
+            day INTEGER NOT NULL,
+            chat_id INTEGER NOT NULL,
+            msg_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, chat_id)
+        ) WITHOUT ROWID
+    """)
+    conn.execute("""
+        CREATE TABLE totals (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            messages INTEGER NOT NULL DEFAULT 0,
+            users INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    conn.execute("""
+        CREATE TRIGGER messages_stats_totals AFTER INSERT ON messages
+        BEGIN
+            UPDATE totals SET messages = messages + 1 WHERE id = 1;
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER messages_stats_user AFTER INSERT ON messages
+        WHEN NEW.user_id IS NOT NULL
+        BEGIN
+            INSERT INTO user_stats (user_id, username, msg_count, last_date)
+            VALUES (NEW.user_id, NEW.username, 1, NEW.date)
+            ON CONFLICT (user_id) DO UPDATE SET
+                msg_count = msg_count + 1,
+                username = COALESCE(excluded.username, username),
+                last_date = MAX(COALESCE(last_date, 0), excluded.last_date);
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER messages_stats_chat AFTER INSERT ON messages
+        WHEN NEW.chat_id IS NOT NULL
+        BEGIN
+            INSERT INTO chat_stats (chat_id, msg_count, last_date)
+            VALUES (NEW.chat_id, 1, NEW.date)
+            ON CONFLICT (chat_id) DO UPDATE SET
+                msg_count = msg_count + 1,
+                last_date = MAX(COALESCE(last_date, 0), excluded.last_date);
+            INSERT INTO daily_stats (day, chat_id, msg_count)
+            VALUES (NEW.date / 86400, NEW.chat_id, 1)
+            ON CONFLICT (day, chat_id) DO UPDATE SET msg_count = msg_count + 1;
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER user_stats_new_user AFTER INSERT ON user_stats
+        BEGIN
+            UPDATE totals SET users = users + 1 WHERE id = 1;
+        END
+    """)
+    rebuild_stats(conn)
+
+def _migrate_v4(conn: sqlite3.Connection) -> None:
+    """
+    v4: index the natural key of rows stored without a message_id (v1 data and
+    restores of v1 backups). It is not unique: v1 dates have one-second
+    resolution, so a user can send the same text twice within one key, and
+    such rows are kept. Restores deduplicate them by counting (see
+    merge_backup_batch).
+    """
+    conn.execute("""
+        CREATE INDEX idx_messages_legacy_key
+        ON messages (chat_id, user_id, date, message)
+        WHERE message_id IS NULL
+    """)
+
+def _migrate_v5(conn: sqlite3.Connection) -> None:
+    """
+    v5: index chat_id on its own so chat-filtered pages can walk it in id order.
+    """
+    conn.execute("CREATE INDEX idx_messages_chat_id ON messages (chat_id)")
+
+def fts5_available(conn: sqlite3.Connection) -> bool:
+    """
+    True if this SQLite build includes the FTS5 extension.
+    """
+    return conn.execute("SELECT sqlite_compileoption_used('ENABLE_FTS5')").fetchone()[0] == 1
+
+def _migrate_v6(conn: sqlite3.Connection) -> None:
+    """
+    v6: a meta key/value table and an FTS5 external-content index over
+    messages.message. New rows are indexed by trigger; rows that existed before
+    the migration (ids up to fts_backfill_end) are indexed in the background
+    by FtsBackfill, which advances fts_backfill_pos.
+    """
+    conn.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value) WITHOUT ROWID")
+    if not fts5_available(conn):
+        logging.warning("SQLite was built without FTS5; /search will be unavailable.")
+        return
+    conn.execute("""
+        CREATE VIRTUAL TABLE messages_fts USING fts5(
+            message, content='messages', content_rowid='id'
+        )
+    """)
+    end = conn.execute("SELECT COALESCE(MAX(id), 0) FROM messages").fetchone()[0]
+    conn.execute("INSERT INTO meta (key, value) VALUES ('fts_backfill_pos', 0), ('fts_backfill_end', ?)", (end,))
+    conn.execute("""
+        CREATE TRIGGER messages_fts_insert AFTER INSERT ON messages
+        BEGIN
+            INSERT INTO messages_fts (rowid, message) VALUES (NEW.id, NEW.message);
+        END
+    """)
+    # Only rows that are already in the index may be removed from it.
+    conn.execute("""
+        CREATE TRIGGER messages_fts_delete AFTER DELETE ON messages
+        WHEN OLD.id > (SELECT value FROM meta WHERE key = 'fts_backfill_end')
+          OR OLD.id <= (SELECT value FROM meta WHERE key = 'fts_backfill_pos')
+        BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, message) VALUES ('delete', OLD.id, OLD.message);
+        END
+    """)
+
+def _migrate_v7(conn: sqlite3.Connection) -> None:
+    """
+    v7: users table with the latest known profile of every user, used to
+    resolve @usernames locally. Seeded from the usernames already stored.
+    """
+    conn.execute("""
+        CREATE TABLE users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            last_name TEXT,
+            updated INTEGER
+        )
+    """)
+    conn.execute("CREATE INDEX idx_users_username ON users (username COLLATE NOCASE)")
+    conn.execute("""
+        INSERT INTO users (user_id, username, updated)
+        SELECT user_id, username, last_date FROM user_stats
+    """)
+
+def _migrate_v8(conn: sqlite3.Connection, admins: frozenset) -> None:
+    """
+    v8: persistent admin list, seeded with admins (the configured ones, see
+    Config.admins). Every change bumps meta.admins_version so running processes
+    notice it.
+    """
+    conn.execute("""
+        CREATE TABLE admins (
+            user_id INTEGER PRIMARY KEY,
+            added_by INTEGER,
+            added INTEGER
+        )
+    """)
+    conn.executemany("INSERT INTO admins (user_id, added) VALUES (?, strftime('%s', 'now'))",
+                     [(admin_id,) for admin_id in sorted(admins)])
+    conn.execute("INSERT INTO meta (key, value) VALUES ('admins_version', 1)")
+    for event in ("INSERT", "DELETE"):
+        conn.execute(f"""
+            CREATE TRIGGER admins_version_{event.lower()} AFTER {event} ON admins
+            BEGIN
+                UPDATE meta SET value = value + 1 WHERE key = 'admins_version';
+            END
+        """)
+
+def _migrate_v9(conn: sqlite3.Connection) -> None:
+    """
+    v9: messages of every kind. media holds one row per file, keyed by
+    Telegram's file_unique_id, so a file forwarded many times is described
+    (and, with MEDIA_DOWNLOAD, stored) once; message_media links non-text
+    messages to their kind and file. message_versions keeps every edit of a
+    message, the messages row keeps the original.
+    """
+    conn.execute("""
+        CREATE TABLE media (
+            file_unique_id TEXT PRIMARY KEY,
+            file_id TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            mime_type TEXT,
+            file_name TEXT,
+            file_size INTEGER,
+            width INTEGER,
+            height INTEGER,
+            duration INTEGER,
+            first_seen INTEGER,
+            last_seen INTEGER,
+            seen_count INTEGER NOT NULL DEFAULT 0,
+            path TEXT,
+            stored_size INTEGER
+        )
+    """)
+    conn.execute("CREATE INDEX idx_media_stored ON media (last_seen) WHERE path IS NOT NULL")
+    conn.execute("""
+        CREATE TABLE message_media (
+            chat_id INTEGER NOT NULL,
+            message_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            file_unique_id TEXT,
+            PRIMARY KEY (chat_id, message_id)
+        ) WITHOUT ROWID
+    """)
+    conn.execute("CREATE INDEX idx_message_media_file ON message_media (file_unique_id)")
+    conn.execute("""
+        CREATE TABLE message_versions (
+            chat_id INTEGER NOT NULL,
+            message_id INTEGER NOT NULL,
+            edit_date INTEGER NOT NULL,
+            user_id INTEGER,
+            message TEXT,
+            PRIMARY KEY (chat_id, message_id, edit_date)
+        ) WITHOUT ROWID
+    """)
+
+def _migrate_v10(conn: sqlite3.Connection) -> None:
+    """
+    v10: catalog of the files in ARTIFACT_DIR. file_id is the Telegram file of
+    the last upload, reused until the content changes. Filled by
+    FileCatalog.sync() at startup.
+    """
+    conn.execute("""
+        CREATE TABLE files (
+            name TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            mtime INTEGER NOT NULL,
+            sha256 TEXT NOT NULL,
+            file_id TEXT,
+            added INTEGER
+        ) WITHOUT ROWID
+    """)
+
+# Each entry upgrades the schema by one version; PRAGMA user_version records
+# how many have been applied.
+MIGRATIONS = [
+    _migrate_v1, _migrate_v2, _migrate_v3, _migrate_v4, _migrate_v5, _migrate_v6, _migrate_v7,
+    _migrate_v8, _migrate_v9, _migrate_v10,
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+def migrate(conn: sqlite3.Connection, admins: frozenset = DEFAULT_ADMINS) -> int:
+    """
+    Apply all pending migrations in order, each in its own transaction.
+    admins seeds the admin list when v8 creates it. Returns the resulting
+    schema version.
+    """
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version > SCHEMA_VERSION:
+        raise RuntimeError(f"Database schema version {version} is newer than supported ({SCHEMA_VERSION}).")
+    while version < SCHEMA_VERSION:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            migration = MIGRATIONS[version]
+            if migration is _migrate_v8:
+                migration = functools.partial(migration, admins=admins)
+            migration(conn)
+            version += 1
+            conn.execute(f"PRAGMA user_version = {version}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        logging.info(f"Database migrated to schema version {version}.")
+    return version
+
+# ---------------- Initialize Database ----------------
+def init_db(conn: sqlite3.Connection, admins: frozenset = DEFAULT_ADMINS) -> None:
+    """
+    Bring the database schema up to date and switch it to WAL mode. admins are
+    the admins of a newly created database.
+    """
+    try:
+        migrate(conn, admins)
+        conn.execute("PRAGMA journal_mode = WAL")
+        logging.info("Database initialized successfully.")
+    except Exception as e:
+        logging.error(f"Error initializing database: {e}")
+        raise
+
+def format_date(value) -> str:
+    """
+    Format a stored epoch date for display (UTC).
+    """
+    if not isinstance(value, int):
+        return str(value)
+    return datetime.fromtimestamp(value, timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+
+# Connections are opened on first use; the schema is brought up to date by open_database() at startup.
+db = Database(DB_PATH, DB_READERS)
+
+# ---------------- Recent Messages Cache ----------------
+class RecentRecord:
+    """
+    One cached message. id stays None until the row has been written; refs
+    counts the rings holding it.
+    """
+    __slots__ = ("id", "user_id", "username", "chat_id", "message_id", "message", "date", "refs")
+
+    def __init__(self, user_id: int, username: str, chat_id: int, message_id: int, message: str, date: int) -> None:
+        self.id = None
+        self.user_id = user_id
+        self.username = username
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.message = message
+        self.date = date
+        self.refs = 0
+
+    def as_row(self) -> tuple:
+        # Same shape as the rows of fetch_messages_page.
+        return self.id, self.user_id, self.username, self.chat_id, self.message, self.date
+
+class RecentMessages:
+    """
+    Ring buffers of the newest messages per chat and overall, filled by the
+    message writer. A record only becomes visible once its flush has assigned
+    it an id, so a page served from here is exactly the page SQLite would
+    return, as long as every newer row was written through this process: true
+    for a chat since startup (in multi-process mode each chat has one worker)
+    and for the overall ring only in single-process mode. Rows merged by
+    /restore get newer ids out of arrival order, so a restore clears the cache
+    (of the worker that ran it, in multi-process mode).
+    bytes counts every record still held by a ring. Over max_bytes, the least
+    recently active chats are dropped together with their pending records and
+    the part of the overall ring up to their newest record, so the memory is
+    really released and the overall ring stays a gapless run of the newest rows.
+    """
+    # Rough per-record cost on top of the strings (object, slots, deque entries).
+    RECORD_OVERHEAD = 200
+
+    def __init__(self, per_chat: int, overall: int, max_bytes: int) -> None:
+        self.per_chat = per_chat
+        self.max_bytes = max_bytes
+        self._chats = OrderedDict()
+        self._overall = deque(maxlen=overall) if overall > 0 else None
+        self._unassigned = {}
+        self.serve_overall = True
+        self.bytes = 0
+        # Counters
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.per_chat > 0
+
+    def _size(self, record: RecentRecord) -> int:
+        return self.RECORD_OVERHEAD + len(record.message or "") + len(record.username or "")
+
+    def _release(self, record: RecentRecord) -> None:
+        record.refs -= 1
+        if not record.refs:
+            self.bytes -= self._size(record)
+
+    def add(self, row: tuple) -> None:
+        """
+        Cache a (user_id, username, chat_id, message_id, message, date) row queued for writing.
+        """
+        record = RecentRecord(*row)
+        ring = self._chats.get(record.chat_id)
+        if ring is None:
+            ring = self._chats[record.chat_id] = deque()
+        else:
+            self._chats.move_to_end(record.chat_id)
+        self.bytes += self._size(record)
+        record.refs = 1
+        ring.append(record)
+        if len(ring) > self.per_chat:
+            self._release(ring.popleft())
+        if self._overall is not None:
+            if len(self._overall) == self._overall.maxlen:
+                self._release(self._overall.popleft())
+            record.refs += 1
+            self._overall.append(record)
+        self._unassigned[(record.chat_id, record.message_id)] = record
+        if self.bytes > self.max_bytes:
+            self._evict()
+
+    def _evict(self) -> None:
+        evicted = set()
+        while self.bytes > self.max_bytes and len(self._chats) > 1:
+            chat_id, ring = self._chats.popitem(last=False)
+            evicted.add(chat_id)
+            for old in ring:
+                self._release(old)
+        if not evicted:
+            return
+        self._unassigned = {key: record for key, record in self._unassigned.items() if key[0] not in evicted}
+        if self._overall is not None:
+            # Drop the overall ring up to the newest record of an evicted chat.
+            keep = 0
+            for record in reversed(self._overall):
+                if record.chat_id in evicted:
+                    break
+                keep += 1
+            while len(self._overall) > keep:
+                self._release(self._overall.popleft())
+
+    def settle(self, batch: list, ids: list) -> None:
+        """
+        Give the records of a flushed (or dropped) batch their ids from
+        (id, chat_id, message_id) rows. Records without one, such as ignored
+        duplicates, stay invisible.
+        """
+        assigned = {(chat_id, message_id): row_id for row_id, chat_id, message_id in ids or ()}
+        for row in batch:
+            key = (row[2], row[3])
+            record = self._unassigned.pop(key, None)
+            if record is not None:
+                record.id = assigned.get(key)
+
+    def clear(self) -> None:
+        self._chats.clear()
+        if self._overall is not None:
+            self._overall.clear()
+        self._unassigned.clear()
+        self.bytes = 0
+
+    def page(self, message_filters: dict, limit: int):
+        """
+        Newest page for fetch_messages_page's filters, as (rows, has_older,
+        has_newer), or None when the cache cannot answer it.
+        """
+        if not self.enabled:
+            return None
+        chat_id = message_filters.get("chat")
+        ring = self._chats.get(chat_id) if chat_id is not None else (self._overall if self.serve_overall else None)
+        rows = []
+        for record in reversed(ring or ()):
+            if record.id is None:
+                continue
+            if "user" in message_filters and record.user_id != message_filters["user"]:
+                continue
+            if "to" in message_filters and record.date >= message_filters["to"]:
+                continue
+            if "from" in message_filters and record.date < message_filters["from"]:
+                continue
+            rows.append(record.as_row())
+            if len(rows) > limit:
+                self.hits += 1
+                return rows[:limit], True, False
+        self.misses += 1
+        return None
+
+recent = RecentMessages(RECENT_PER_CHAT, RECENT_OVERALL, RECENT_MAX_BYTES)
+metrics.callback(
+    "bot_recent_cache_requests_total", "/show_data first pages by cache result.",
+    lambda: {("hit",): recent.hits, ("miss",): recent.misses}, "counter", ("result",)
 )
+metrics.callback("bot_recent_cache_bytes", "Approximate size of the recent messages cache.", lambda: recent.bytes)
+
+# ---------------- Update Deduplication ----------------
+class UpdateTracker:
+    """
+    Drops updates that have already been handled before any handler sees them.
+    floor is the highest update_id up to which every update has been handled:
+    it only moves across consecutive handled IDs, and handled IDs above a gap
+    wait in _done until the gap fills or gap_timeout passes. The message writer
+    stores floor in meta under key, in the same transaction as the rows of
+    those updates. At startup the stored offset is confirmed to Telegram, so
+    polling resumes right after it, and anything redelivered anyway is
+    recognised by its update_id or, within the window, by its
+    (chat_id, message_id).
+    """
+    OFFSET_SQL = """
+        INSERT INTO meta (key, value) VALUES (?, ?)
+        ON CONFLICT (key) DO UPDATE SET value = excluded.value
+    """
+
+    def __init__(self, window: int, gap_timeout: float) -> None:
+        self.window = window
+        self.gap_timeout = gap_timeout
+        self.key = "update_offset"
+        # Confirm the stored offset at startup (polling mode only).
+        self.acknowledge = False
+        self.floor = 0
+        self.saved = 0
+        # Without a stored offset, the first update seen; IDs below it are new too.
+        self._anchor = None
+        self._running = set()
+        # Handled IDs above floor, with the time they finished, and a heap of them.
+        self._done = {}
+        self._done_ids = []
+        self._messages = OrderedDict()
+        # Counters
+        self.duplicates = 0
+
+    @staticmethod
+    def worker_key(index: int, workers: int) -> str:
+        # Updates are routed by chat, so each worker's offset depends on the number of workers.
+        return f"update_offset_{index}_of_{workers}"
+
+    @staticmethod
+    def _offsets(conn: sqlite3.Connection, keys: list) -> list:
+        placeholders = ", ".join("?" * len(keys))
+        return [row[0] for row in conn.execute(f"SELECT value FROM meta WHERE key IN ({placeholders})", keys)]
+
+    async def load(self) -> None:
+        """
+        Start from the offset stored in the database, forgetting updates seen
+        by an earlier application in this process.
+        """
+        offsets = await db.read(self._offsets, [self.key])
+        self.floor = self.saved = offsets[0] if offsets else 0
+        self._anchor = None
+        self._running.clear()
+        self._done.clear()
+        self._done_ids.clear()
+        self._messages.clear()
+
+    async def acknowledge_offset(self, bot, keys: list) -> None:
+        """
+        Confirm every update up to the lowest offset stored under keys, so
+        Telegram does not send them again. Skipped until all keys exist.
+        """
+        offsets = await db.read(self._offsets, keys)
+        if len(offsets) < len(keys):
+            return
+        offset = min(offsets)
+        try:
+            await bot.get_updates(offset=offset + 1, limit=1, timeout=0)
+        except TelegramError as e:
+            logging.warning(f"Could not confirm handled updates to Telegram: {e}")
+            return
+        logging.info(f"Resuming after update {offset}.")
+
+    def begin(self, update: Update) -> bool:
+        """
+        Register an update about to be handled; False if it was handled before.
+        """
+        update_id = update.update_id
+        if not self.floor:
+            self._anchor = update_id
+            self.floor = update_id - 1
+        elif update_id <= self.floor and (self._anchor is None or update_id >= self._anchor):
+            if self.floor - update_id < self.window:
+                self.duplicates += 1
+                return False
+            # Telegram starts from a random ID after a week without updates.
+            logging.warning(f"Update IDs restarted at {update_id} (offset was {self.floor}).")
+            self._anchor = update_id
+            self.floor = update_id - 1
+            self.saved = 0
+            self._done.clear()
+            self._done_ids.clear()
+        if update_id in self._running or update_id in self._done:
+            self.duplicates += 1
+            return False
+        message = update.message or update.channel_post
+        if message is not None:
+            key = (message.chat_id, message.message_id)
+            if key in self._messages:
+                self.duplicates += 1
+                return False
+            self._messages[key] = None
+            if len(self._messages) > self.window:
+                self._messages.popitem(last=False)
+        self._running.add(update_id)
+        return True
+
+    def end(self, update: Update) -> None:
+        """
+        Mark an update as handled and move floor up across consecutive handled
+        updates. A gap is skipped once the update above it has waited
+        gap_timeout seconds and no update below it is still running.
+        """
+        update_id = update.update_id
+        self._running.discard(update_id)
+        if update_id <= self.floor:
+            # Below the first update seen without a stored offset.
+            return
+        now = time.monotonic()
+        self._done[update_id] = now
+        heapq.heappush(self._done_ids, update_id)
+        while self._done_ids:
+            lowest = self._done_ids[0]
+            if lowest != self.floor + 1 and (
+                    now - self._done[lowest] < self.gap_timeout
+                    or any(running < lowest for running in self._running)):
+                break
+            heapq.heappop(self._done_ids)
+            del self._done[lowest]
+            self.floor = lowest
+
+    def pending_offset(self):
+        """
+        (key, floor) when floor has moved since it was last stored, else None.
+        """
+        return (self.key, self.floor) if self.floor > self.saved else None
+
+update_tracker = UpdateTracker(UPDATE_DEDUP_WINDOW, UPDATE_GAP_TIMEOUT)
+metrics.callback("bot_duplicate_updates_total", "Updates dropped because they were already handled.",
+                 lambda: update_tracker.duplicates, "counter")
+
+async def skip_handled_update(update: Update, context: CallbackContext) -> None:
+    if not update_tracker.begin(update):
+        raise ApplicationHandlerStop
+
+async def finish_update(update: Update, context: CallbackContext) -> None:
+    update_tracker.end(update)
+
+# ---------------- Batched Message Writer ----------------
+class MessageWriter(SharedInstance):
+    """
+    In-process write queue for incoming messages.
+    Rows are buffered and flushed with executemany in a single transaction when
+    the batch size or the flush interval is reached. Failed batches are retried
+    up to max_retries times before being dropped.
+    The latest profile of every sender, media links and file metadata, and
+    edited versions are written in the same transaction, and so is the update
+    offset: a batch holds the rows of every update below it. Accepted rows are
+    also put in the recent cache, which gets their ids once they are written.
+    """
+    INSERT_SQL = """
+        INSERT OR IGNORE INTO messages (user_id, username, chat_id, message_id, message, date)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """
+    USER_SQL = """
+        INSERT INTO users (user_id, username, first_name, last_name, updated)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (user_id) DO UPDATE SET
+            username = excluded.username,
+            first_name = excluded.first_name,
+            last_name = excluded.last_name,
+            updated = excluded.updated
+        WHERE excluded.updated >= COALESCE(users.updated, 0)
+    """
+    LINK_SQL = """
+        INSERT OR IGNORE INTO message_media (chat_id, message_id, kind, file_unique_id)
+        VALUES (?, ?, ?, ?)
+    """
+    MEDIA_SQL = """
+        INSERT INTO media (file_unique_id, file_id, kind, mime_type, file_name, file_size,
+                           width, height, duration, first_seen, last_seen, seen_count)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (file_unique_id) DO UPDATE SET
+            file_id = excluded.file_id,
+            last_seen = MAX(last_seen, excluded.last_seen),
+            seen_count = seen_count + excluded.seen_count
+    """
+    VERSION_SQL = """
+        INSERT OR IGNORE INTO message_versions (chat_id, message_id, edit_date, user_id, message)
+        VALUES (?, ?, ?, ?, ?)
+    """
+
+    def __init__(self, db: Database, batch_size: int, flush_interval: float,
+                 max_pending: int, max_retries: int, recent: RecentMessages = None,
+                 updates: UpdateTracker = None) -> None:
+        self.db = db
+        self.recent = recent if recent is not None and recent.enabled else None
+        self.updates = updates
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.max_retries = max_retries
+        self._rows = []
+        self._users = {}
+        self._links = []
+        self._media = {}
+        self._versions = []
+        self._failures = 0
+        self._wakeup = asyncio.Event()
+        self._task = None
+        # Counters
+        self.written = 0
+        self.flushes = 0
+        self.retried = 0
+        self.dropped = 0
+
+    @property
+    def pending(self) -> int:
+        return len(self._rows) + len(self._versions)
+
+    def add(self, row: tuple, user_row: tuple = None, link: tuple = None, media_row: tuple = None) -> None:
+        """
+        Queue a message row for the next flush. The row is dropped if the queue is full.
+        user_row is (user_id, username, first_name, last_name, date); only the
+        latest one per user is kept until the next flush. link is the
+        (chat_id, message_id, kind, file_unique_id) row of a non-text message
+        and media_row the metadata of its file (see media_row()); repeated
+        sightings of a file before the flush are merged into one row.
+        """
+        if self.pending >= self.max_pending:
+            self.dropped += 1
+            logging.warning("Write queue is full; dropping message.")
+            return
+        self._rows.append(row)
+        if self.recent is not None:
+            self.recent.add(row)
+        if user_row is not None:
+            self._users[user_row[0]] = user_row
+        if link is not None:
+            self._links.append(link)
+        if media_row is not None:
+            queued = self._media.get(media_row[0])
+            if queued is not None:
+                media_row = media_row[:9] + (queued[9], media_row[10], queued[11] + 1)
+            self._media[media_row[0]] = media_row
+        if len(self._rows) >= self.batch_size:
+            self._wakeup.set()
+
+    def add_version(self, row: tuple) -> None:
+        """
+        Queue an edited version, (chat_id, message_id, edit_date, user_id, message).
+        """
+        if self.pending >= self.max_pending:
+            self.dropped += 1
+            logging.warning("Write queue is full; dropping edited message.")
+            return
+        self._versions.append(row)
+
+    def _write_batch(self, conn: sqlite3.Connection, batch: list, users: list,
+                     links: list = (), media: list = (), versions: list = (), with_ids: bool = False,
+                     offset: tuple = None):
+        """
+        Write one batch. With with_ids, returns the (id, chat_id, message_id)
+        of the inserted messages: the writer thread is the only one inserting,
+        so they are the last rowcount ids.
+        """
+        started = time.perf_counter()
+        ids = None
+        with conn:
+            cursor = conn.executemany(self.INSERT_SQL, batch)
+            if with_ids and cursor.rowcount > 0:
+                last_id = conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+                ids = conn.execute(
+                    "SELECT id, chat_id, message_id FROM messages WHERE id > ?", (last_id - cursor.rowcount,)
+                ).fetchall()
+            conn.executemany(self.USER_SQL, users)
+            conn.executemany(self.LINK_SQL, links)
+            conn.executemany(self.MEDIA_SQL, media)
+            conn.executemany(self.VERSION_SQL, versions)
+            if offset is not None:
+                conn.execute(UpdateTracker.OFFSET_SQL, offset)
+        DB_COMMIT_SECONDS.observe(time.perf_counter() - started)
+        return ids
+
+    async def flush(self) -> int:
+        """
+        Write all pending rows in one transaction on the DB writer thread.
+        Returns the number of message rows written.
+        """
+        offset = self.updates.pending_offset() if self.updates is not None else None
+        if not self._rows and not self._versions and offset is None:
+            return 0
+        batch, self._rows = self._rows, []
+        users, self._users = self._users, {}
+        links, self._links = self._links, []
+        media, self._media = self._media, {}
+        versions, self._versions = self._versions, []
+        try:
+            ids = await self.db.write(self._write_batch, batch, list(users.values()), links,
+                                      list(media.values()), versions, self.recent is not None, offset)
+        except sqlite3.Error as e:
+            self._failures += 1
+            if self._failures > self.max_retries:
+                logging.error(f"Dropping {len(batch)} messages after {self.max_retries} failed retries: {e}")
+                self.dropped += len(batch) + len(versions)
+                self._failures = 0
+                if self.recent is not None:
+                    self.recent.settle(batch, None)
+            else:
+                logging.error(f"Database error while writing {len(batch)} messages, will retry: {e}")
+                self.retried += len(batch)
+                # Put the batch back in front, keeping the queue bounded.
+                keep = max(self.max_pending - self.pending - len(versions), 0)
+                self.dropped += max(len(batch) - keep, 0)
+                self._rows = batch[:keep] + self._rows
+                self._links = links + self._links
+                self._versions = versions + self._versions
+                for user_id, user_row in users.items():
+                    self._users.setdefault(user_id, user_row)
+                for file_unique_id, media_row in media.items():
+                    self._media.setdefault(file_unique_id, media_row)
+            return 0
+        if offset is not None:
+            self.updates.saved = offset[1]
+        if self.recent is not None:
+            self.recent.settle(batch, ids)
+        self._failures = 0
+        self.written += len(batch)
+        self.flushes += 1
+        return len(batch)
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            with profiler.sample("writer.flush"):
+                await self.flush()
+
+    def start(self) -> None:
+        if self._task is None:
+            # An event that waited on an earlier event loop cannot be reused.
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """
+        Stop the background flusher and write any rows that are still pending.
+        """
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for _ in range(self.max_retries + 1):
+            await self.flush()
+            if not self.pending:
+                break
+        logging.info(
+            f"Message writer stopped: written={self.written}, flushes={self.flushes}, "
+            f"retried={self.retried}, dropped={self.dropped}"
+        )
+
+writer = MessageWriter(db, WRITE_BATCH_SIZE, WRITE_FLUSH_INTERVAL, WRITE_MAX_PENDING, WRITE_MAX_RETRIES,
+                       recent, update_tracker)
+metrics.callback("bot_messages_written_total", "Messages written to the database.", lambda: writer.written, "counter")
+metrics.callback("bot_messages_dropped_total", "Messages dropped by the write queue.", lambda: writer.dropped, "counter")
+metrics.callback("bot_write_queue_pending", "Messages waiting in the write queue.", lambda: writer.pending)
+metrics.callback("bot_db_file_bytes", "Size of the database files.", db.file_sizes, labels=("file",))
+
+# ---------------- Media Store ----------------
+# Message attributes that carry a file, in the order they are checked (an
+# animation also sets document).
+MEDIA_ATTRIBUTES = ("photo", "animation", "video", "video_note", "audio", "voice", "document", "sticker")
+
+def describe_message(message) -> tuple:
+    """
+    Return (kind, text, media) for a message: kind is None for plain text
+    messages; text is the text or caption, or a short description for polls,
+    locations, contacts and the like; media is the file (the largest size of
+    a photo), if any.
+    """
+    text = message.text if message.text is not None else message.caption
+    for kind in MEDIA_ATTRIBUTES:
+        media = getattr(message, kind)
+        if media:
+            return kind, text, media[-1] if kind == "photo" else media
+    if message.poll:
+        return "poll", message.poll.question, None
+    if message.venue:
+        return "venue", f"{message.venue.title}, {message.venue.address}", None
+    if message.location:
+        return "location", f"{message.location.latitude}, {message.location.longitude}", None
+    if message.contact:
+        contact = message.contact
+        return "contact", " ".join(filter(None, (contact.first_name, contact.last_name, contact.phone_number))), None
+    if message.dice:
+        return "dice", f"{message.dice.emoji} {message.dice.value}", None
+    if message.text is not None:
+        return None, text, None
+    # Joins, leaves, pins, title changes and other service messages.
+    return "service", text, None
+
+def media_row(kind: str, media, date: int) -> tuple:
+    """
+    Row for the media table (see MessageWriter.MEDIA_SQL) describing one sighting of a file.
+    """
+    return (
+        media.file_unique_id, media.file_id, kind,
+        getattr(media, "mime_type", None), getattr(media, "file_name", None), media.file_size,
+        getattr(media, "width", None), getattr(media, "height", None), getattr(media, "duration", None),
+        date, date, 1,
+    )
+
+class MediaStore(SharedInstance):
+    """
+    Optional content-addressed copy of received files under
+    directory/<first two characters>/<file_unique_id>. Telegram gives the same
+    file the same file_unique_id however often it is forwarded, so each file
+    is downloaded and stored once. Downloads run on `workers` tasks fed by a
+    bounded queue; when it is full new files are skipped instead of holding up
+    ingestion. After every download the least recently seen files are deleted
+    until the store fits in quota bytes. The media table is the index, so
+    several processes can share one store.
+    """
+
+    def __init__(self, db: Database, directory: str, workers: int, queue_size: int,
+                 quota: int, max_file_size: int) -> None:
+        self.db = db
+        self.directory = directory
+        self.workers = workers
+        self.quota = quota
+        self.max_file_size = max_file_size
+        self._queue = asyncio.Queue(maxsize=queue_size)
+        self._queued = set()
+        self._tasks = []
+        # Counters
+        self.downloaded = 0
+        self.skipped = 0
+        self.failed = 0
+        self.evicted = 0
+        self.stored_bytes = 0
+
+    def path_for(self, file_unique_id: str) -> str:
+        return os.path.join(self.directory, file_unique_id[:2], file_unique_id)
+
+    def submit(self, bot, kind: str, media) -> None:
+        """
+        Queue a file for download unless it is too big, already queued, or the queue is full.
+        """
+        if not self._tasks or media.file_unique_id in self._queued:
+            return
+        if (media.file_size or 0) > min(self.max_file_size, self.quota):
+            self.skipped += 1
+            return
+        try:
+            self._queue.put_nowait((bot, kind, media.file_unique_id, media.file_id))
+        except asyncio.QueueFull:
+            self.skipped += 1
+            return
+        self._queued.add(media.file_unique_id)
+
+    @staticmethod
+    def _stored_path(conn: sqlite3.Connection, file_unique_id: str):
+        row = conn.execute("SELECT path FROM media WHERE file_unique_id = ?", (file_unique_id,)).fetchone()
+        return row[0] if row and row[0] and os.path.exists(row[0]) else None
+
+    def _record(self, conn: sqlite3.Connection, file_unique_id: str, file_id: str, kind: str,
+                path: str, size: int) -> tuple:
+        """
+        Mark the file as stored and evict the least recently seen files beyond
+        the quota. Returns (evicted_paths, stored_bytes); the caller deletes the files.
+        The download can finish before the message writer has flushed the
+        file's metadata, so the row is created if needed.
+        """
+        now = int(time.time())
+        with conn:
+            conn.execute("""
+                INSERT INTO media (file_unique_id, file_id, kind, first_seen, last_seen, path, stored_size)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (file_unique_id) DO UPDATE SET path = excluded.path, stored_size = excluded.stored_size
+            """, (file_unique_id, file_id, kind, now, now, path, size))
+            total = conn.execute("SELECT COALESCE(SUM(stored_size), 0) FROM media WHERE path IS NOT NULL").fetchone()[0]
+            evicted = []
+            if total > self.quota:
+                for evicted_id, evicted_path, evicted_size in conn.execute(
+                    "SELECT file_unique_id, path, stored_size FROM media WHERE path IS NOT NULL ORDER BY last_seen"
+                ).fetchall():
+                    if total <= self.quota:
+                        break
+                    evicted.append((evicted_id, evicted_path))
+                    total -= evicted_size or 0
+                conn.executemany("UPDATE media SET path = NULL, stored_size = NULL WHERE file_unique_id = ?",
+                                 [(evicted_id,) for evicted_id, _ in evicted])
+        return [evicted_path for _, evicted_path in evicted], total
+
+    async def _download(self, bot, kind: str, file_unique_id: str, file_id: str) -> None:
+        if await self.db.read(self._stored_path, file_unique_id):
+            return
+        path = self.path_for(file_unique_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        partial = f"{path}.{os.getpid()}.part"
+        try:
+            telegram_file = await bot.get_file(file_id)
+            await telegram_file.download_to_drive(partial)
+            os.replace(partial, path)
+        finally:
+            if os.path.exists(partial):
+                os.remove(partial)
+        evicted, self.stored_bytes = await self.db.write(
+            self._record, file_unique_id, file_id, kind, path, os.path.getsize(path)
+        )
+        self.downloaded += 1
+        for evicted_path in evicted:
+            self.evicted += 1
+            if os.path.exists(evicted_path):
+                os.remove(evicted_path)
+
+    async def _run(self) -> None:
+        while True:
+            bot, kind, file_unique_id, file_id = await self._queue.get()
+            try:
+                await self._download(bot, kind, file_unique_id, file_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.failed += 1
+                logging.error(f"Error downloading media {file_unique_id}: {e}")
+            finally:
+                self._queued.discard(file_unique_id)
+
+    def start(self) -> None:
+        if not self._tasks:
+            # A queue that was used on an earlier event loop cannot be reused.
+            self._queue = asyncio.Queue(maxsize=self._queue.maxsize)
+            self._queued.clear()
+            self._tasks = [asyncio.create_task(self._run()) for _ in range(max(self.workers, 1))]
+
+    async def stop(self) -> None:
+        """
+        Stop the download workers; files still queued are not downloaded.
+        """
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+media_store = MediaStore(db, MEDIA_DIR, MEDIA_DOWNLOAD_WORKERS, MEDIA_QUEUE_SIZE, MEDIA_QUOTA_BYTES, MEDIA_MAX_FILE_SIZE)
+metrics.callback(
+    "bot_media_downloads_total", "Media downloads by outcome.",
+    lambda: {("downloaded",): media_store.downloaded, ("skipped",): media_store.skipped,
+             ("failed",): media_store.failed, ("evicted",): media_store.evicted},
+    "counter", ("outcome",)
+)
+metrics.callback("bot_media_store_bytes", "Bytes in the media store after the last download.",
+                 lambda: media_store.stored_bytes)
+
+# ---------------- Full-Text Search Index ----------------
+class FtsBackfill:
+    """
+    Adds messages stored before the search index existed to messages_fts,
+    FTS_BACKFILL_BATCH rows per writer transaction, until fts_backfill_pos
+    reaches fts_backfill_end.
+    """
+
+    def __init__(self, db: Database, batch_size: int, interval: float) -> None:
+        self.db = db
+        self.batch_size = batch_size
+        self.interval = interval
+        self._task = None
+        # Unknown until the progress has been read at startup.
+        self.pos = 0
+        self.end = None
+
+    @staticmethod
+    def _progress(conn: sqlite3.Connection) -> tuple:
+        rows = dict(conn.execute(
+            "SELECT key, value FROM meta WHERE key IN ('fts_backfill_pos', 'fts_backfill_end')"
+        ).fetchall())
+        return rows.get("fts_backfill_pos", 0), rows.get("fts_backfill_end", 0)
+
+    def _index_batch(self, conn: sqlite3.Connection) -> tuple:
+        pos, end = self._progress(conn)
+        if pos >= end:
+            return pos, end
+        upto = min(pos + self.batch_size, end)
+        with conn:
+            conn.execute("""
+                INSERT INTO messages_fts (rowid, message)
+                SELECT id, message FROM messages WHERE id > ? AND id <= ?
+            """, (pos, upto))
+            conn.execute("UPDATE meta SET value = ? WHERE key = 'fts_backfill_pos'", (upto,))
+        return upto, end
+
+    @property
+    def done(self) -> bool:
+        return self.end is not None and self.pos >= self.end
+
+    async def _run(self) -> None:
+        self.pos, self.end = await self.db.read(self._progress)
+        if self.done:
+            return
+        logging.info(f"Indexing {self.end - self.pos} existing messages for search.")
+        while not self.done:
+            try:
+                self.pos, self.end = await self.db.write(self._index_batch)
+            except sqlite3.Error as e:
+                logging.error(f"Error while indexing messages for search: {e}")
+            await asyncio.sleep(self.interval)
+        logging.info("Search index backfill completed.")
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+fts_backfill = FtsBackfill(db, FTS_BACKFILL_BATCH, FTS_BACKFILL_INTERVAL)
+
+# ---------------- Username Resolver ----------------
+ResolvedUser = namedtuple("ResolvedUser", "id username first_name last_name")
+
+class UserResolver:
+    """
+    Resolves @usernames to users without a Telegram round-trip where possible:
+    an in-memory LRU cache with a TTL first, then the local users table, and
+    only then bot.get_chat. Unknown usernames are cached too (for a shorter TTL).
+    """
+
+    def __init__(self, db: Database, max_size: int, ttl: float, negative_ttl: float) -> None:
+        self.db = db
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._cache = OrderedDict()
+        # Counters
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.db_hits = 0
+        self.api_calls = 0
+
+    @staticmethod
+    def _key(username: str) -> str:
+        return username.lstrip("@").lower()
+
+    def clear(self) -> None:
+        self._cache.clear()
+
+    def _store(self, key: str, user) -> None:
+        ttl = self.ttl if user is not None else self.negative_ttl
+        self._cache[key] = (time.monotonic() + ttl, user)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+
+    def observe(self, user_id: int, username: str, first_name: str, last_name: str) -> None:
+        """
+        Refresh a cached entry from an incoming message, so renames and users who
+        were cached as unknown are picked up without waiting for the TTL.
+        """
+        if username and self._key(username) in self._cache:
+            self._store(self._key(username), ResolvedUser(user_id, username, first_name, last_name))
+
+    @staticmethod
+    def _lookup(conn: sqlite3.Connection, username: str):
+        return conn.execute("""
+            SELECT user_id, username, first_name, last_name FROM users
+            WHERE username = ? COLLATE NOCASE
+            ORDER BY updated DESC
+            LIMIT 1
+        """, (username,)).fetchone()
+
+    async def resolve(self, bot, username: str):
+        """
+        Return a ResolvedUser for @username, or None if Telegram does not know it.
+        Errors other than "chat not found" are raised and not cached.
+        """
+        key = self._key(username)
+        entry = self._cache.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            self._cache.move_to_end(key)
+            self.cache_hits += 1
+            return entry[1]
+        self.cache_misses += 1
+
+        row = await self.db.read(self._lookup, key)
+        if row is not None:
+            self.db_hits += 1
+            user = ResolvedUser(*row)
+            self._store(key, user)
+            return user
+
+        self.api_calls += 1
+        try:
+            chat = await bot.get_chat(f"@{key}")
+        except BadRequest as e:
+            if "chat not found" in str(e).lower():
+                self._store(key, None)
+                return None
+            raise
+        user = ResolvedUser(chat.id, chat.username, chat.first_name, chat.last_name)
+        self._store(key, user)
+        return user
+
+    def summary(self) -> str:
+        return (
+            f"cache_hits={self.cache_hits}, cache_misses={self.cache_misses}, "
+            f"db_hits={self.db_hits}, api_calls={self.api_calls}, cached={len(self._cache)}"
+        )
+
+resolver = UserResolver(db, RESOLVER_CACHE_SIZE, RESOLVER_TTL, RESOLVER_NEGATIVE_TTL)
+
+async def open_database() -> None:
+    """
+    Bring the schema up to date and the file catalog in line with its directory
+    (unless another process owns the database), and load the admin list and the
+    stored update offset. Runs at startup, so importing bot.py never touches the
+    database file.
+    """
+    started = time.perf_counter()
+    # An earlier application in this process may have used another database.
+    recent.clear()
+    resolver.clear()
+    if db.remote is None:
+        await db.write(init_db, admins.initial)
+        await file_catalog.sync()
+    await admins.reload()
+    await update_tracker.load()
+    startup.record("database", time.perf_counter() - started)
+
+async def on_startup(application: Application) -> None:
+    """
+    Open the database and start background services once the application is initialized.
+    """
+    await open_database()
+    if update_tracker.acknowledge and db.remote is None:
+        await update_tracker.acknowledge_offset(application.bot, [update_tracker.key])
+    metrics.callback("bot_update_queue_size", "Updates received but not yet processed.", application.update_queue.qsize)
+    writer.start()
+    admins.start()
+    if MEDIA_DOWNLOAD:
+        media_store.start()
+    if db.remote is None:
+        # Worker processes leave these to the writer process.
+        fts_backfill.start()
+        retention.schedule(application)
+    await metrics_server.start()
+    startup.mark("ready")
+    logging.info(f"Startup: {startup.summary()}")
+
+async def on_shutdown(application: Application) -> None:
+    """
+    Flush pending data before the process exits.
+    """
+    await metrics_server.stop()
+    if profiler.samples:
+        try:
+            await dump_profile()
+        except Exception as e:
+            logging.error(f"Error writing the profile: {e}")
+    await admins.stop()
+    await media_store.stop()
+    await fts_backfill.stop()
+    await writer.stop()
+    db.close()
+    archive_store.close()
+    charts.close()
+    logging.info(f"Username resolver: {resolver.summary()}")
+    logging.info(f"Outbound: {rate_limiter.summary()}, merged_replies={reply_queue.merged}")
+
+# ---------------- Outbound Rate Limiting ----------------
+class TokenBucket:
+    """
+    Token bucket that hands out reservations: reserve() takes a token now and
+    returns how long the caller has to wait before using it. A rate of 0 or
+    less means no limit; only pause() holds such a bucket back.
+    """
+    __slots__ = ("rate", "capacity", "tokens", "updated", "paused_until")
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def reserve(self) -> float:
+        now = time.monotonic()
+        if self.rate <= 0:
+            return max(0.0, self.paused_until - now)
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return max(0.0, -self.tokens / self.rate)
+
+    def pause(self, seconds: float) -> None:
+        """
+        Hold back the bucket for the given time (after a RetryAfter from Telegram).
+        """
+        if self.rate <= 0:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            return
+        self.tokens = min(self.tokens, 0.0) - seconds * self.rate
+
+class OutboundRateLimiter(BaseRateLimiter):
+    """
+    Rate limiter for every request the bot makes.
+    Sending requests wait for a token from their chat's bucket (private chats
+    and groups have different rates) and then from the global bucket. Requests
+    that hit RetryAfter wait the requested time and are retried. Tracks the
+    number of queued requests and the send latency.
+    """
+    # Requests not tied to a chat's flood limit only use the global bucket.
+    UNTHROTTLED = {"answerCallbackQuery", "getMe", "getUpdates", "getFile", "getChat", "setWebhook", "deleteWebhook"}
+    MAX_CHAT_BUCKETS = 10000
+
+    def __init__(self, global_rate: float, chat_rate: float, group_rate: float, max_retries: int) -> None:
+        self.global_bucket = TokenBucket(global_rate, max(global_rate, 1.0))
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self._chat_buckets = OrderedDict()
+        self._latencies = deque(maxlen=1000)
+        # Metrics
+        self.queued = 0
+        self.sent = 0
+        self.failed = 0
+        self.retry_after = 0
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            # Group, supergroup and channel IDs are negative; "@name" targets are channels.
+            is_group = not isinstance(chat_id, int) or chat_id < 0
+            rate = self.group_rate if is_group else self.chat_rate
+            bucket = self._chat_buckets[chat_id] = TokenBucket(rate, max(rate, 1.0))
+            while len(self._chat_buckets) > self.MAX_CHAT_BUCKETS:
+                self._chat_buckets.popitem(last=False)
+        else:
+            self._chat_buckets.move_to_end(chat_id)
+        return bucket
+
+    async def acquire(self, chat_id=None) -> None:
+        """
+        Wait for a send slot in chat_id (if given) and then in the global bucket.
+        """
+        self.queued += 1
+        try:
+            if chat_id is not None:
+                delay = self._chat_bucket(chat_id).reserve()
+                if delay:
+                    await asyncio.sleep(delay)
+            delay = self.global_bucket.reserve()
+            if delay:
+                await asyncio.sleep(delay)
+        finally:
+            self.queued -= 1
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get("chat_id")
+        throttle_chat = endpoint not in self.UNTHROTTLED and chat_id is not None
+        with profiler.span(f"api {endpoint}", "api"):
+            return await self._send(callback, args, kwargs, endpoint, chat_id, throttle_chat, rate_limit_args)
+
+    async def _send(self, callback, args, kwargs, endpoint, chat_id, throttle_chat, rate_limit_args):
+        started = time.monotonic()
+        # Callers that already reserved a slot pass rate_limit_args={"acquired": True}.
+        if not (rate_limit_args or {}).get("acquired"):
+            with profiler.span("rate limit wait", "wait"):
+                await self.acquire(chat_id if throttle_chat else None)
+        for attempt in range(self.max_retries + 1):
+            try:
+                result = await callback(*args, **kwargs)
+            except RetryAfter as e:
+                self.retry_after += 1
+                if attempt == self.max_retries:
+                    self.failed += 1
+                    raise
+                logging.warning(f"Flood limit hit on {endpoint}; retrying in {e.retry_after}s.")
+                if throttle_chat:
+                    self._chat_bucket(chat_id).pause(e.retry_after)
+                with profiler.span("rate limit wait", "wait"):
+                    await asyncio.sleep(e.retry_after)
+                    await self.acquire(chat_id if throttle_chat else None)
+            except Exception:
+                self.failed += 1
+                raise
+            else:
+                self.sent += 1
+                self._latencies.append(time.monotonic() - started)
+                return result
+
+    def latency_percentiles(self) -> tuple:
+        """
+        (p50, p99) send latency in seconds over the last 1000 requests, including queueing time.
+        """
+        if not self._latencies:
+            return 0.0, 0.0
+        ordered = sorted(self._latencies)
+        return ordered[len(ordered) // 2], ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))]
+
+    def summary(self) -> str:
+        p50, p99 = self.latency_percentiles()
+        return (
+            f"queued={self.queued}, sent={self.sent}, failed={self.failed}, "
+            f"retry_after={self.retry_after}, latency_p50={p50:.3f}s, latency_p99={p99:.3f}s"
+        )
+
+class ReplyQueue:
+    """
+    Sends reply-mode replies in background tasks so handle_message never waits
+    on Telegram. With merging enabled, a chat has at most one reply waiting for
+    its turn; newer messages just retarget it, so a burst gets one reply to its
+    newest message instead of one reply per message.
+    """
+
+    def __init__(self, limiter: OutboundRateLimiter, merge: bool) -> None:
+        self.limiter = limiter
+        self.merge = merge
+        self._pending = {}
+        self.merged = 0
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+    def submit(self, application: Application, chat_id: int, message_id: int, text: str) -> None:
+        if not self.merge:
+            application.create_task(self._send(application.bot, chat_id, message_id, text))
+            return
+        pending = self._pending.get(chat_id)
+        if pending is not None:
+            pending[0], pending[1] = message_id, text
+            self.merged += 1
+            return
+        self._pending[chat_id] = [message_id, text]
+        application.create_task(self._deliver_merged(application.bot, chat_id))
+
+    async def _deliver_merged(self, bot, chat_id: int) -> None:
+        try:
+            await self.limiter.acquire(chat_id)
+        finally:
+            message_id, text = self._pending.pop(chat_id)
+        await self._send(bot, chat_id, message_id, text, {"acquired": True})
+
+    async def _send(self, bot, chat_id: int, message_id: int, text: str, rate_limit_args: dict = None) -> None:
+        try:
+            await bot.send_message(
+                chat_id=chat_id, text=text, reply_to_message_id=message_id,
+                rate_limit_args=rate_limit_args
+            )
+        except Exception as e:
+            logging.error(f"Error sending reply: {e}")
+
+rate_limiter = OutboundRateLimiter(OUTBOUND_GLOBAL_RATE, OUTBOUND_CHAT_RATE, OUTBOUND_GROUP_RATE, OUTBOUND_MAX_RETRIES)
+reply_queue = ReplyQueue(rate_limiter, REPLY_MERGE)
+metrics.callback(
+    "bot_outbound_requests_total", "Outbound Bot API requests by outcome.",
+    lambda: {("sent",): rate_limiter.sent, ("failed",): rate_limiter.failed, ("retry_after",): rate_limiter.retry_after},
+    "counter", ("outcome",)
+)
+metrics.callback("bot_reply_queue_pending", "Reply-mode replies waiting to be sent.", lambda: reply_queue.pending)
+
+# ---------------- Offline Bot API Backend ----------------
+class OfflineRequest(BaseRequest):
+    """
+    Request backend that answers Bot API calls locally instead of contacting
+    Telegram, for running the bot against recorded updates. getMe returns a stub
+    bot user, send/edit methods return a stub message, and every call is
+    counted per endpoint. Files registered with add_file() can be fetched with
+    getFile and downloaded from the local disk.
+    """
+
+    def __init__(self, token: str) -> None:
+        # The bot ID is the numeric part of the token before the colon.
+        prefix = token.split(":", 1)[0]
+        self.bot_id = int(prefix) if prefix.isdigit() else 1
+        self.calls = {}
+        self.files = {}
+        self._message_id = 0
+
+    def add_file(self, path: str) -> str:
+        """
+        Register a local file and return the file_id that getFile resolves to it.
+        """
+        file_id = f"offline-{len(self.files) + 1}"
+        self.files[file_id] = os.path.abspath(path)
+        return file_id
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def _result(self, endpoint: str, params: dict):
+        if endpoint == "getMe":
+            return {"id": self.bot_id, "is_bot": True, "first_name": "RoboJame", "username": "robojame_bot"}
+        if endpoint == "getUpdates":
+            return []
+        if endpoint == "getChat":
+            return {"id": self.bot_id, "type": "private", "first_name": "Offline"}
+        if endpoint == "getFile":
+            file_id = params.get("file_id", "")
+            return {"file_id": file_id, "file_unique_id": file_id or "offline",
+                    "file_path": self.files.get(file_id, "offline")}
+        if endpoint.startswith(("send", "edit", "forward", "copy")):
+            self._message_id += 1
+            chat_id = params.get("chat_id", 0)
+            result = {
+                "message_id": self._message_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id if isinstance(chat_id, int) else 0, "type": "private"},
+                "text": params.get("text", ""),
+            }
+            if endpoint == "sendDocument":
+                # A file_id is echoed back; an upload gets a new one.
+                document = params.get("document")
+                file_id = document if isinstance(document, str) else f"offline-document-{self._message_id}"
+                result["document"] = {"file_id": file_id, "file_unique_id": file_id}
+            return result
+        return True
+
+    async def do_request(self, url: str, method: str, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None) -> tuple:
+        endpoint = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data else {}
+        self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+        logging.debug(f"Offline Bot API call: {endpoint} {params}")
+        return 200, json.dumps({"ok": True, "result": self._result(endpoint, params)}).encode()
+
+# ---------------- Create Bot Application ----------------
+def build_application(token: str, request: BaseRequest = None,
+                      concurrent_updates: int = CONCURRENT_UPDATES) -> Application:
+    """
+    Build the Application with the shared rate limiter and lifecycle hooks.
+    request optionally replaces the HTTP backend (see OfflineRequest).
+    """
+    builder = (
+        Application.builder()
+        .token(token)
+        .rate_limiter(rate_limiter)
+        .concurrent_updates(concurrent_updates)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+    )
+    if request is not None:
+        builder = builder.request(request).get_updates_request(request)
+    return builder.build()
+
+# ---------------- Admin Registry ----------------
+class AdminRegistry(SharedInstance):
+    """
+    Admin IDs stored in the admins table and served from an immutable in-memory
+    snapshot, so a permission check is a single frozenset lookup.
+    Every change bumps meta.admins_version (by trigger); the registry polls that
+    counter and reloads, so changes made by other processes sharing the database
+    show up within ADMINS_POLL_INTERVAL seconds.
+    """
+
+    def __init__(self, db: Database, main_admin: int, initial: frozenset, poll_interval: float) -> None:
+        self.db = db
+        self.main_admin = main_admin
+        # Seeded into the admins table when the database is created.
+        self.initial = frozenset(initial)
+        self.poll_interval = poll_interval
+        self._ids = frozenset({main_admin})
+        self._version = None
+        self._task = None
+
+    def __contains__(self, user_id) -> bool:
+        return user_id in self._ids
+
+    def __iter__(self):
+        return iter(sorted(self._ids))
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    @staticmethod
+    def _version_of(conn: sqlite3.Connection) -> int:
+        row = conn.execute("SELECT value FROM meta WHERE key = 'admins_version'").fetchone()
+        return row[0] if row else 0
+
+    def _load(self, conn: sqlite3.Connection) -> tuple:
+        # Read the version first: a change racing with this read is picked up by the next poll.
+        version = self._version_of(conn)
+        ids = {row[0] for row in conn.execute("SELECT user_id FROM admins")}
+        return frozenset(ids | {self.main_admin}), version
+
+    def _swap(self, snapshot: tuple) -> None:
+        self._ids, self._version = snapshot
+
+    async def reload(self) -> None:
+        self._swap(await self.db.read(self._load))
+
+    def _add(self, conn: sqlite3.Connection, user_id: int, added_by: int) -> tuple:
+        with conn:
+            added = conn.execute(
+                "INSERT OR IGNORE INTO admins (user_id, added_by, added) VALUES (?, ?, ?)",
+                (user_id, added_by, int(time.time()))
+            ).rowcount
+        return added, self._load(conn)
+
+    def _remove(self, conn: sqlite3.Connection, user_id: int) -> tuple:
+        with conn:
+            removed = conn.execute("DELETE FROM admins WHERE user_id = ?", (user_id,)).rowcount
+        return removed, self._load(conn)
+
+    async def add(self, user_id: int, added_by: int) -> bool:
+        """
+        Register an admin. Returns False if the user already was one.
+        """
+        added, snapshot = await self.db.write(self._add, user_id, added_by)
+        self._swap(snapshot)
+        return bool(added)
+
+    async def remove(self, user_id: int) -> bool:
+        """
+        Remove an admin. Returns False if the user was not one.
+        """
+        removed, snapshot = await self.db.write(self._remove, user_id)
+        self._swap(snapshot)
+        return bool(removed)
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                version = await self.db.read(self._version_of)
+                if version != self._version:
+                    await self.reload()
+                    logging.info("Admin list reloaded after a change in another process.")
+            except sqlite3.Error as e:
+                logging.error(f"Error polling the admin list: {e}")
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+admins = AdminRegistry(db, MAIN_ADMIN_ID, DEFAULT_ADMINS, ADMINS_POLL_INTERVAL)
+
+def admin_only(denied_text: str = "❌ You do not have permission."):
+    """
+    Decorator for handlers that only admins may use. Other users get denied_text
+    (as a reply, or as an alert for inline button presses).
+    """
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(update: Update, context: CallbackContext) -> None:
+            user = update.effective_user
+            if user is not None and user.id in admins:
+                return await handler(update, context)
+            if update.callback_query:
+                await update.callback_query.answer(denied_text, show_alert=True)
+            elif update.message:
+                await update.message.reply_text(denied_text)
+        return wrapper
+    return decorator
+
+# ---------------- File Catalog ----------------
+BACKUP_FILE_RE = re.compile(r"^backup_[\w-]+\.(db(\.(gz|zst)(\.part\d{3})?)?|manifest\.json)$")
+ARCHIVE_FILE_RE = re.compile(r"^archive_(\d{4})_(\d{2})\.db(\.gz|\.zst)?$")
+CHART_FILE_RE = re.compile(r"^chart_[\w-]+\.png$")
+PROFILE_FILE_RE = re.compile(r"^profile_[\w-]+\.folded$")
+FILE_PREFIX_RE = re.compile(r"^[\w.-]*$")
+# Sent from the working directory and never cataloged, since they change all the time.
+WORKING_FILES = ("bot_data.db", "esp32_data_logger.log")
+
+def is_allowed_file(filename: str) -> bool:
+    """
+    Returns True if the file is allowed to be sent via Telegram.
+    Allowed files: 
+      - Exactly "bot_data.db", "esp32_data_logger.log", "chart.png"
+      - Cached charts: "chart_*.png"
+      - Backups: "backup_*.db", compressed "backup_*.db.gz" / "backup_*.db.zst",
+        their numbered parts ("*.part001", ...) and "backup_*.manifest.json"
+      - Monthly message archives: "archive_YYYY_MM.db", optionally ".gz" / ".zst" compressed
+      - Exports: files starting with "data_log_" and ending with ".xlsx", ".csv.gz" or ".parquet"
+      - Profiles: "profile_*.folded"
+    """
+    allowed_exact = {"bot_data.db", "esp32_data_logger.log", "chart.png"}
+    if filename in allowed_exact:
+        return True
+    if BACKUP_FILE_RE.match(filename) or ARCHIVE_FILE_RE.match(filename) or CHART_FILE_RE.match(filename):
+        return True
+    if PROFILE_FILE_RE.match(filename):
+        return True
+    if filename.startswith("data_log_") and filename.endswith((".xlsx", ".csv.gz", ".parquet")):
+        return True
+    return False
+
+CatalogEntry = namedtuple("CatalogEntry", ["name", "size", "mtime", "sha256", "file_id"])
+
+class FileCatalog(SharedInstance):
+    """
+    The files table: one row per allowed file in directory, so /list_files is
+    an indexed query instead of a directory scan. Files are added when they
+    are written and checked against their size and mtime when sent; a changed
+    file is hashed again. The file_id of an upload is kept while the content
+    (SHA-256) stays the same, so sending a file again uploads nothing.
+    """
+    UPSERT_SQL = """
+        INSERT INTO files (name, size, mtime, sha256, added) VALUES (?, ?, ?, ?, strftime('%s', 'now'))
+        ON CONFLICT (name) DO UPDATE SET
+            size = excluded.size,
+            mtime = excluded.mtime,
+            file_id = CASE WHEN files.sha256 = excluded.sha256 THEN files.file_id END,
+            sha256 = excluded.sha256
+    """
+
+    def __init__(self, db: Database, directory: str) -> None:
+        self.db = db
+        self.directory = directory
+        # Counters
+        self.uploads = 0
+        self.reused = 0
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def _entry(self, name: str) -> tuple:
+        """
+        (name, size, mtime, sha256) of a file in directory. Runs in a worker thread.
+        """
+        path = self.path(name)
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            stat = os.fstat(f.fileno())
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+        return name, stat.st_size, stat.st_mtime_ns, digest.hexdigest()
+
+    def _upsert(self, conn: sqlite3.Connection, entries: list, removed: list = ()) -> None:
+        with conn:
+            conn.executemany(self.UPSERT_SQL, entries)
+            conn.executemany("DELETE FROM files WHERE name = ?", [(name,) for name in removed])
+
+    def _remember(self, conn: sqlite3.Connection, name: str, sha256: str, file_id: str) -> None:
+        with conn:
+            conn.execute("UPDATE files SET file_id = ? WHERE name = ? AND sha256 = ?", (file_id, name, sha256))
+
+    @staticmethod
+    def _get(conn: sqlite3.Connection, name: str):
+        row = conn.execute("SELECT name, size, mtime, sha256, file_id FROM files WHERE name = ?", (name,)).fetchone()
+        return CatalogEntry(*row) if row else None
+
+    @staticmethod
+    def _stats(conn: sqlite3.Connection) -> dict:
+        return {name: (size, mtime) for name, size, mtime in conn.execute("SELECT name, size, mtime FROM files")}
+
+    @staticmethod
+    def page(conn: sqlite3.Connection, prefix: str, page: int, limit: int = FILES_PAGE_SIZE) -> tuple:
+        """
+        One page of (name, size) rows in name order, optionally only names
+        starting with prefix. Returns (rows, has_more).
+        """
+        condition, params = "", []
+        if prefix:
+            # A range on the primary key; prefix only contains FILE_PREFIX_RE characters.
+            condition = "WHERE name >= ? AND name < ?"
+            params = [prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)]
+        rows = conn.execute(
+            f"SELECT name, size FROM files {condition} ORDER BY name LIMIT ? OFFSET ?",
+            params + [limit + 1, page * limit]
+        ).fetchall()
+        return rows[:limit], len(rows) > limit
+
+    async def add(self, names: list) -> None:
+        """
+        Catalog newly written (or rewritten) files in directory.
+        """
+        entries = await asyncio.to_thread(lambda: [self._entry(name) for name in names])
+        await self.db.write(self._upsert, entries)
+
+    async def discard(self, names: list) -> None:
+        await self.db.write(self._upsert, [], names)
+
+    def _scan(self, known: dict) -> tuple:
+        """
+        Move allowed files left in the working directory into directory, then
+        compare directory with the catalog. Returns (entries, removed) for
+        _upsert. Runs in a worker thread.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        if os.path.abspath(self.directory) != os.path.abspath("."):
+            for name in os.listdir("."):
+                if name not in WORKING_FILES and is_allowed_file(name) and os.path.isfile(name):
+                    shutil.move(name, self.path(name))
+                    logging.info(f"Moved {name} into {self.directory}.")
+        entries, present = [], set()
+        with os.scandir(self.directory) as found:
+            for item in found:
+                if item.name in WORKING_FILES or not is_allowed_file(item.name) or not item.is_file():
+                    continue
+                present.add(item.name)
+                stat = item.stat()
+                if known.get(item.name) != (stat.st_size, stat.st_mtime_ns):
+                    entries.append(self._entry(item.name))
+        return entries, [name for name in known if name not in present]
+
+    async def sync(self) -> None:
+        """
+        Bring the catalog in line with directory; only new and changed files are hashed.
+        """
+        entries, removed = await asyncio.to_thread(self._scan, await self.db.read(self._stats))
+        if entries or removed:
+            await self.db.write(self._upsert, entries, removed)
+            logging.info(f"File catalog: {len(entries)} files added or changed, {len(removed)} removed.")
+
+    async def lookup(self, name: str):
+        """
+        The entry for name, hashed again if the file changed since it was
+        cataloged; None (and the row removed) if the file is gone.
+        """
+        entry = await self.db.read(self._get, name)
+        try:
+            stat = os.stat(self.path(name))
+        except FileNotFoundError:
+            if entry is not None:
+                await self.discard([name])
+            return None
+        if entry is None or (entry.size, entry.mtime) != (stat.st_size, stat.st_mtime_ns):
+            await self.add([name])
+            entry = await self.db.read(self._get, name)
+        return entry
+
+    async def send(self, message, entry: CatalogEntry):
+        """
+        Reply to message with the file: by its cached file_id when there is one,
+        otherwise uploaded from disk, keeping the new file_id.
+        """
+        if entry.file_id:
+            try:
+                sent = await message.reply_document(document=entry.file_id)
+                self.reused += 1
+                return sent
+            except BadRequest as e:
+                logging.warning(f"Cached file_id of {entry.name} was rejected, uploading again: {e}")
+        with open(self.path(entry.name), "rb") as f:
+            sent = await message.reply_document(document=f, filename=entry.name, write_timeout=UPLOAD_TIMEOUT)
+        self.uploads += 1
+        await self.uploaded(entry, sent)
+        return sent
+
+    async def uploaded(self, entry: CatalogEntry, sent) -> None:
+        """
+        Keep the file_id of a message that carried entry's file.
+        """
+        if sent is not None and sent.document is not None:
+            await self.db.write(self._remember, entry.name, entry.sha256, sent.document.file_id)
+
+file_catalog = FileCatalog(db, ARTIFACT_DIR)
+metrics.callback(
+    "bot_file_sends_total", "/get_file sends by how the file reached Telegram.",
+    lambda: {("upload",): file_catalog.uploads, ("file_id",): file_catalog.reused}, "counter", ("source",)
+)
+
+# ---------------- Backup Helpers ----------------
+class PartWriter:
+    """
+    Writes a byte stream to numbered part files of at most part_size bytes,
+    keeping a SHA-256 checksum per part and for the whole stream. Parts are
+    named without the directory they are written to.
+    """
+
+    def __init__(self, base_name: str, part_size: int, directory: str = ".") -> None:
+        self.base_name = base_name
+        self.part_size = part_size
+        self.directory = directory
+        self.parts = []
+        self.total_size = 0
+        self._digest = hashlib.sha256()
+        self._file = None
+        self._part_digest = None
+        self._part_len = 0
+
+    def _open_part(self) -> None:
+        name = f"{self.base_name}.part{len(self.parts) + 1:03d}"
+        self._file = open(os.path.join(self.directory, name), "wb")
+        self._part_digest = hashlib.sha256()
+        self._part_len = 0
+        self.parts.append({"name": name})
+
+    def _close_part(self) -> None:
+        self._file.close()
+        self.parts[-1].update(size=self._part_len, sha256=self._part_digest.hexdigest())
+        self._file = None
+
+    def write(self, data: bytes) -> None:
+        self._digest.update(data)
+        self.total_size += len(data)
+        view = memoryview(data)
+        while view:
+            if self._file is None:
+                self._open_part()
+            chunk = view[:self.part_size - self._part_len]
+            self._file.write(chunk)
+            self._part_digest.update(chunk)
+            self._part_len += len(chunk)
+            view = view[len(chunk):]
+            if self._part_len >= self.part_size:
+                self._close_part()
+
+    def close(self) -> list:
+        """
+        Finish the last part. A stream that fits in one part is renamed to base_name.
+        Returns the paths of the written files.
+        """
+        if self._file is not None:
+            self._close_part()
+        if len(self.parts) == 1:
+            os.replace(os.path.join(self.directory, self.parts[0]["name"]), os.path.join(self.directory, self.base_name))
+            self.parts[0]["name"] = self.base_name
+        return [os.path.join(self.directory, part["name"]) for part in self.parts]
+
+    @property
+    def sha256(self) -> str:
+        return self._digest.hexdigest()
+
+def get_compressor(kind: str):
+    """
+    Return (compressor, extension) for a streaming compressor with compress() and flush().
+    Falls back to gzip when zstd is requested but the zstandard package is missing.
+    """
+    if kind == "zstd":
+        if zstandard is not None:
+            return zstandard.ZstdCompressor(level=3).compressobj(), "zst"
+        logging.warning("zstandard is not installed; falling back to gzip for backups.")
+    # wbits=31 produces a gzip container that gzip/zcat can read directly.
+    return zlib.compressobj(6, zlib.DEFLATED, 31), "gz"
+
+def create_backup(db_path: str, stem: str, directory: str = ".") -> dict:
+    """
+    Take a consistent online backup of the database and write it stream-compressed,
+    split into parts if it is larger than BACKUP_PART_SIZE.
+    Runs in a worker thread. The source connection holds one read transaction for
+    the whole copy, so the snapshot stays consistent while the writer keeps
+    committing (WAL), and pages are copied BACKUP_PAGES_PER_STEP at a time.
+    Returns a manifest dict; for multi-part backups it is also written to
+    "<stem>.manifest.json" and listed in "files". Files are written to
+    directory; "files" holds their paths, the rest of the manifest bare names.
+    """
+    tmp_path = os.path.join(directory, f"{stem}.db.tmp")
+    src = sqlite3.connect(db_path)
+    dst = sqlite3.connect(tmp_path)
+    try:
+        src.execute("BEGIN")
+        src.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+        src.backup(dst, pages=BACKUP_PAGES_PER_STEP, sleep=0.001)
+        src.rollback()
+        dst.execute("PRAGMA journal_mode = DELETE")
+    finally:
+        src.close()
+        dst.close()
+
+    compressor, ext = get_compressor(BACKUP_COMPRESSION)
+    out = PartWriter(f"{stem}.db.{ext}", BACKUP_PART_SIZE, directory)
+    try:
+        with open(tmp_path, "rb") as f:
+            raw_size = 0
+            while True:
+                chunk = f.read(1024 * 1024)
+                if not chunk:
+                    break
+                raw_size += len(chunk)
+                out.write(compressor.compress(chunk))
+        out.write(compressor.flush())
+        files = out.close()
+    except Exception:
+        for part in out.parts:
+            path = os.path.join(directory, part["name"])
+            if os.path.exists(path):
+                os.remove(path)
+        raise
+    finally:
+        os.remove(tmp_path)
+
+    manifest = {
+        "name": out.base_name,
+        "compression": "zstd" if ext == "zst" else "gzip",
+        "raw_size": raw_size,
+        "size": out.total_size,
+        "sha256": out.sha256,
+        "parts": out.parts,
+    }
+    if len(files) > 1:
+        manifest_name = os.path.join(directory, f"{stem}.manifest.json")
+        with open(manifest_name, "w") as f:
+            json.dump(manifest, f, indent=2)
+        files.append(manifest_name)
+    manifest["files"] = files
+    return manifest
+
+# ---------------- Restore Helpers ----------------
+BACKUP_PART_RE = re.compile(r"^(?P<name>.+\.db\.(gz|zst))\.part(?P<num>\d{3})$")
+
+def get_decompressor(name: str):
+    """
+    Return a streaming decompressor (with decompress()) for a backup file name,
+    or None if the file is an uncompressed database.
+    """
+    if name.endswith(".gz"):
+        return zlib.decompressobj(31)
+    if name.endswith(".zst"):
+        if zstandard is None:
+            raise RuntimeError("The zstandard package is required to restore .zst backups.")
+        return zstandard.ZstdDecompressor().decompressobj()
+    return None
+
+def assemble_backup(files: dict, dest: str) -> None:
+    """
+    Turn downloaded backup files into a plain database file at dest.
+    files maps original file names to local paths. Accepts a single .db, .db.gz
+    or .db.zst file, or the parts of a split backup together with its manifest,
+    whose checksums are verified. A compressed stream that ends early is
+    rejected. Everything is streamed in 1 MB chunks. Runs in a worker thread.
+    """
+    manifest_name = next((n for n in files if n.endswith(".manifest.json")), None)
+    if manifest_name:
+        with open(files[manifest_name]) as f:
+            manifest = json.load(f)
+        source_name = manifest["name"]
+        missing = [p["name"] for p in manifest["parts"] if p["name"] not in files]
+        if missing:
+            raise ValueError(f"Missing backup parts: {', '.join(missing)}")
+        sources = [(files[p["name"]], p["sha256"]) for p in manifest["parts"]]
+        expected_total = manifest["sha256"]
+    else:
+        source_name = next(iter(files))
+        sources = [(files[source_name], None)]
+        expected_total = None
+
+    decompressor = get_decompressor(source_name)
+    total_digest = hashlib.sha256()
+    with open(dest, "wb") as out:
+        for path, expected in sources:
+            part_digest = hashlib.sha256()
+            with open(path, "rb") as f:
+                while True:
+                    chunk = f.read(1024 * 1024)
+                    if not chunk:
+                        break
+                    part_digest.update(chunk)
+                    total_digest.update(chunk)
+                    out.write(decompressor.decompress(chunk) if decompressor else chunk)
+            if expected and part_digest.hexdigest() != expected:
+                raise ValueError(f"Checksum mismatch in {os.path.basename(path)}")
+    if decompressor and not decompressor.eof:
+        raise ValueError("The compressed backup is incomplete (truncated file or missing parts)")
+    if expected_total and total_digest.hexdigest() != expected_total:
+        raise ValueError("Checksum mismatch for the assembled backup")
+
+def backup_files_complete(files: dict) -> bool:
+    """
+    True once the downloaded files form a complete backup: a single database
+    file, or a manifest together with every part it lists.
+    """
+    manifest_name = next((n for n in files if n.endswith(".manifest.json")), None)
+    if manifest_name:
+        with open(files[manifest_name]) as f:
+            manifest = json.load(f)
+        return all(p["name"] in files for p in manifest["parts"])
+    return any(not BACKUP_PART_RE.match(n) for n in files)
+
+# Converts v1 text dates to epoch seconds while keeping integer dates as they are.
+DATE_TO_EPOCH_SQL = """
+    CASE WHEN typeof(date) = 'text'
+         THEN COALESCE(CAST(strftime('%s', date) AS INTEGER), date)
+         ELSE date END
+"""
+
+def attach_backup(conn: sqlite3.Connection, path: str, schema: str):
+    """
+    Attach a backup database as schema on the writer connection and number the
+    copies of every legacy key (rows without a message_id) in it, in id order,
+    in temp.<schema>_occurrence. Every restore uses its own schema name, so
+    restores started from several chats (or worker processes) can run at once.
+    Returns (select_columns, max_id), or None if it has no messages table.
+    """
+    conn.execute(f"ATTACH DATABASE ? AS {schema}", (path,))
+    try:
+        if not conn.execute(f"SELECT 1 FROM {schema}.sqlite_master WHERE type='table' AND name='messages'").fetchone():
+            detach_backup(conn, schema)
+            return None
+        columns = {row[1] for row in conn.execute(f"PRAGMA {schema}.table_info(messages)")}
+        message_id = "message_id" if "message_id" in columns else "NULL"
+        select_columns = f"user_id, username, chat_id, {message_id}, message, {DATE_TO_EPOCH_SQL}"
+        max_id = conn.execute(f"SELECT COALESCE(MAX(id), 0) FROM {schema}.messages").fetchone()[0]
+        with conn:
+            conn.execute(f"CREATE TEMP TABLE {schema}_occurrence (id INTEGER PRIMARY KEY, occurrence INTEGER)")
+            conn.execute(f"""
+                INSERT INTO temp.{schema}_occurrence (id, occurrence)
+                SELECT id, ROW_NUMBER() OVER (
+                    PARTITION BY chat_id, user_id, {DATE_TO_EPOCH_SQL}, message ORDER BY id
+                )
+                FROM {schema}.messages
+                WHERE {message_id} IS NULL
+            """)
+            conn.execute(f"""
+                CREATE TEMP TABLE {schema}_batch (
+                    user_id INTEGER, username TEXT, chat_id INTEGER, message_id INTEGER, message TEXT, date INTEGER,
+                    occurrence INTEGER, archived INTEGER NOT NULL DEFAULT 0
+                )
+            """)
+    except Exception:
+        # Not a database, or not one we can read: leave nothing attached.
+        detach_backup(conn, schema)
+        raise
+    return select_columns, max_id
+
+def _drop_archived_rows(conn: sqlite3.Connection, schema: str, batch: str) -> None:
+    """
+    Remove the staged restore rows whose (chat_id, message_id) the attached
+    archive already holds, and add the archive's copies of every staged
+    legacy key to the row's archived count.
+    """
+    with conn:
+        conn.execute(f"""
+            DELETE FROM temp.{batch} AS b
+            WHERE b.message_id IS NOT NULL AND EXISTS (
+                SELECT 1 FROM {schema}.messages a
+                WHERE a.chat_id = b.chat_id AND a.message_id = b.message_id)
+        """)
+        conn.execute(f"""
+            UPDATE temp.{batch} AS b
+            SET archived = archived + (
+                SELECT COUNT(*) FROM {schema}.messages a INDEXED BY idx_messages_legacy_key
+                WHERE a.message_id IS NULL AND a.chat_id IS b.chat_id AND a.user_id IS b.user_id
+                  AND a.date IS b.date AND a.message IS b.message)
+            WHERE b.message_id IS NULL
+        """)
+
+def merge_backup_batch(conn: sqlite3.Connection, schema: str, select_columns: str, after_id: int,
+                       batch_size: int, store: "ArchiveStore" = None) -> tuple:
+    """
+    Merge the next batch of rows (by id) from the backup attached as schema.
+    Duplicates are skipped by the unique (chat_id, message_id) key. A row
+    without a message_id is the n-th copy of its (chat_id, user_id, date,
+    message) key in the backup, and is only inserted while fewer than n
+    copies are stored: restoring a backup twice adds nothing, and repeated
+    messages within one second of a v1 backup are all kept. Rows that
+    retention already moved into an archive of store count as stored too:
+    the batch is staged in temp.<schema>_batch and checked against every archive
+    whose month overlaps its dates before it is inserted in one transaction.
+    Returns (last_id, rows_read, rows_inserted); last_id is None when done.
+    """
+    batch = f"{schema}_batch"
+    last_id, count = conn.execute(f"""
+        SELECT MAX(id), COUNT(*) FROM (
+            SELECT id FROM {schema}.messages WHERE id > ? ORDER BY id LIMIT ?
+        )
+    """, (after_id, batch_size)).fetchone()
+    if not count:
+        return None, 0, 0
+    with conn:
+        conn.execute(f"DELETE FROM temp.{batch}")
+        conn.execute(f"""
+            INSERT INTO temp.{batch} (user_id, username, chat_id, message_id, message, date, occurrence)
+            SELECT {select_columns}, o.occurrence
+            FROM {schema}.messages s LEFT JOIN temp.{schema}_occurrence o ON o.id = s.id
+            WHERE s.id > ? AND s.id <= ?
+            ORDER BY s.id
+        """, (after_id, last_id))
+    if store is not None:
+        oldest, newest = conn.execute(f"""
+            SELECT MIN(date), MAX(date) FROM temp.{batch} WHERE typeof(date) = 'integer'
+        """).fetchone()
+        if oldest is not None:
+            # ATTACH is not allowed inside a transaction, so each archive is checked on its own.
+            with store.lock:
+                for source in store.sources({"from": oldest, "to": newest + 1}):
+                    query_archive(conn, store, source, _drop_archived_rows, batch)
+    with conn:
+        cursor = conn.execute(f"""
+            INSERT OR IGNORE INTO main.messages (user_id, username, chat_id, message_id, message, date)
+            SELECT user_id, username, chat_id, message_id, message, date FROM temp.{batch} AS b
+            WHERE b.message_id IS NOT NULL OR b.occurrence > b.archived + (
+                -- The planner would otherwise walk every legacy row of the chat.
+                SELECT COUNT(*) FROM main.messages m INDEXED BY idx_messages_legacy_key
+                WHERE m.message_id IS NULL AND m.chat_id IS b.chat_id AND m.user_id IS b.user_id
+                  AND m.date IS b.date AND m.message IS b.message)
+            ORDER BY rowid
+        """)
+        conn.execute(f"DELETE FROM temp.{batch}")
+    return last_id, count, cursor.rowcount
+
+def detach_backup(conn: sqlite3.Connection, schema: str) -> None:
+    conn.execute(f"DROP TABLE IF EXISTS temp.{schema}_occurrence")
+    conn.execute(f"DROP TABLE IF EXISTS temp.{schema}_batch")
+    conn.execute(f"DETACH DATABASE {schema}")
+
+# ---------------- Message Archives ----------------
+ARCHIVE_COLUMNS = "id, user_id, username, chat_id, message_id, message, date"
+
+# An archive file as seen by queries: month is (year, month), path may be compressed.
+ArchiveSource = namedtuple("ArchiveSource", ["month", "path", "min_id", "max_id"])
+
+def month_of(epoch: int) -> tuple:
+    moment = datetime.fromtimestamp(epoch, timezone.utc)
+    return moment.year, moment.month
+
+def month_bounds(month: tuple) -> tuple:
+    """
+    (start, end) epoch seconds of a (year, month); end is exclusive.
+    """
+    year, number = month
+    start = datetime(year, number, 1, tzinfo=timezone.utc)
+    end = datetime(year + number // 12, number % 12 + 1, 1, tzinfo=timezone.utc)
+    return int(start.timestamp()), int(end.timestamp())
+
+def init_archive(conn: sqlite3.Connection) -> None:
+    """
+    Create the archive schema if needed: the messages table of the main
+    database (so /restore accepts archive files), keeping the original ids,
+    with the same unique keys and its own search index.
+    """
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER,
+            username TEXT,
+            chat_id INTEGER,
+            message_id INTEGER,
+            message TEXT,
+            date INTEGER
+        )
+    """)
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_chat_message ON messages (chat_id, message_id)")
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_messages_legacy_key
+        ON messages (chat_id, user_id, date, message)
+        WHERE message_id IS NULL
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_user_id ON messages (user_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_date ON messages (date)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_chat_id ON messages (chat_id)")
+    if fts5_available(conn):
+        conn.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+                message, content='messages', content_rowid='id'
+            )
+        """)
+        conn.execute("""
+            CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages
+            BEGIN
+                INSERT INTO messages_fts (rowid, message) VALUES (NEW.id, NEW.message);
+            END
+        """)
+
+class ArchiveStore(SharedInstance):
+    """
+    Monthly archive databases (archive_YYYY_MM.db) in a directory.
+    Closed months can be compressed to .db.gz / .db.zst; a query that needs one
+    gets a copy unpacked into a temporary cache. Used from the DB threads, so
+    file changes happen under lock.
+    """
+
+    def __init__(self, directory: str, compression: str) -> None:
+        self.directory = directory
+        self.compression = compression
+        self.lock = threading.RLock()
+        self._bounds = {}
+        self._cache = {}
+        self._cache_dir = None
+
+    def plain_path(self, month: tuple) -> str:
+        return os.path.join(self.directory, f"archive_{month[0]:04d}_{month[1]:02d}.db")
+
+    def files(self) -> dict:
+        """
+        {(year, month): path} of every archive, preferring the uncompressed file.
+        """
+        result = {}
+        for name in os.listdir(self.directory):
+            match = ARCHIVE_FILE_RE.match(name)
+            if not match:
+                continue
+            month = (int(match.group(1)), int(match.group(2)))
+            if month not in result or not match.group(3):
+                result[month] = os.path.join(self.directory, name)
+        return result
+
+    def writable_path(self, month: tuple) -> str:
+        """
+        Path of the uncompressed archive for month; a compressed archive is
+        unpacked first so rows can be added to it. Call with the lock held.
+        """
+        path = self.plain_path(month)
+        if not os.path.exists(path):
+            for extension in (".gz", ".zst"):
+                packed = path + extension
+                if os.path.exists(packed):
+                    assemble_backup({os.path.basename(packed): packed}, path + ".tmp")
+                    os.replace(path + ".tmp", path)
+                    os.remove(packed)
+                    break
+        return path
+
+    def readable_path(self, path: str) -> str:
+        """
+        Path of an uncompressed copy of the archive at path.
+        """
+        if path.endswith(".db"):
+            return path
+        with self.lock:
+            mtime = os.path.getmtime(path)
+            cached = self._cache.get(path)
+            if cached and cached[0] == mtime and os.path.exists(cached[1]):
+                return cached[1]
+            if self._cache_dir is None:
+                self._cache_dir = tempfile.mkdtemp(prefix="archive_cache_")
+            plain = os.path.join(self._cache_dir, os.path.basename(path).rsplit(".", 1)[0])
+            assemble_backup({os.path.basename(path): path}, plain)
+            self._cache[path] = (mtime, plain)
+            return plain
+
+    def seal(self, month: tuple) -> str:
+        """
+        Compress the archive of a closed month and remove the uncompressed file.
+        """
+        with self.lock:
+            path = self.plain_path(month)
+            compressor, extension = get_compressor(self.compression)
+            packed = f"{path}.{extension}"
+            with open(path, "rb") as src, open(packed + ".tmp", "wb") as dst:
+                while True:
+                    chunk = src.read(1024 * 1024)
+                    if not chunk:
+                        break
+                    dst.write(compressor.compress(chunk))
+                dst.write(compressor.flush())
+            os.replace(packed + ".tmp", packed)
+            os.remove(path)
+            return packed
+
+    def _id_bounds(self, path: str) -> tuple:
+        stat = os.stat(path)
+        key = (stat.st_mtime, stat.st_size)
+        cached = self._bounds.get(path)
+        if cached and cached[0] == key:
+            return cached[1]
+        conn = sqlite3.connect(self.readable_path(path))
+        try:
+            bounds = conn.execute("SELECT MIN(id), MAX(id) FROM messages").fetchone()
+        finally:
+            conn.close()
+        self._bounds[path] = (key, bounds)
+        return bounds
+
+    def sources(self, message_filters: dict) -> list:
+        """
+        Non-empty archives whose month overlaps the from/to filters, newest first.
+        """
+        result = []
+        with self.lock:
+            for month, path in sorted(self.files().items(), reverse=True):
+                start, end = month_bounds(month)
+                if message_filters.get("from") is not None and end <= message_filters["from"]:
+                    continue
+                if message_filters.get("to") is not None and start >= message_filters["to"]:
+                    continue
+                min_id, max_id = self._id_bounds(path)
+                if min_id is not None:
+                    result.append(ArchiveSource(month, path, min_id, max_id))
+        return result
+
+    def close(self) -> None:
+        """
+        Remove the cache of unpacked archives.
+        """
+        with self.lock:
+            if self._cache_dir is not None:
+                shutil.rmtree(self._cache_dir, ignore_errors=True)
+                self._cache_dir = None
+                self._cache.clear()
+
+def query_archive(conn: sqlite3.Connection, store: ArchiveStore, source: ArchiveSource, fn, *args):
+    """
+    ATTACH an archive as "archive" on conn, run fn(conn, "archive", *args) and
+    DETACH it again.
+    """
+    conn.execute("ATTACH DATABASE ? AS archive", (store.readable_path(source.path),))
+    try:
+        return fn(conn, "archive", *args)
+    finally:
+        conn.execute("DETACH DATABASE archive")
+
+def add_archive_stats(conn: sqlite3.Connection, path: str) -> None:
+    """
+    Add the messages of an archive to the statistics counters. Used after
+    rebuild_stats(), inside the same transaction, so the counters cover
+    archived messages too.
+    """
+    archive = sqlite3.connect(path)
+    try:
+        users = archive.execute("""
+            SELECT m.user_id,
+                   (SELECT username FROM messages WHERE user_id = m.user_id ORDER BY id DESC LIMIT 1),
+                   COUNT(*), MAX(m.date)
+            FROM messages m
+            WHERE m.user_id IS NOT NULL
+            GROUP BY m.user_id
+        """).fetchall()
+        chats = archive.execute("""
+            SELECT chat_id, COUNT(*), MAX(date) FROM messages
+            WHERE chat_id IS NOT NULL
+            GROUP BY chat_id
+        """).fetchall()
+        days = archive.execute("""
+            SELECT date / 86400, chat_id, COUNT(*) FROM messages
+            WHERE chat_id IS NOT NULL
+            GROUP BY date / 86400, chat_id
+        """).fetchall()
+        total = archive.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+    finally:
+        archive.close()
+    # Newer data was added first, so existing usernames are kept.
+    conn.executemany("""
+        INSERT INTO user_stats (user_id, username, msg_count, last_date) VALUES (?, ?, ?, ?)
+        ON CONFLICT (user_id) DO UPDATE SET
+            msg_count = msg_count + excluded.msg_count,
+            username = COALESCE(username, excluded.username),
+            last_date = MAX(COALESCE(last_date, 0), excluded.last_date)
+    """, users)
+    conn.executemany("""
+        INSERT INTO chat_stats (chat_id, msg_count, last_date) VALUES (?, ?, ?)
+        ON CONFLICT (chat_id) DO UPDATE SET
+            msg_count = msg_count + excluded.msg_count,
+            last_date = MAX(COALESCE(last_date, 0), excluded.last_date)
+    """, chats)
+    conn.executemany("""
+        INSERT INTO daily_stats (day, chat_id, msg_count) VALUES (?, ?, ?)
+        ON CONFLICT (day, chat_id) DO UPDATE SET msg_count = msg_count + excluded.msg_count
+    """, days)
+    conn.execute("UPDATE totals SET messages = messages + ? WHERE id = 1", (total,))
+
+def rebuild_all_stats(conn: sqlite3.Connection, store: ArchiveStore) -> None:
+    """
+    Recompute the statistics counters from the main database and every archive.
+    Runs on the DB writer thread, so no rows are archived meanwhile.
+    """
+    with store.lock, conn:
+        rebuild_stats(conn)
+        for month, path in sorted(store.files().items(), reverse=True):
+            add_archive_stats(conn, store.readable_path(path))
+
+class RetentionManager:
+    """
+    Moves messages older than the retention period into monthly archives in
+    batches, oldest month first. Each batch is committed to the archive before
+    the rows are deleted from the main database, so a crash in between only
+    leaves duplicates that the next run skips. Statistics counters are not
+    touched: they keep counting archived messages. Runs as a repeating job on
+    the Application's job queue, or with start() in the writer process, which
+    has no job queue.
+    """
+
+    def __init__(self, db: Database, store: ArchiveStore, days: int, batch_size: int,
+                 pause: float, compression: str) -> None:
+        self.db = db
+        self.store = store
+        self.days = days
+        self.batch_size = batch_size
+        self.pause = pause
+        self.compression = compression
+        self.archived = 0
+        self._running = False
+        self._task = None
+
+    def _archive_batch(self, conn: sqlite3.Connection, cutoff: int) -> int:
+        # v2 kept unparseable v1 dates as text; such rows are never archived.
+        oldest = conn.execute("SELECT MIN(date) FROM messages WHERE typeof(date) = 'integer'").fetchone()[0]
+        if oldest is None or oldest >= cutoff:
+            return 0
+        month = month_of(oldest)
+        start, end = month_bounds(month)
+        rows = conn.execute(f"""
+            SELECT {ARCHIVE_COLUMNS} FROM messages
+            WHERE date >= ? AND date < ?
+            ORDER BY date
+            LIMIT ?
+        """, (start, min(end, cutoff), self.batch_size)).fetchall()
+        with self.store.lock:
+            archive = sqlite3.connect(self.store.writable_path(month))
+            try:
+                init_archive(archive)
+                with archive:
+                    archive.executemany(
+                        f"INSERT OR IGNORE INTO messages ({ARCHIVE_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?)", rows
+                    )
+            finally:
+                archive.close()
+        with conn:
+            conn.executemany("DELETE FROM messages WHERE id = ?", [(row[0],) for row in rows])
+        return len(rows)
 
-# ---------------- Logging Configuration ----------------
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", 
-    level=logging.INFO
-)
+    def _seal_closed_months(self, cutoff: int) -> int:
+        sealed = 0
+        for month, path in self.store.files().items():
+            if path.endswith(".db") and month_bounds(month)[1] <= cutoff:
+                self.store.seal(month)
+                sealed += 1
+        return sealed
 
-# ---------------- Retrieve Bot Token ----------------
-TOKEN = os.getenv("TOKEN")
-if not TOKEN:
-    raise ValueError("TOKEN is not set. Please set the TOKEN environment variable with your bot token.")
+    async def run(self) -> int:
+        """
+        Archive everything older than the retention period. Returns the number of rows moved.
+        """
+        if self._running or self.days <= 0:
+            return 0
+        self._running = True
+        moved = 0
+        try:
+            cutoff = int(time.time()) - self.days * 86400
+            while True:
+                count = await self.db.write(self._archive_batch, cutoff)
+                if not count:
+                    break
+                moved += count
+                self.archived += count
+                # Give queued message writes a turn on the writer thread.
+                await asyncio.sleep(self.pause)
+            sealed = 0
+            if self.compression != "none":
+                sealed = await asyncio.to_thread(self._seal_closed_months, cutoff)
+            if moved or sealed:
+                logging.info(f"Retention: archived {moved} messages, compressed {sealed} archives.")
+                await file_catalog.sync()
+        except Exception as e:
+            logging.error(f"Error archiving old messages: {e}")
+        finally:
+            self._running = False
+        return moved
 
-DB_PATH = "bot_data.db"
+    async def _job(self, context: CallbackContext) -> None:
+        await self.run()
 
-# ---------------- Initialize Database ----------------
-def init_db(db_path: str) -> sqlite3.Connection:
+    def schedule(self, application: Application) -> None:
+        if self.days <= 0:
+            return
+        if application.job_queue is None:
+            logging.warning("Retention needs the job queue: pip install \"python-telegram-bot[job-queue]\".")
+            return
+        application.job_queue.run_repeating(self._job, interval=RETENTION_INTERVAL, first=60, name="retention")
+
+    async def _run(self) -> None:
+        await asyncio.sleep(60)
+        while True:
+            await self.run()
+            await asyncio.sleep(RETENTION_INTERVAL)
+
+    def start(self) -> None:
+        if self.days > 0 and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+archive_store = ArchiveStore(ARTIFACT_DIR, ARCHIVE_COMPRESSION)
+retention = RetentionManager(db, archive_store, RETENTION_DAYS, RETENTION_BATCH_SIZE,
+                             RETENTION_BATCH_PAUSE, ARCHIVE_COMPRESSION)
+metrics.callback("bot_archived_messages_total", "Messages moved into archives.", lambda: retention.archived, "counter")
+
+# ---------------- Export Helpers ----------------
+EXPORT_COLUMNS = ("id", "date", "chat_id", "user_id", "username", "message_id", "message")
+
+class CsvExportPart:
+    """
+    gzip-compressed CSV with a header row. The compressor is flushed after
+    every batch so size() is the real file size.
+    """
+    extension = "csv.gz"
+    max_rows = None
+
+    def __init__(self, path: str) -> None:
+        self._raw = open(path, "wb")
+        self._gzip = gzip.GzipFile(fileobj=self._raw, mode="wb")
+        self._text = io.TextIOWrapper(self._gzip, encoding="utf-8", newline="")
+        self._csv = csv.writer(self._text)
+        self._csv.writerow(EXPORT_COLUMNS)
+
+    def write(self, rows: list) -> None:
+        self._csv.writerows((row[0], format_date(row[1])) + row[2:] for row in rows)
+        self._text.flush()
+        self._gzip.flush()
+
+    def size(self) -> int:
+        return self._raw.tell()
+
+    def close(self) -> None:
+        self._text.close()
+        self._raw.close()
+
+class ParquetExportPart:
+    """
+    Parquet file (zstd-compressed columns), one row group per batch.
+    """
+    extension = "parquet"
+    max_rows = None
+
+    def __init__(self, path: str) -> None:
+        import pyarrow
+        import pyarrow.parquet
+        self._arrow = pyarrow
+        self.schema = pyarrow.schema([
+            ("id", pyarrow.int64()), ("date", pyarrow.timestamp("s", tz="UTC")),
+            ("chat_id", pyarrow.int64()), ("user_id", pyarrow.int64()), ("username", pyarrow.string()),
+            ("message_id", pyarrow.int64()), ("message", pyarrow.string()),
+        ])
+        self._file = open(path, "wb")
+        self._writer = pyarrow.parquet.ParquetWriter(self._file, self.schema, compression="zstd")
+
+    def write(self, rows: list) -> None:
+        columns = [list(column) for column in zip(*rows)]
+        # Legacy dates that could not be converted to epoch seconds are left empty.
+        columns[1] = [value if isinstance(value, int) else None for value in columns[1]]
+        self._writer.write_batch(self._arrow.RecordBatch.from_arrays(
+            [self._arrow.array(column, type=field.type) for column, field in zip(columns, self.schema)],
+            schema=self.schema
+        ))
+
+    def size(self) -> int:
+        return self._file.tell()
+
+    def close(self) -> None:
+        self._writer.close()
+        self._file.close()
+
+class XlsxExportPart:
+    """
+    XLSX workbook written with openpyxl's write-only mode, which streams rows
+    to a temporary file instead of keeping them in memory. The compressed
+    size is only known after saving, so size() is an estimate from the raw
+    row size.
+    """
+    extension = "xlsx"
+    # Excel's row limit, minus the header.
+    max_rows = 1048575
+
+    def __init__(self, path: str) -> None:
+        import openpyxl
+        from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+        self.path = path
+        self._illegal = ILLEGAL_CHARACTERS_RE
+        self._book = openpyxl.Workbook(write_only=True)
+        self._sheet = self._book.create_sheet("messages")
+        self._sheet.append(EXPORT_COLUMNS)
+        self._size = 0
+
+    def write(self, rows: list) -> None:
+        for row in rows:
+            date = datetime.fromtimestamp(row[1], timezone.utc).replace(tzinfo=None) if isinstance(row[1], int) else row[1]
+            message = self._illegal.sub("", row[6]) if isinstance(row[6], str) else row[6]
+            username = self._illegal.sub("", row[4]) if isinstance(row[4], str) else row[4]
+            self._sheet.append((row[0], date, row[2], row[3], username, row[5], message))
+            self._size += export_row_size(row)
+
+    def size(self) -> int:
+        return self._size
+
+    def close(self) -> None:
+        self._book.save(self.path)
+
+EXPORT_FORMATS = {"csv": CsvExportPart, "parquet": ParquetExportPart, "xlsx": XlsxExportPart}
+
+def export_row_size(row: tuple) -> int:
+    """
+    Upper estimate of the bytes a row adds to an export file.
+    """
+    return 32 + sum(len(value.encode("utf-8")) if isinstance(value, str) else 20 for value in row)
+
+class ExportWriter:
+    """
+    Writes export rows to numbered files named <stem>_001.<ext>, ... so that
+    none exceeds part_size bytes (estimated before each batch is written).
+    An export that fits in one file is renamed to <stem>.<ext>.
+    """
+
+    def __init__(self, stem: str, part_class, part_size: int) -> None:
+        self.stem = stem
+        self.part_class = part_class
+        self.part_size = part_size
+        self.files = []
+        self.rows = 0
+        self._part = None
+        self._part_rows = 0
+
+    def _roll(self) -> None:
+        if self._part is not None:
+            self._part.close()
+        name = f"{self.stem}_{len(self.files) + 1:03d}.{self.part_class.extension}"
+        self._part = self.part_class(name)
+        self._part_rows = 0
+        self.files.append(name)
+
+    def _flush(self, pending: list) -> None:
+        if pending:
+            self._part.write(pending)
+            self._part_rows += len(pending)
+            self.rows += len(pending)
+
+    def write(self, rows: list) -> None:
+        if self._part is None:
+            self._roll()
+        pending, pending_size = [], self._part.size()
+        max_rows = self.part_class.max_rows
+        for row in rows:
+            row_size = export_row_size(row)
+            part_rows = self._part_rows + len(pending)
+            if part_rows and (pending_size + row_size > self.part_size or (max_rows and part_rows >= max_rows)):
+                self._flush(pending)
+                self._roll()
+                pending, pending_size = [], self._part.size()
+            pending.append(row)
+            pending_size += row_size
+        self._flush(pending)
+
+    def close(self) -> list:
+        """
+        Finish the last file and return the names of all written files.
+        """
+        if self._part is not None:
+            self._part.close()
+            self._part = None
+        if len(self.files) == 1:
+            name = f"{self.stem}.{self.part_class.extension}"
+            os.replace(self.files[0], name)
+            self.files[0] = name
+        return self.files
+
+    def abort(self) -> None:
+        try:
+            if self._part is not None:
+                self._part.close()
+        finally:
+            self._part = None
+            for name in self.files:
+                if os.path.exists(name):
+                    os.remove(name)
+
+def export_messages(message_filters: dict, export_format: str, stem: str) -> tuple:
     """
-    Connect to the SQLite database and create the messages table if it does not exist.
+    Stream the matching messages, archives included, into export files in
+    EXPORT_FETCH_SIZE batches, so memory use does not depend on the number of
+    rows. Archived months come first, oldest first; rows are in id order within
+    each database. Uses its own connection and runs in a worker thread.
+    Returns (file_names, row_count); no file is kept when nothing matches.
     """
+    conditions, params = build_message_filters(message_filters)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    out = ExportWriter(stem, EXPORT_FORMATS[export_format], EXPORT_PART_SIZE)
+
+    def copy(conn: sqlite3.Connection, schema: str) -> None:
+        cursor = conn.execute(f"""
+            SELECT {', '.join(EXPORT_COLUMNS)} FROM {schema}.messages
+            {where}
+            ORDER BY id
+        """, params)
+        while True:
+            rows = cursor.fetchmany(EXPORT_FETCH_SIZE)
+            if not rows:
+                break
+            out.write(rows)
+
+    conn = db.connect()
     try:
-        conn = sqlite3.connect(db_path, check_same_thread=False)
-        cursor = conn.cursor()
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                username TEXT,
-                chat_id INTEGER,
-                message TEXT,
-                date TEXT
-            )
-        """)
-        conn.commit()
-        logging.info("Database initialized successfully.")
-        return conn
-    except Exception as e:
-        logging.error(f"Error initializing database: {e}")
+        for source in reversed(archive_store.sources(message_filters)):
+            query_archive(conn, archive_store, source, copy)
+        copy(conn, "main")
+    except Exception:
+        out.abort()
         raise
+    finally:
+        conn.close()
+    if not out.rows:
+        out.abort()
+        return [], 0
+    return out.close(), out.rows
 
-conn = init_db(DB_PATH)
-cursor = conn.cursor()
+# ---------------- Charts ----------------
+# SQL expression (over daily_stats.day) for every chart bucket. Epoch day 0 was
+# a Thursday, so weeks are shifted by 3 days to start on Monday.
+CHART_BUCKETS = {
+    "day": "day",
+    "week": "(day + 3) / 7",
+    "month": "strftime('%Y-%m', day * 86400, 'unixepoch')",
+}
 
-# ---------------- Create Bot Application ----------------
-bot = Application.builder().token(TOKEN).build()
+def collect_chart_data(conn: sqlite3.Connection, chat_id: int, days: int, bucket: str) -> dict:
+    """
+    Aggregates for a chart, on a DB reader thread. Message volume comes from the
+    daily_stats counters in one grouped query; the top users of the range come
+    from one indexed query per database (main plus the archives in range).
+    "counter" is the message counter of the chat (or of all chats), used to
+    decide when a cached chart is stale.
+    """
+    today = int(time.time()) // 86400
+    first_day = today - days + 1
+    chat_condition = " AND chat_id = ?" if chat_id is not None else ""
+    chat_params = [chat_id] if chat_id is not None else []
+    expression = CHART_BUCKETS[bucket]
+    volume = dict(conn.execute(f"""
+        SELECT {expression} AS bucket, SUM(msg_count) FROM daily_stats
+        WHERE day >= ?{chat_condition}
+        GROUP BY bucket
+        ORDER BY bucket
+    """, [first_day] + chat_params).fetchall())
+    # Walk every day of the range so empty buckets show up as zero; the keys
+    # match the SQL expressions above.
+    keys, labels = [], []
+    for day in range(first_day, today + 1):
+        start = datetime.fromtimestamp(day * 86400, timezone.utc)
+        if bucket == "month":
+            key = label = start.strftime("%Y-%m")
+        elif bucket == "week":
+            key = (day + 3) // 7
+            label = (start - timedelta(days=start.weekday())).strftime("%Y-%m-%d")
+        else:
+            key, label = day, start.strftime("%Y-%m-%d")
+        if not keys or keys[-1] != key:
+            keys.append(key)
+            labels.append(label)
+    counts = [volume.get(key, 0) for key in keys]
 
-# ---------------- Admin Settings ----------------
-MAIN_ADMIN_ID = 381200758
-admins = {MAIN_ADMIN_ID, 1156819072}  # Add additional admin IDs here
+    message_filters = {"from": first_day * 86400}
+    if chat_id is not None:
+        message_filters["chat"] = chat_id
+    conditions, params = build_message_filters(message_filters)
 
-# ---------------- Helper Functions for File Management ----------------
-def is_allowed_file(filename: str) -> bool:
+    def count_users(conn: sqlite3.Connection, schema: str) -> list:
+        return conn.execute(f"""
+            SELECT user_id, COUNT(*) FROM {schema}.messages
+            WHERE {' AND '.join(conditions)} AND user_id IS NOT NULL
+            GROUP BY user_id
+        """, params).fetchall()
+
+    totals = {}
+    for user_id, count in count_users(conn, "main"):
+        totals[user_id] = totals.get(user_id, 0) + count
+    for source in archive_store.sources(message_filters):
+        for user_id, count in query_archive(conn, archive_store, source, count_users):
+            totals[user_id] = totals.get(user_id, 0) + count
+    top = sorted(totals.items(), key=lambda item: -item[1])[:10]
+    names = {}
+    if top:
+        placeholders = ", ".join("?" * len(top))
+        for user_id, username, first_name in conn.execute(
+            f"SELECT user_id, username, first_name FROM users WHERE user_id IN ({placeholders})",
+            [user_id for user_id, _ in top]
+        ):
+            names[user_id] = f"@{username}" if username else (first_name or str(user_id))
+
+    if chat_id is not None:
+        row = conn.execute("SELECT msg_count FROM chat_stats WHERE chat_id = ?", (chat_id,)).fetchone()
+    else:
+        row = conn.execute("SELECT messages FROM totals WHERE id = 1").fetchone()
+    return {
+        "today": today,
+        "counter": row[0] if row else 0,
+        "labels": labels,
+        "counts": counts,
+        "top_users": [(names.get(user_id, str(user_id)), count) for user_id, count in top],
+    }
+
+def _init_chart_worker() -> None:
+    # Pay matplotlib's import cost once per worker process, not per chart.
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot  # noqa: F401
+
+def render_chart(path: str, title: str, labels: list, counts: list, top_users: list) -> str:
     """
-    Returns True if the file is allowed to be sent via Telegram.
-    Allowed files: 
-      - Exactly "bot_data.db", "esp32_data_logger.log", "chart.png"
-      - Files starting with "backup_" and ending with ".db"
-      - Files starting with "data_log_" and ending with ".xlsx"
+    Render the message volume and top users into a PNG at path. Runs in a chart
+    worker process.
     """
-    allowed_exact = {"bot_data.db", "esp32_data_logger.log", "chart.png"}
-    if filename in allowed_exact:
-        return True
-    if filename.startswith("backup_") and filename.endswith(".db"):
-        return True
-    if filename.startswith("data_log_") and filename.endswith(".xlsx"):
-        return True
-    return False
+    import matplotlib.pyplot as plt
+    fig, (volume_ax, users_ax) = plt.subplots(2, 1, figsize=(10, 8), gridspec_kw={"height_ratios": [3, 2]})
+    volume_ax.bar(range(len(counts)), counts, color="#4C72B0")
+    step = max(1, len(labels) // 12)
+    volume_ax.set_xticks(range(0, len(labels), step))
+    volume_ax.set_xticklabels(labels[::step], rotation=45, ha="right", fontsize=8)
+    volume_ax.set_ylabel("Messages")
+    volume_ax.set_title(title)
+    if top_users:
+        names = [name for name, _ in reversed(top_users)]
+        users_ax.barh(names, [count for _, count in reversed(top_users)], color="#55A868")
+        users_ax.set_xlabel("Messages")
+        users_ax.set_title("Top users")
+    else:
+        users_ax.axis("off")
+    fig.tight_layout()
+    fig.savefig(path, dpi=100)
+    plt.close(fig)
+    return path
+
+class ChartRenderer:
+    """
+    Renders /chart images in a process pool, so matplotlib's import and drawing
+    never run on the event loop. Rendered files (chart_<chat>_<days>d_<bucket>.png)
+    are cached per (chat, range, bucket) and re-rendered once refresh_messages
+    new messages have arrived in that chat, or the day changes. The least
+    recently used charts beyond cache_size are deleted. Charts live in the
+    file catalog's directory and are cataloged as they are rendered.
+    The pool spawns its workers rather than forking a process that runs DB and
+    event loop threads; importing bot.py in them has no side effects.
+    """
+    Cached = namedtuple("Cached", ["path", "day", "counter"])
+
+    def __init__(self, workers: int, cache_size: int, refresh_messages: int) -> None:
+        self.workers = workers
+        self.cache_size = cache_size
+        self.refresh_messages = refresh_messages
+        self._cache = OrderedDict()
+        self._pool = None
+        self.hits = 0
+        self.renders = 0
+
+    @staticmethod
+    def available() -> bool:
+        return importlib.util.find_spec("matplotlib") is not None
+
+    def _executor(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_chart_worker
+            )
+        return self._pool
+
+    async def get(self, chat_id: int, days: int, bucket: str, title: str) -> str:
+        """
+        Return the path of an up-to-date chart, rendering it if needed.
+        """
+        data = await db.read(collect_chart_data, chat_id, days, bucket)
+        key = (chat_id, days, bucket)
+        cached = self._cache.get(key)
+        if (cached and cached.day == data["today"] and os.path.exists(cached.path)
+                and data["counter"] - cached.counter < self.refresh_messages):
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return cached.path
+        name = f"chart_{'all' if chat_id is None else chat_id}_{days}d_{bucket}.png"
+        path = file_catalog.path(name)
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(
+            self._executor(), render_chart, path, title, data["labels"], data["counts"], data["top_users"]
+        )
+        self.renders += 1
+        # chart.png always holds the latest chart for /get_file.
+        await asyncio.to_thread(shutil.copyfile, path, file_catalog.path("chart.png"))
+        self._cache[key] = self.Cached(path, data["today"], data["counter"])
+        self._cache.move_to_end(key)
+        evicted_paths = []
+        while len(self._cache) > self.cache_size:
+            evicted_paths.append(self._cache.popitem(last=False)[1].path)
+        if evicted_paths:
+            await asyncio.to_thread(self._remove, evicted_paths)
+        evicted_names = [os.path.basename(evicted) for evicted in evicted_paths]
+        await file_catalog.add([name, "chart.png"])
+        if evicted_names:
+            await file_catalog.discard(evicted_names)
+        return path
+
+    @staticmethod
+    def _remove(paths: list) -> None:
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def close(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+charts = ChartRenderer(CHART_WORKERS, CHART_CACHE_SIZE, CHART_REFRESH_MESSAGES)
+metrics.callback(
+    "bot_charts_total", "Chart requests by result.",
+    lambda: {("cached",): charts.hits, ("rendered",): charts.renders}, "counter", ("result",)
+)
+
+# ---------------- Message Browsing Helpers ----------------
+def parse_date_arg(value: str) -> int:
+    """
+    Parse "YYYY-MM-DD" or "YYYY-MM-DDTHH:MM" (UTC) into epoch seconds.
+    """
+    for fmt in ("%Y-%m-%d", "%Y-%m-%dT%H:%M"):
+        try:
+            return int(datetime.strptime(value, fmt).replace(tzinfo=timezone.utc).timestamp())
+        except ValueError:
+            pass
+    raise ValueError(f"Invalid date: {value}. Use YYYY-MM-DD or YYYY-MM-DDTHH:MM.")
+
+def parse_message_filters(args: list) -> dict:
+    """
+    Parse key=value filter arguments: user=<id>, chat=<id>, from=<date>, to=<date>.
+    The "to" date is exclusive. Raises ValueError on invalid input.
+    """
+    result = {}
+    for arg in args:
+        key, sep, value = arg.partition("=")
+        if not sep or not value:
+            raise ValueError(f"Invalid filter: {arg}. Use key=value.")
+        key = key.lower()
+        if key in ("user", "chat"):
+            try:
+                result[key] = int(value)
+            except ValueError:
+                raise ValueError(f"{key} must be a numeric ID.")
+        elif key in ("from", "to"):
+            result[key] = parse_date_arg(value)
+        else:
+            raise ValueError(f"Unknown filter: {key}")
+    return result
+
+def build_message_filters(message_filters: dict) -> tuple:
+    """
+    Build SQL conditions and parameters for parse_message_filters() output.
+    """
+    conditions, params = [], []
+    if "user" in message_filters:
+        conditions.append("user_id = ?")
+        params.append(message_filters["user"])
+    if "chat" in message_filters:
+        conditions.append("chat_id = ?")
+        params.append(message_filters["chat"])
+    if "from" in message_filters:
+        conditions.append("date >= ?")
+        params.append(message_filters["from"])
+    if "to" in message_filters:
+        conditions.append("date < ?")
+        params.append(message_filters["to"])
+    return conditions, params
+
+def _page_rows(conn: sqlite3.Connection, schema: str, conditions: list, params: list,
+               before: int, after: int, limit: int) -> list:
+    page_conditions = list(conditions)
+    page_params = list(params)
+    if after is not None:
+        page_conditions.append("id > ?")
+        page_params.append(after)
+        order = "ASC"
+    else:
+        if before is not None:
+            page_conditions.append("id < ?")
+            page_params.append(before)
+        order = "DESC"
+    where = f"WHERE {' AND '.join(page_conditions)}" if page_conditions else ""
+    return conn.execute(f"""
+        SELECT id, user_id, username, chat_id, message, date
+        FROM {schema}.messages
+        {where}
+        ORDER BY id {order}
+        LIMIT ?
+    """, page_params + [limit + 1]).fetchall()
+
+def _has_newer(conn: sqlite3.Connection, schema: str, conditions: list, params: list, newest_id: int) -> bool:
+    where = " AND ".join(conditions + ["id > ?"])
+    return conn.execute(
+        f"SELECT 1 FROM {schema}.messages WHERE {where} LIMIT 1", params + [newest_id]
+    ).fetchone() is not None
+
+def fetch_messages_page(conn: sqlite3.Connection, message_filters: dict, before: int = None,
+                        after: int = None, limit: int = SHOW_DATA_PAGE_SIZE) -> tuple:
+    """
+    Fetch one page of messages, newest first, using keyset pagination on id:
+    rows older than `before`, or the page directly newer than `after`.
+    Every page costs the same no matter how deep it is.
+    Archived rows keep their ids, so archives are merged in by id; only the
+    archives whose id range can still contribute to the page are attached.
+    Returns (rows, has_older, has_newer).
+    """
+    conditions, params = build_message_filters(message_filters)
+    newest_first = after is None
+    rows = _page_rows(conn, "main", conditions, params, before, after, limit)
+    sources = archive_store.sources(message_filters)
+    for source in sources:
+        if before is not None and source.min_id >= before:
+            continue
+        if after is not None and source.max_id <= after:
+            continue
+        if len(rows) > limit:
+            boundary = rows[limit][0]
+            if (source.max_id < boundary) if newest_first else (source.min_id > boundary):
+                continue
+        rows += query_archive(conn, archive_store, source, _page_rows, conditions, params, before, after, limit)
+        # A row can briefly exist in both places while it is being archived.
+        rows = sorted({row[0]: row for row in rows}.values(), key=lambda row: row[0], reverse=newest_first)
+    more = len(rows) > limit
+    rows = rows[:limit]
+    if after is not None:
+        rows.reverse()
+        has_newer, has_older = more, bool(rows)
+    else:
+        has_older = more
+        has_newer = False
+        if rows and before is not None:
+            newest_id = rows[0][0]
+            has_newer = _has_newer(conn, "main", conditions, params, newest_id) or any(
+                query_archive(conn, archive_store, source, _has_newer, conditions, params, newest_id)
+                for source in sources if source.max_id > newest_id
+            )
+    return rows, has_older, has_newer
+
+def truncate_html(text: str, max_len: int) -> str:
+    """
+    HTML-escape text, shortening it so the escaped result fits in max_len characters.
+    """
+    escaped = html.escape(text)
+    if len(escaped) <= max_len:
+        return escaped
+    # Binary search the longest prefix whose escaped form (plus "…") still fits.
+    low, high = 0, len(text)
+    while low < high:
+        mid = (low + high + 1) // 2
+        if len(html.escape(text[:mid])) < max_len:
+            low = mid
+        else:
+            high = mid - 1
+    return html.escape(text[:low]) + "…"
+
+def format_message_entry(row: tuple) -> str:
+    """
+    Format a (id, user_id, username, chat_id, message, date) row as escaped HTML.
+    """
+    return (
+        f"👤 <b>UserID:</b> {row[1]}\n"
+        f"🗣 <b>Username:</b> {html.escape(row[2]) if row[2] else 'Unknown'}\n"
+        f"💬 <b>Message:</b> {truncate_html(row[4] or '', MESSAGE_LIMIT // 2)}\n"
+        f"💡 <b>ChatID:</b> {row[3]}\n"
+        f"🕒 <b>Date:</b> {format_date(row[5])}\n"
+        "-----------------------------------\n"
+    )
+
+def split_html_chunks(header: str, entries: list, limit: int = MESSAGE_LIMIT) -> list:
+    """
+    Join pre-escaped HTML entries into as few messages as possible, each under limit characters.
+    Entries are never split, so tags always stay balanced.
+    """
+    chunks, parts, size = [], [header], len(header)
+    for entry in entries:
+        if parts and size + len(entry) > limit:
+            chunks.append("".join(parts))
+            parts, size = [], 0
+        parts.append(entry)
+        size += len(entry)
+    if parts:
+        chunks.append("".join(parts))
+    return chunks
 
-def list_allowed_files() -> list:
+def remember_page_query(context: CallbackContext, kind: str, query: dict) -> str:
     """
-    Lists all allowed files in the current directory.
+    Store the query behind a paginated result in user_data and return a short
+    token for callback data (which Telegram limits to 64 bytes).
     """
-    files = os.listdir(".")
-    return [f for f in files if os.path.isfile(f) and is_allowed_file(f)]
+    queries = context.user_data.setdefault("page_queries", {})
+    token = uuid.uuid4().hex[:8]
+    queries[token] = {"kind": kind, **query}
+    # Keep only the most recent queries.
+    while len(queries) > 20:
+        queries.pop(next(iter(queries)))
+    return token
+
+def page_keyboard(prefix: str, token: str, newer, older, labels: tuple = ("⬅️ Newer", "Older ➡️")):
+    """
+    Inline "newer/older" buttons. newer and older are cursors, or None to hide the button.
+    """
+    buttons = []
+    if newer is not None:
+        buttons.append(InlineKeyboardButton(labels[0], callback_data=f"{prefix}:{token}:n:{newer}"))
+    if older is not None:
+        buttons.append(InlineKeyboardButton(labels[1], callback_data=f"{prefix}:{token}:o:{older}"))
+    return InlineKeyboardMarkup([buttons]) if buttons else None
+
+async def send_chunks(context: CallbackContext, chat_id: int, chunks: list, reply_markup=None) -> None:
+    """
+    Send HTML chunks in order, attaching reply_markup to the last one.
+    """
+    for i, chunk in enumerate(chunks):
+        await context.bot.send_message(
+            chat_id=chat_id, text=chunk, parse_mode=ParseMode.HTML,
+            reply_markup=reply_markup if i == len(chunks) - 1 else None
+        )
+
+async def send_show_data_page(context: CallbackContext, chat_id: int, token: str,
+                              before: int = None, after: int = None) -> None:
+    """
+    Send one page of /show_data results to chat_id.
+    """
+    query = context.user_data["page_queries"][token]
+    page = recent.page(query["filters"], SHOW_DATA_PAGE_SIZE) if before is None and after is None else None
+    rows, has_older, has_newer = page or await db.read(fetch_messages_page, query["filters"], before, after)
+    if not rows:
+        await context.bot.send_message(chat_id=chat_id, text="📭 No messages have been recorded.")
+        return
+    header = f"📌 <b>Recorded Messages ({len(rows)}):</b>\n\n"
+    chunks = split_html_chunks(header, [format_message_entry(row) for row in rows])
+    keyboard = page_keyboard("sd", token, rows[0][0] if has_newer else None, rows[-1][0] if has_older else None)
+    await send_chunks(context, chat_id, chunks, keyboard)
+
+def build_fts_query(terms: list) -> str:
+    """
+    Turn user search terms into an FTS5 query: every term becomes a quoted
+    phrase (so punctuation cannot cause syntax errors) and all terms must match.
+    A trailing "*" keeps prefix matching.
+    """
+    parts = []
+    for term in terms:
+        prefix = term.endswith("*")
+        term = term.rstrip("*")
+        if term:
+            parts.append('"' + term.replace('"', '""') + '"' + ("*" if prefix else ""))
+    return " ".join(parts)
+
+def _search_rows(conn: sqlite3.Connection, schema: str, fts_query: str, conditions: list,
+                 params: list, limit: int) -> list:
+    if not conn.execute(f"SELECT 1 FROM {schema}.sqlite_master WHERE name = 'messages_fts'").fetchone():
+        return []
+    where = "".join(f" AND m.{condition}" for condition in conditions)
+    return conn.execute(f"""
+        SELECT m.id, m.user_id, m.username, m.chat_id, m.message, m.date, bm25(messages_fts)
+        FROM {schema}.messages_fts
+        JOIN {schema}.messages m ON m.id = messages_fts.rowid
+        WHERE messages_fts MATCH ?{where}
+        ORDER BY bm25(messages_fts)
+        LIMIT ?
+    """, [fts_query] + params + [limit]).fetchall()
+
+def search_messages(conn: sqlite3.Connection, fts_query: str, message_filters: dict,
+                    page: int, limit: int = SEARCH_PAGE_SIZE) -> tuple:
+    """
+    Run a ranked (bm25) full-text search. Returns (rows, has_more).
+    Ranked results have no stable key, so pages are addressed by number.
+    Archives in the filtered date range are searched too: each source returns
+    its best rows up to the end of the page. bm25 scores depend on the corpus
+    statistics of each index, so scores from different sources are not
+    comparable; the sources' results are interleaved by their rank instead
+    (every source's best row, then every source's second best, ...).
+    """
+    conditions, params = build_message_filters(message_filters)
+    wanted = (page + 1) * limit + 1
+    results = [_search_rows(conn, "main", fts_query, conditions, params, wanted)]
+    for source in archive_store.sources(message_filters):
+        results.append(query_archive(conn, archive_store, source, _search_rows, fts_query, conditions, params, wanted))
+    ranked, seen = [], set()
+    for position in range(max(len(rows) for rows in results)):
+        for rows in results:
+            if position < len(rows) and rows[position][0] not in seen:
+                seen.add(rows[position][0])
+                ranked.append(rows[position])
+    page_rows = [row[:6] for row in ranked[page * limit:(page + 1) * limit + 1]]
+    return page_rows[:limit], len(page_rows) > limit
+
+async def send_search_page(context: CallbackContext, chat_id: int, token: str, page: int) -> None:
+    """
+    Send one page of /search results to chat_id.
+    """
+    query = context.user_data["page_queries"][token]
+    rows, has_more = await db.read(search_messages, query["fts_query"], query["filters"], page)
+    if not rows:
+        await context.bot.send_message(chat_id=chat_id, text="🔍 No matching messages found.")
+        return
+    header = f"🔍 <b>Search results for</b> <code>{html.escape(query['text'])}</code> (page {page + 1}):\n\n"
+    if not fts_backfill.done:
+        header += "ℹ️ Older messages are still being indexed; results may be incomplete.\n\n"
+    chunks = split_html_chunks(header, [format_message_entry(row) for row in rows])
+    keyboard = page_keyboard(
+        "se", token, page - 1 if page > 0 else None,
+        page + 1 if has_more and page + 1 < SEARCH_MAX_PAGES else None,
+        labels=("⬅️ Previous", "Next ➡️")
+    )
+    await send_chunks(context, chat_id, chunks, keyboard)
 
 # ---------------- Command Handlers ----------------
 async def start(update: Update, context: CallbackContext) -> None:
@@ -96,7 +4160,7 @@ async def start(update: Update, context: CallbackContext) -> None:
             "سلام! 🤖 من ربات جامع هستم.\n"
             "✅ تمامی پیام‌ها ثبت می‌شوند.\n\n"
             "برای دریافت داده‌ها:\n"
-            "➖ /show_data - نمایش پیام‌های ثبت‌شده (فقط برای ادمین، 50 پیام اخیر).\n"
+            "➖ /show_data - نمایش صفحه‌به‌صفحه پیام‌های ثبت‌شده با فیلتر (فقط برای ادمین).\n"
             "➖ /stats - نمایش آمار کلی ربات.\n\n"
             "برای مدیریت ریپلای در این چت:\n"
             "➖ /reply - فعال کردن حالت ریپلای (تنها ادمین).\n"
@@ -108,7 +4172,7 @@ async def start(update: Update, context: CallbackContext) -> None:
             "🔧 امکانات جدید:\n"
             "➖ /backup - بکاپ‌گیری از دیتابیس و ارسال آن به تلگرام.\n"
             "➖ /restore - ریستور دیتابیس از فایل بکاپ ارسال‌شده.\n"
-            "➖ /list_files - نمایش فایل‌های ذخیره‌شده مجاز.\n"
+            "➖ /list_files [prefix] - نمایش فایل‌های ذخیره‌شده مجاز (صفحه‌به‌صفحه).\n"
             "➖ /get_file <filename> - ارسال فایل مورد نظر به عنوان داکیومنت.\n"
             "➖ /get_info <username یا شماره تلفن> - دریافت اطلاعات عمومی کاربر.\n\n"
             "برای مشاهده راهنمای کامل دستورات، از /help استفاده کنید."
@@ -126,7 +4190,7 @@ async def help_command(update: Update, context: CallbackContext) -> None:
         "📚 <b>راهنمای کامل ربات جامع</b>\n\n"
         "1. <b>/start</b>: معرفی ربات و نمایش ویژگی‌ها.\n"
         "2. <b>/help</b>: نمایش راهنمای کامل دستورات.\n"
-        "3. <b>/show_data</b>: نمایش 50 پیام ثبت‌شده (فقط برای ادمین).\n"
+        "3. <b>/show_data [user=&lt;id&gt;] [chat=&lt;id&gt;] [from=YYYY-MM-DD] [to=YYYY-MM-DD]</b>: نمایش صفحه‌به‌صفحه پیام‌های ثبت‌شده با دکمه‌های قبلی/بعدی (فقط برای ادمین).\n"
         "4. <b>/stats</b>: نمایش آمار کلی ربات شامل تعداد پیام‌ها، کاربران منحصربه‌فرد، 5 کاربر برتر و زمان فعال بودن.\n"
         "5. <b>/reply</b>: فعال کردن حالت ریپلای (تنها ادمین). پیام بعدی به عنوان ریپلای ارسال می‌شود.\n"
         "6. <b>/endreply</b>: پایان حالت ریپلای.\n"
@@ -135,9 +4199,15 @@ async def help_command(update: Update, context: CallbackContext) -> None:
         "9. <b>/list_admins</b>: نمایش لیست ادمین‌های ثبت‌شده.\n"
         "10. <b>/backup</b>: بکاپ‌گیری از دیتابیس و ارسال فایل بکاپ.\n"
         "11. <b>/restore</b>: ریستور دیتابیس از فایل بکاپ ارسال‌شده.\n"
-        "12. <b>/list_files</b>: نمایش لیست فایل‌های ذخیره‌شده مجاز (مثلاً بکاپ‌ها، اکسل، نمودار).\n"
+        "12. <b>/list_files [prefix]</b>: نمایش لیست فایل‌های ذخیره‌شده مجاز (مثلاً بکاپ‌ها، اکسل، نمودار)؛ با prefix فقط فایل‌هایی که با آن شروع می‌شوند.\n"
         "13. <b>/get_file &lt;filename&gt;</b>: دریافت فایل مورد نظر (در صورت موجود بودن و مجاز بودن).\n"
-        "14. <b>/get_info &lt;username یا شماره تلفن&gt;</b>: دریافت اطلاعات عمومی کاربر (فقط اطلاعات عمومی مانند نام، نام خانوادگی، یوزرنیم و شناسه).\n\n"
+        "14. <b>/get_info &lt;username یا شماره تلفن&gt;</b>: دریافت اطلاعات عمومی کاربر (فقط اطلاعات عمومی مانند نام، نام خانوادگی، یوزرنیم و شناسه).\n"
+        "15. <b>/rebuild_stats</b>: محاسبه مجدد شمارنده‌های آمار از روی پیام‌های ذخیره‌شده (فقط برای ادمین).\n"
+        "16. <b>/search [chat=&lt;id&gt;] [user=&lt;id&gt;] &lt;words&gt;</b>: جستجوی متن کامل در تمام پیام‌های ذخیره‌شده (فقط برای ادمین).\n"
+        "17. <b>/metrics</b>: خلاصه معیارهای عملکرد: تعداد و زمان اجرای هر دستور، زمان‌های پایگاه داده، سرعت ثبت پیام و خطاها (فقط برای ادمین).\n"
+        "18. <b>/export [csv|parquet|xlsx] [user=&lt;id&gt;] [chat=&lt;id&gt;] [from=YYYY-MM-DD] [to=YYYY-MM-DD]</b>: خروجی گرفتن از پیام‌ها (همراه با آرشیوها) در قالب CSV فشرده، Parquet یا XLSX (فقط برای ادمین).\n"
+        "19. <b>/chart [days] [day|week|month] [chat=&lt;id&gt;]</b>: نمودار تعداد پیام‌ها در طول زمان و کاربران برتر (فقط برای ادمین).\n"
+        "20. <b>/profile [on [fraction]|off|dump]</b>: پروفایل‌گیری از بخشی از به‌روزرسانی‌ها (زمان هندلر، پایگاه داده و تلگرام) و ذخیره آن برای نمودار شعله‌ای (فقط برای ادمین).\n\n"
         "💡 توجه: دسترسی به برخی دستورات فقط برای ادمین‌ها مجاز است."
     )
     try:
@@ -147,118 +4217,187 @@ async def help_command(update: Update, context: CallbackContext) -> None:
 
 async def handle_message(update: Update, context: CallbackContext) -> None:
     """
-    Save incoming messages to the database and send a reply if reply mode is active.
+    Save incoming messages and channel posts of every kind (text, captions,
+    media, polls, locations, service messages) and send a reply if reply mode is active.
     """
-    if not update.message:
+    message = update.effective_message
+    if not message:
         return
     try:
+        user = message.from_user
         # Check if reply mode is active (only for admins)
-        if context.chat_data.get("awaiting_reply_text") and update.message.from_user.id in admins:
-            context.chat_data["reply_text"] = update.message.text
+        if (context.chat_data.get("awaiting_reply_text") and message.text
+                and user is not None and user.id in admins):
+            context.chat_data["reply_text"] = message.text
             context.chat_data.pop("awaiting_reply_text")
-            await update.message.reply_text(f"✅ Reply mode activated.\nReply: {update.message.text}")
+            await message.reply_text(f"✅ Reply mode activated.\nReply: {message.text}")
             return
 
-        # Save message to database
-        user = update.message.from_user
-        chat_id = update.message.chat_id
-        message_text = update.message.text
-        date_str = update.message.date.strftime("%Y-%m-%d %H:%M:%S")
-        try:
-            cursor.execute("""
-                INSERT INTO messages (user_id, username, chat_id, message, date)
-                VALUES (?, ?, ?, ?, ?)
-            """, (user.id, user.username, chat_id, message_text, date_str))
-            conn.commit()
-        except Exception as db_error:
-            logging.error(f"Database error while inserting message: {db_error}")
+        # Save message to database; channel posts have no sender, only the channel.
+        chat_id = message.chat_id
+        date = int(message.date.timestamp())
+        kind, text, media = describe_message(message)
+        username = user.username if user is not None else getattr(message.sender_chat, "username", None)
+        writer.add(
+            (user.id if user is not None else None, username, chat_id, message.message_id, text, date),
+            (user.id, user.username, user.first_name, user.last_name, date) if user is not None else None,
+            (chat_id, message.message_id, kind, media.file_unique_id if media else None) if kind else None,
+            media_row(kind, media, date) if media else None,
+        )
+        if user is not None:
+            resolver.observe(user.id, user.username, user.first_name, user.last_name)
+        if media and MEDIA_DOWNLOAD:
+            media_store.submit(context.bot, kind, media)
 
-        # Send reply if reply mode is active
-        if "reply_text" in context.chat_data:
-            try:
-                await update.message.reply_text(
-                    context.chat_data["reply_text"],
-                    reply_to_message_id=update.message.message_id
-                )
-            except Exception as e:
-                logging.error(f"Error sending reply: {e}")
+        # Send reply if reply mode is active (queued, so ingestion never waits on Telegram).
+        # Only messages users sent with text or a caption are answered, not channel
+        # posts or service messages (joins, pins, ...).
+        if ("reply_text" in context.chat_data and update.message is not None and kind != "service"
+                and user is not None and (message.text or message.caption)):
+            reply_queue.submit(context.application, chat_id, message.message_id, context.chat_data["reply_text"])
     except Exception as e:
         logging.error(f"Error in handle_message: {e}")
 
+async def handle_edited_message(update: Update, context: CallbackContext) -> None:
+    """
+    Save the new text or caption of an edited message or channel post as a new version.
+    """
+    message = update.effective_message
+    if not message:
+        return
+    try:
+        _, text, _ = describe_message(message)
+        edit_date = int((message.edit_date or message.date).timestamp())
+        user_id = message.from_user.id if message.from_user is not None else None
+        writer.add_version((message.chat_id, message.message_id, edit_date, user_id, text))
+    except Exception as e:
+        logging.error(f"Error in handle_edited_message: {e}")
+
+@admin_only("❌ You do not have permission to access this command.")
 async def show_data(update: Update, context: CallbackContext) -> None:
     """
-    Show the last 50 recorded messages from the database (admin only).
+    Show recorded messages from the database, newest first, one page at a time (admin only).
+    Usage: /show_data [user=<id>] [chat=<id>] [from=YYYY-MM-DD] [to=YYYY-MM-DD]
+    Use the inline buttons to move to newer or older pages.
     """
     if not update.message:
         return
     user_id = update.message.from_user.id
-    if user_id not in admins:
-        await update.message.reply_text("❌ You do not have permission to access this command.")
+    try:
+        message_filters = parse_message_filters(context.args or [])
+    except ValueError as e:
+        await update.message.reply_text(f"❌ {e}")
         return
 
+    token = remember_page_query(context, "show_data", {"filters": message_filters})
     try:
-        cursor.execute("""
-            SELECT user_id, username, chat_id, message, date 
-            FROM messages
-            ORDER BY id DESC
-            LIMIT 50
-        """)
-        rows = cursor.fetchall()
+        if update.message.chat.type != "private":
+            await send_show_data_page(context, user_id, token)
+            await update.message.reply_text("✅ Data has been sent to your private messages.")
+        else:
+            await send_show_data_page(context, update.message.chat_id, token)
     except Exception as e:
-        logging.error(f"Database error in show_data: {e}")
+        logging.error(f"Error sending data message: {e}")
         await update.message.reply_text("❌ Error retrieving data.")
+
+@admin_only("❌ You do not have permission.")
+async def show_data_page(update: Update, context: CallbackContext) -> None:
+    """
+    Handle the newer/older buttons of /show_data.
+    """
+    query = update.callback_query
+    _, token, direction, cursor = query.data.split(":")
+    if token not in context.user_data.get("page_queries", {}):
+        await query.answer("⌛ This result has expired. Please run the command again.", show_alert=True)
         return
+    await query.answer()
+    try:
+        if direction == "o":
+            await send_show_data_page(context, query.message.chat_id, token, before=int(cursor))
+        else:
+            await send_show_data_page(context, query.message.chat_id, token, after=int(cursor))
+    except Exception as e:
+        logging.error(f"Error sending data page: {e}")
 
-    if not rows:
-        response = "📭 No messages have been recorded."
-    else:
-        response = "📌 <b>Last 50 Recorded Messages:</b>\n\n"
-        for row in rows:
-            response += (
-                f"👤 <b>UserID:</b> {row[0]}\n"
-                f"🗣 <b>Username:</b> {row[1] if row[1] else 'Unknown'}\n"
-                f"💬 <b>Message:</b> {row[3]}\n"
-                f"💡 <b>ChatID:</b> {row[2]}\n"
-                f"🕒 <b>Date:</b> {row[4]}\n"
-                "-----------------------------------\n"
-            )
+@admin_only("❌ You do not have permission to access this command.")
+async def search(update: Update, context: CallbackContext) -> None:
+    """
+    Full-text search over all stored messages, best matches first (admin only).
+    Usage: /search [chat=<id>] [user=<id>] [from=YYYY-MM-DD] [to=YYYY-MM-DD] <words>
+    """
+    if not update.message:
+        return
+    user_id = update.message.from_user.id
+    args = context.args or []
+    filter_args = [arg for arg in args if "=" in arg and arg.split("=", 1)[0].lower() in ("user", "chat", "from", "to")]
+    terms = [arg for arg in args if arg not in filter_args]
+    fts_query = build_fts_query(terms)
+    if not fts_query:
+        await update.message.reply_text("❌ Please provide search words, e.g. /search hello world")
+        return
+    try:
+        message_filters = parse_message_filters(filter_args)
+    except ValueError as e:
+        await update.message.reply_text(f"❌ {e}")
+        return
+    available = await db.fetchone("SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'")
+    if not available:
+        await update.message.reply_text("❌ Search is not available: SQLite was built without FTS5.")
+        return
 
+    token = remember_page_query(context, "search", {
+        "filters": message_filters, "fts_query": fts_query, "text": " ".join(terms)
+    })
     try:
         if update.message.chat.type != "private":
-            await context.bot.send_message(chat_id=user_id, text=response, parse_mode=ParseMode.HTML)
-            await update.message.reply_text("✅ Data has been sent to your private messages.")
+            await send_search_page(context, user_id, token, 0)
+            await update.message.reply_text("✅ Search results have been sent to your private messages.")
         else:
-            await update.message.reply_text(response, parse_mode=ParseMode.HTML)
+            await send_search_page(context, update.message.chat_id, token, 0)
     except Exception as e:
-        logging.error(f"Error sending data message: {e}")
+        logging.error(f"Error in search: {e}")
+        await update.message.reply_text("❌ Error searching messages.")
+
+@admin_only("❌ You do not have permission.")
+async def search_page(update: Update, context: CallbackContext) -> None:
+    """
+    Handle the previous/next buttons of /search.
+    """
+    query = update.callback_query
+    _, token, _, page = query.data.split(":")
+    if token not in context.user_data.get("page_queries", {}):
+        await query.answer("⌛ This result has expired. Please run the command again.", show_alert=True)
+        return
+    await query.answer()
+    try:
+        await send_search_page(context, query.message.chat_id, token, int(page))
+    except Exception as e:
+        logging.error(f"Error sending search page: {e}")
 
+@admin_only("❌ You do not have permission.")
 async def reply_command(update: Update, context: CallbackContext) -> None:
     """
     Activate reply mode for admins; the next message will be used as the reply text.
     """
     if not update.message:
         return
-    if update.message.from_user.id not in admins:
-        await update.message.reply_text("❌ You do not have permission.")
-        return
     context.chat_data["awaiting_reply_text"] = True
     await update.message.reply_text("📝 Please send the reply text or emoji.")
 
+@admin_only("❌ You do not have permission.")
 async def endreply_command(update: Update, context: CallbackContext) -> None:
     """
     Deactivate reply mode for admins.
     """
     if not update.message:
         return
-    if update.message.from_user.id not in admins:
-        await update.message.reply_text("❌ You do not have permission.")
-        return
     if "reply_text" in context.chat_data:
         context.chat_data.pop("reply_text")
         await update.message.reply_text("✅ Reply mode deactivated.")
     else:
         await update.message.reply_text("ℹ️ Reply mode is not active.")
 
+@admin_only("❌ You do not have permission.")
 async def add_admin(update: Update, context: CallbackContext) -> None:
     """
     Add a new admin. Only current admins can add a new admin.
@@ -267,9 +4406,6 @@ async def add_admin(update: Update, context: CallbackContext) -> None:
     """
     if not update.message:
         return
-    if update.message.from_user.id not in admins:
-        await update.message.reply_text("❌ You do not have permission.")
-        return
 
     if not context.args:
         await update.message.reply_text("❌ Please provide a user ID or @username as an argument.")
@@ -280,19 +4416,14 @@ async def add_admin(update: Update, context: CallbackContext) -> None:
 
     if admin_input.startswith('@'):
         try:
-            chat = await context.bot.get_chat(admin_input)
-            new_admin = chat.id
-        except BadRequest as e:
-            error_msg = str(e).lower()
-            if "chat not found" in error_msg:
-                await update.message.reply_text("❌ Chat not found. The user may not have started a conversation with the bot. Please provide the numeric ID instead.")
-                return
-            else:
-                await update.message.reply_text(f"❌ Error retrieving user ID: {e}")
-                return
+            resolved = await resolver.resolve(context.bot, admin_input)
         except Exception as e:
             await update.message.reply_text(f"❌ Error retrieving user ID: {e}")
             return
+        if resolved is None:
+            await update.message.reply_text("❌ Chat not found. The user may not have started a conversation with the bot. Please provide the numeric ID instead.")
+            return
+        new_admin = resolved.id
     else:
         try:
             new_admin = int(admin_input)
@@ -300,25 +4431,28 @@ async def add_admin(update: Update, context: CallbackContext) -> None:
             await update.message.reply_text("❌ Invalid input provided. Please provide a numeric user ID or a username starting with '@'.")
             return
 
-    if new_admin == MAIN_ADMIN_ID:
+    if new_admin == admins.main_admin:
         await update.message.reply_text("❌ The main admin cannot be changed.")
         return
 
-    if new_admin in admins:
-        await update.message.reply_text("ℹ️ This user is already an admin.")
-    else:
-        admins.add(new_admin)
+    try:
+        added = await admins.add(new_admin, update.message.from_user.id)
+    except Exception as e:
+        logging.error(f"Error adding admin: {e}")
+        await update.message.reply_text("❌ Error saving the admin list.")
+        return
+    if added:
         await update.message.reply_text(f"✅ User {new_admin} has been added as an admin.")
+    else:
+        await update.message.reply_text("ℹ️ This user is already an admin.")
 
+@admin_only("❌ You do not have permission.")
 async def remove_admin(update: Update, context: CallbackContext) -> None:
     """
     Remove an admin from the list. Only current admins can remove an admin.
     """
     if not update.message:
         return
-    if update.message.from_user.id not in admins:
-        await update.message.reply_text("❌ You do not have permission.")
-        return
 
     if not context.args:
         await update.message.reply_text("❌ Please provide a user ID or @username as an argument.")
@@ -329,11 +4463,14 @@ async def remove_admin(update: Update, context: CallbackContext) -> None:
 
     if admin_input.startswith('@'):
         try:
-            chat = await context.bot.get_chat(admin_input)
-            rem_admin = chat.id
+            resolved = await resolver.resolve(context.bot, admin_input)
         except Exception as e:
             await update.message.reply_text(f"❌ Error retrieving user ID: {e}")
             return
+        if resolved is None:
+            await update.message.reply_text("❌ Chat not found. Please provide the numeric ID instead.")
+            return
+        rem_admin = resolved.id
     else:
         try:
             rem_admin = int(admin_input)
@@ -341,12 +4478,17 @@ async def remove_admin(update: Update, context: CallbackContext) -> None:
             await update.message.reply_text("❌ Invalid input provided.")
             return
 
-    if rem_admin == MAIN_ADMIN_ID:
+    if rem_admin == admins.main_admin:
         await update.message.reply_text("❌ The main admin cannot be removed.")
         return
 
-    if rem_admin in admins:
-        admins.remove(rem_admin)
+    try:
+        removed = await admins.remove(rem_admin)
+    except Exception as e:
+        logging.error(f"Error removing admin: {e}")
+        await update.message.reply_text("❌ Error saving the admin list.")
+        return
+    if removed:
         await update.message.reply_text(f"✅ User {rem_admin} has been removed from the admin list.")
     else:
         await update.message.reply_text("ℹ️ This user is not in the admin list.")
@@ -364,122 +4506,342 @@ async def list_admins(update: Update, context: CallbackContext) -> None:
     try:
         await update.message.reply_text(response, parse_mode=ParseMode.HTML)
     except Exception as e:
-        logging.error(f"Error in list_admins: {e}")
+        logging.error(f"Error in list_admins: {e}")
+
+@admin_only("❌ You do not have permission to perform this action.")
+async def backup_db(update: Update, context: CallbackContext) -> None:
+    """
+    Create a backup of the database and send the backup file to the admin.
+    """
+    if not update.message:
+        return
+    await update.message.reply_text("⏳ Creating database backup...")
+    files = []
+    try:
+        await writer.flush()
+        stem = f"backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        manifest = await asyncio.to_thread(create_backup, db.path, stem, file_catalog.directory)
+        files = manifest["files"]
+        for filename in files:
+            with open(filename, "rb") as backup_file:
+                await update.message.reply_document(document=backup_file, write_timeout=UPLOAD_TIMEOUT)
+        await update.message.reply_text(
+            f"✅ Backup complete: {len(manifest['parts'])} part(s), "
+            f"{manifest['size'] / 1024 / 1024:.1f} MB ({manifest['compression']}, "
+            f"{manifest['raw_size'] / 1024 / 1024:.1f} MB uncompressed).\n"
+            f"SHA-256: <code>{manifest['sha256']}</code>",
+            parse_mode=ParseMode.HTML
+        )
+        logging.info("Database backup completed successfully.")
+    except Exception as e:
+        logging.error(f"Error during database backup: {e}")
+        await update.message.reply_text("❌ Error creating database backup.")
+    finally:
+        for filename in files:
+            if os.path.exists(filename):
+                os.remove(filename)
+
+@admin_only("❌ You do not have permission to perform this action.")
+async def export_command(update: Update, context: CallbackContext) -> None:
+    """
+    Export stored messages, archives included, and send the files to the admin.
+    Usage: /export [csv|parquet|xlsx] [user=<id>] [chat=<id>] [from=YYYY-MM-DD] [to=YYYY-MM-DD]
+    csv (the default) is gzip-compressed. Large exports are split into several
+    files; all of them stay in the file catalog, so /get_file resends them
+    without uploading them again.
+    """
+    if not update.message:
+        return
+    args = list(context.args or [])
+    export_format = args.pop(0).lower() if args and args[0].lower() in EXPORT_FORMATS else "csv"
+    try:
+        message_filters = parse_message_filters(args)
+    except ValueError as e:
+        await update.message.reply_text(f"❌ {e}")
+        return
+    if export_format == "parquet" and importlib.util.find_spec("pyarrow") is None:
+        await update.message.reply_text("❌ Parquet export requires the pyarrow package.")
+        return
+    if export_format == "xlsx" and importlib.util.find_spec("openpyxl") is None:
+        await update.message.reply_text("❌ XLSX export requires the openpyxl package.")
+        return
+
+    await update.message.reply_text("⏳ Exporting messages...")
+    try:
+        await writer.flush()
+        stem = file_catalog.path(f"data_log_{datetime.now().strftime('%Y%m%d_%H%M%S')}")
+        files, rows = await asyncio.to_thread(export_messages, message_filters, export_format, stem)
+        if not rows:
+            await update.message.reply_text("ℹ️ No messages match the given filters.")
+            return
+        names = [os.path.basename(path) for path in files]
+        await file_catalog.add(names)
+        for name in names:
+            await file_catalog.send(update.message, await file_catalog.lookup(name))
+        await update.message.reply_text(f"✅ Exported {rows} messages to {len(files)} file(s).")
+        logging.info(f"Export completed: {rows} rows, {len(files)} file(s).")
+    except Exception as e:
+        logging.error(f"Error exporting messages: {e}")
+        await update.message.reply_text("❌ Error exporting messages.")
+
+def make_restore_dir() -> str:
+    """
+    A new scratch directory for the files of one restore, under ARTIFACT_DIR
+    (the file catalog skips directories). Decompressed backups can be large,
+    so it stays off the system temp dir, which may live in memory.
+    """
+    os.makedirs(ARTIFACT_DIR, exist_ok=True)
+    return tempfile.mkdtemp(prefix="restore_", dir=ARTIFACT_DIR)
+
+async def run_restore(update: Update, files: dict) -> None:
+    """
+    Assemble the downloaded backup files and merge them into the database in
+    batches on the DB writer thread, editing a progress message as it goes.
+    Message ingestion keeps running between batches.
+    """
+    status = await update.message.reply_text("⏳ Preparing backup file...")
+    restore_dir = make_restore_dir()
+    restore_file = os.path.join(restore_dir, "restore.db")
+    schema = f"restore_{uuid.uuid4().hex}"
+    attached = False
+    try:
+        await asyncio.to_thread(assemble_backup, files, restore_file)
+        await writer.flush()
+        source = await db.write(attach_backup, restore_file, schema)
+        if source is None:
+            await status.edit_text("❌ The backup file does not contain the required table.")
+            return
+        attached = True
+        select_columns, max_id = source
+        after_id, read, inserted = 0, 0, 0
+        last_report = asyncio.get_running_loop().time()
+        while True:
+            last_id, count, added = await db.write(
+                merge_backup_batch, schema, select_columns, after_id, RESTORE_BATCH_SIZE, archive_store
+            )
+            if last_id is None:
+                break
+            after_id, read, inserted = last_id, read + count, inserted + added
+            now = asyncio.get_running_loop().time()
+            if now - last_report >= 3:
+                last_report = now
+                percent = 100 * after_id // max_id if max_id else 100
+                try:
+                    await status.edit_text(f"⏳ Restoring... {percent}% ({read} rows read, {inserted} new)")
+                except Exception as e:
+                    logging.error(f"Error updating restore progress: {e}")
+        await status.edit_text(
+            f"✅ Data has been successfully restored.\n"
+            f"📥 {inserted} new messages, {read - inserted} duplicates skipped."
+        )
+        logging.info(f"Restore completed: {read} rows read, {inserted} inserted.")
+    except Exception as e:
+        logging.error(f"Error restoring data: {e}")
+        await update.message.reply_text(f"❌ Error restoring data: {e}")
+    finally:
+        if attached:
+            await db.write(detach_backup, schema)
+            recent.clear()
+        for path in list(files.values()) + [restore_file]:
+            if os.path.exists(path):
+                os.remove(path)
+        for directory in {os.path.dirname(path) for path in files.values()} | {restore_dir}:
+            if os.path.isdir(directory) and not os.listdir(directory):
+                os.rmdir(directory)
 
-async def backup_db(update: Update, context: CallbackContext) -> None:
+async def download_backup_document(context: CallbackContext, document, directory: str) -> tuple:
     """
-    Create a backup of the database and send the backup file to the admin.
+    Download a backup document into directory. Returns (original_name, local_path).
     """
-    if not update.message:
-        return
-    if update.message.from_user.id not in admins:
-        await update.message.reply_text("❌ You do not have permission to perform this action.")
+    name = os.path.basename(document.file_name or "backup.db")
+    path = os.path.join(directory, name)
+    file = await context.bot.get_file(document.file_id)
+    await file.download_to_drive(custom_path=path)
+    return name, path
+
+def discard_pending_restore(chat_data: dict, pending: dict = None) -> None:
+    """
+    Forget the files collected for a /restore sent without a document and
+    remove their directory. With pending, only if that restore is still the
+    one waiting (so a timer does not cancel a newer /restore).
+    """
+    current = chat_data.get("awaiting_restore")
+    if current is None or (pending is not None and current is not pending):
         return
-    try:
-        backup_filename = f"backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}.db"
-        shutil.copy(DB_PATH, backup_filename)
-        with open(backup_filename, "rb") as backup_file:
-            await update.message.reply_document(document=backup_file)
-        os.remove(backup_filename)
-        logging.info("Database backup completed successfully.")
-    except Exception as e:
-        logging.error(f"Error during database backup: {e}")
-        await update.message.reply_text("❌ Error creating database backup.")
+    chat_data.pop("awaiting_restore")
+    current["timer"].cancel()
+    shutil.rmtree(current["dir"], ignore_errors=True)
 
+def schedule_restore_timeout(chat_data: dict, pending: dict) -> None:
+    """
+    (Re)start the timer that discards pending after RESTORE_WAIT_TIMEOUT
+    seconds without a new file.
+    """
+    if pending.get("timer") is not None:
+        pending["timer"].cancel()
+    pending["timer"] = asyncio.get_running_loop().call_later(
+        RESTORE_WAIT_TIMEOUT, discard_pending_restore, chat_data, pending
+    )
+
+@admin_only("❌ You do not have permission to perform this action.")
 async def restore_db(update: Update, context: CallbackContext) -> None:
     """
     Restore the database from a backup file sent as a document.
-    The backup file's data will be merged with the current data.
+    The backup file's data will be merged with the current data; messages that
+    are already stored are skipped.
+    The backup can be sent with /restore as its caption, /restore can be sent as
+    a reply to it, or /restore can be sent first and the file(s) afterwards.
+    Compressed (.db.gz / .db.zst) backups and split backups (all parts plus the
+    manifest) produced by /backup are accepted.
     """
     if not update.message:
         return
-    if update.message.from_user.id not in admins:
-        await update.message.reply_text("❌ You do not have permission to perform this action.")
-        return
-    if not update.message.document:
-        await update.message.reply_text("❌ Please send the backup file as a document.")
+    document = update.message.document
+    if not document and update.message.reply_to_message:
+        document = update.message.reply_to_message.document
+    # A new /restore replaces one that is still waiting for its files.
+    discard_pending_restore(context.chat_data)
+    if not document:
+        pending = {"dir": make_restore_dir(), "files": {}, "downloads": 0, "timer": None}
+        context.chat_data["awaiting_restore"] = pending
+        schedule_restore_timeout(context.chat_data, pending)
+        await update.message.reply_text(
+            "📎 Please send the backup file as a document.\n"
+            "For a split backup, send all parts and the manifest file."
+        )
         return
+    directory = make_restore_dir()
     try:
-        file = await context.bot.get_file(update.message.document.file_id)
-        restore_file = "restore_temp.db"
-        await file.download_to_drive(custom_path=restore_file)
+        name, path = await download_backup_document(context, document, directory)
     except Exception as e:
         logging.error(f"Error downloading backup file: {e}")
         await update.message.reply_text("❌ Error downloading backup file.")
+        os.rmdir(directory)
+        return
+    if not backup_files_complete({name: path}):
+        await update.message.reply_text("❌ This is one part of a split backup. Send /restore first, then all parts and the manifest.")
+        os.remove(path)
+        os.rmdir(directory)
         return
+    await run_restore(update, {name: path})
 
+async def restore_document(update: Update, context: CallbackContext) -> None:
+    """
+    Collect backup documents sent after /restore and start the restore once a
+    complete backup has arrived.
+    """
+    if not update.message or not update.message.document:
+        return
+    pending = context.chat_data.get("awaiting_restore")
+    if not pending or update.message.from_user.id not in admins:
+        return
+    # The wait does not time out while a file is downloading; it restarts once all are in.
+    pending["downloads"] += 1
+    pending["timer"].cancel()
     try:
-        restore_conn = sqlite3.connect(restore_file)
-        restore_cursor = restore_conn.cursor()
-        # Check if the backup file has the expected table
-        restore_cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='messages'")
-        if not restore_cursor.fetchone():
-            await update.message.reply_text("❌ The backup file does not contain the required table.")
-            restore_conn.close()
-            os.remove(restore_file)
-            return
-
-        restore_cursor.execute("SELECT * FROM messages")
-        rows = restore_cursor.fetchall()
-        restore_conn.close()
+        name, path = await download_backup_document(context, update.message.document, pending["dir"])
     except Exception as e:
-        logging.error(f"Error reading backup file: {e}")
-        await update.message.reply_text("❌ Error reading backup file.")
-        os.remove(restore_file)
+        logging.error(f"Error downloading backup file: {e}")
+        await update.message.reply_text("❌ Error downloading backup file.")
         return
-
+    finally:
+        pending["downloads"] -= 1
+        if not pending["downloads"] and context.chat_data.get("awaiting_restore") is pending:
+            schedule_restore_timeout(context.chat_data, pending)
+    if context.chat_data.get("awaiting_restore") is not pending:
+        # Replaced by a newer /restore meanwhile, which removed the directory.
+        return
+    pending["files"][name] = path
     try:
-        # Insert rows from the backup file into the current database.
-        # Using INSERT OR IGNORE to prevent duplicates based on unique constraints if any.
-        for row in rows:
-            cursor.execute("""
-                INSERT OR IGNORE INTO messages (user_id, username, chat_id, message, date)
-                VALUES (?, ?, ?, ?, ?)
-            """, row[1:])
-        conn.commit()
-        os.remove(restore_file)
-        await update.message.reply_text("✅ Data has been successfully restored.")
+        complete = backup_files_complete(pending["files"])
     except Exception as e:
-        logging.error(f"Error restoring data: {e}")
-        await update.message.reply_text("❌ Error restoring data.")
-        if os.path.exists(restore_file):
-            os.remove(restore_file)
+        logging.error(f"Error reading backup manifest: {e}")
+        await update.message.reply_text("❌ Error reading the backup manifest.")
+        return
+    if not complete:
+        await update.message.reply_text(f"📥 Received {name}. Waiting for the remaining files...")
+        return
+    # run_restore removes the files and the directory once it is done.
+    context.chat_data.pop("awaiting_restore")
+    pending["timer"].cancel()
+    await run_restore(update, pending["files"])
 
-async def stats(update: Update, context: CallbackContext) -> None:
+def collect_stats(conn: sqlite3.Connection, chat_id: int, days: int) -> dict:
     """
-    Show overall bot statistics including total messages, unique users, top 5 users, and uptime.
+    Read the statistics counters. Runs on a DB reader thread.
+    Every query is a primary-key or index lookup, so the cost does not grow with
+    the number of stored messages.
     """
-    if not update.message:
-        return
+    result = {"total_messages": "N/A", "unique_users": "N/A", "top_users": [],
+              "chat_messages": None, "today": None, "chat_today": None, "daily": []}
+    today = int(datetime.now(timezone.utc).timestamp()) // 86400
+    cursor = conn.cursor()
     try:
-        cursor.execute("SELECT COUNT(*) FROM messages")
-        total_messages = cursor.fetchone()[0]
+        row = cursor.execute("SELECT messages, users FROM totals WHERE id = 1").fetchone()
+        if row:
+            result["total_messages"], result["unique_users"] = row
     except Exception as e:
-        logging.error(f"Error fetching total messages: {e}")
-        total_messages = "N/A"
+        logging.error(f"Error fetching totals: {e}")
 
     try:
-        cursor.execute("SELECT COUNT(DISTINCT user_id) FROM messages")
-        unique_users = cursor.fetchone()[0]
+        result["top_users"] = cursor.execute("""
+            SELECT user_id, username, msg_count
+            FROM user_stats
+            ORDER BY msg_count DESC
+            LIMIT 5
+        """).fetchall()
     except Exception as e:
-        logging.error(f"Error fetching unique users: {e}")
-        unique_users = "N/A"
+        logging.error(f"Error fetching top users: {e}")
 
     try:
-        cursor.execute("""
-            SELECT user_id, username, COUNT(*) as msg_count 
-            FROM messages 
-            GROUP BY user_id 
-            ORDER BY msg_count DESC 
-            LIMIT 5
-        """)
-        top_users = cursor.fetchall()
+        result["today"] = cursor.execute(
+            "SELECT COALESCE(SUM(msg_count), 0) FROM daily_stats WHERE day = ?", (today,)
+        ).fetchone()[0]
+        if chat_id is not None:
+            row = cursor.execute("SELECT msg_count FROM chat_stats WHERE chat_id = ?", (chat_id,)).fetchone()
+            result["chat_messages"] = row[0] if row else 0
+            row = cursor.execute(
+                "SELECT msg_count FROM daily_stats WHERE day = ? AND chat_id = ?", (today, chat_id)
+            ).fetchone()
+            result["chat_today"] = row[0] if row else 0
+        if days:
+            if chat_id is not None:
+                result["daily"] = cursor.execute("""
+                    SELECT day, msg_count FROM daily_stats
+                    WHERE chat_id = ? AND day > ?
+                    ORDER BY day DESC
+                """, (chat_id, today - days)).fetchall()
+            else:
+                result["daily"] = cursor.execute("""
+                    SELECT day, SUM(msg_count) FROM daily_stats
+                    WHERE day > ?
+                    GROUP BY day
+                    ORDER BY day DESC
+                """, (today - days,)).fetchall()
     except Exception as e:
-        logging.error(f"Error fetching top users: {e}")
-        top_users = []
+        logging.error(f"Error fetching chat statistics: {e}")
+    return result
+
+async def stats(update: Update, context: CallbackContext) -> None:
+    """
+    Show overall bot statistics including total messages, unique users, top 5 users, and uptime.
+    In groups the counters of the current chat are shown as well.
+    Usage: /stats [days] - also list per-day message counts for the last <days> days.
+    """
+    if not update.message:
+        return
+    days = 0
+    if context.args:
+        try:
+            days = max(0, min(int(context.args[0]), 90))
+        except ValueError:
+            await update.message.reply_text("❌ The number of days must be a number.")
+            return
+    chat_id = update.message.chat_id if update.message.chat.type != "private" else None
+    result = await db.read(collect_stats, chat_id, days)
 
     try:
-        db_creation_time = os.path.getctime(DB_PATH)
+        db_creation_time = os.path.getctime(db.path)
         uptime = datetime.now() - datetime.fromtimestamp(db_creation_time)
     except Exception as e:
         logging.error(f"Error calculating uptime: {e}")
@@ -487,15 +4849,26 @@ async def stats(update: Update, context: CallbackContext) -> None:
 
     stats_text = (
         f"📊 <b>Overall Bot Statistics</b>\n\n"
-        f"📝 <b>Total Messages:</b> {total_messages}\n"
-        f"👥 <b>Unique Users:</b> {unique_users}\n"
+        f"📝 <b>Total Messages:</b> {result['total_messages']}\n"
+        f"👥 <b>Unique Users:</b> {result['unique_users']}\n"
+        f"📅 <b>Messages Today:</b> {result['today'] if result['today'] is not None else 'N/A'}\n"
         f"⏳ <b>Uptime:</b> {uptime if isinstance(uptime, str) else f'{uptime.days} days, {uptime.seconds // 3600} hours'}\n"
     )
-    if top_users:
+    if result["chat_messages"] is not None:
+        stats_text += (
+            f"\n💬 <b>This Chat:</b> {result['chat_messages']} messages"
+            f" ({result['chat_today']} today)\n"
+        )
+    if result["top_users"]:
         stats_text += "\n🏆 <b>Top 5 Users:</b>\n"
-        for user in top_users:
-            display_name = user[1] if user[1] else user[0]
+        for user in result["top_users"]:
+            display_name = html.escape(user[1]) if user[1] else user[0]
             stats_text += f"{display_name} - {user[2]} messages\n"
+    if result["daily"]:
+        stats_text += f"\n📈 <b>Last {days} Days:</b>\n"
+        for day, count in result["daily"]:
+            day_str = datetime.fromtimestamp(day * 86400, timezone.utc).strftime("%Y-%m-%d")
+            stats_text += f"{day_str} - {count} messages\n"
 
     try:
         await update.message.reply_text(stats_text, parse_mode=ParseMode.HTML)
@@ -504,34 +4877,132 @@ async def stats(update: Update, context: CallbackContext) -> None:
     except Exception as e:
         logging.error(f"Error sending stats: {e}")
 
+@admin_only("❌ You do not have permission to perform this action.")
+async def chart_command(update: Update, context: CallbackContext) -> None:
+    """
+    Send a chart of the message volume over time and the top users (admin only).
+    Usage: /chart [days] [day|week|month] [chat=<id>]
+    In a group the chart covers that group, in a private chat all chats.
+    """
+    if not update.message:
+        return
+    days, bucket = 30, "day"
+    chat_id = update.message.chat_id if update.message.chat.type != "private" else None
+    for arg in context.args or []:
+        key, sep, value = arg.partition("=")
+        try:
+            if arg.lower() in CHART_BUCKETS:
+                bucket = arg.lower()
+            elif sep and key.lower() == "chat":
+                chat_id = int(value)
+            elif not sep:
+                days = max(1, min(int(arg), CHART_MAX_DAYS))
+            else:
+                raise ValueError
+        except ValueError:
+            await update.message.reply_text("❌ Usage: /chart [days] [day|week|month] [chat=<id>]")
+            return
+    if not charts.available():
+        await update.message.reply_text("❌ Charts require the matplotlib package.")
+        return
+
+    title = f"Messages per {bucket}, last {days} days" + (f" (chat {chat_id})" if chat_id is not None else "")
+    try:
+        path = await charts.get(chat_id, days, bucket, title)
+        with open(path, "rb") as chart_file:
+            await update.message.reply_photo(photo=chart_file, caption=f"📈 {title}")
+    except Exception as e:
+        logging.error(f"Error creating chart: {e}")
+        await update.message.reply_text("❌ Error creating chart.")
+
+@admin_only("❌ You do not have permission to perform this action.")
+async def rebuild_stats_command(update: Update, context: CallbackContext) -> None:
+    """
+    Recompute the statistics counters from the stored messages, archives included (admin only).
+    Only needed once for data written outside the bot; the counters are kept up to date automatically.
+    """
+    if not update.message:
+        return
+    await update.message.reply_text("⏳ Rebuilding statistics...")
+    try:
+        await writer.flush()
+        await db.write(rebuild_all_stats, archive_store)
+        await update.message.reply_text("✅ Statistics have been rebuilt.")
+    except Exception as e:
+        logging.error(f"Error rebuilding statistics: {e}")
+        await update.message.reply_text("❌ Error rebuilding statistics.")
+
+def format_size(size: int) -> str:
+    for unit in ("B", "KB", "MB"):
+        if size < 1024:
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GB"
+
+async def send_files_page(context: CallbackContext, chat_id: int, token: str, page: int) -> None:
+    """
+    Send one page of /list_files results to chat_id. The working files
+    (bot_data.db, ...) that exist are listed on the first page.
+    """
+    query = context.user_data["page_queries"][token]
+    rows, has_more = await db.read(FileCatalog.page, query["prefix"], page)
+    if page == 0:
+        working = [(name, os.path.getsize(name)) for name in WORKING_FILES
+                   if name.startswith(query["prefix"]) and os.path.isfile(name)]
+        rows = working + rows
+    if not rows:
+        await context.bot.send_message(chat_id=chat_id, text="ℹ️ No allowed files found.")
+        return
+    header = "📁 <b>Allowed Files:</b>\n\n"
+    if page > 0 or has_more:
+        header = f"📁 <b>Allowed Files</b> (page {page + 1}):\n\n"
+    entries = [f"• {html.escape(name)} ({format_size(size)})\n" for name, size in rows]
+    keyboard = page_keyboard("lf", token, page - 1 if page > 0 else None, page + 1 if has_more else None,
+                             labels=("⬅️ Previous", "Next ➡️"))
+    await send_chunks(context, chat_id, split_html_chunks(header, entries), keyboard)
+
+@admin_only("❌ You do not have permission to access this command.")
 async def list_files(update: Update, context: CallbackContext) -> None:
     """
-    List all allowed files stored in the current directory.
+    List the allowed files, from the file catalog, one page at a time.
+    Usage: /list_files [prefix], e.g. /list_files backup_ or /list_files archive_2024
     """
     if not update.message:
         return
-    if update.message.from_user.id not in admins:
-        await update.message.reply_text("❌ You do not have permission to access this command.")
+    prefix = context.args[0].strip() if context.args else ""
+    if not FILE_PREFIX_RE.match(prefix):
+        await update.message.reply_text("❌ A file name prefix may only contain letters, digits, '_', '-' and '.'.")
         return
-    files = list_allowed_files()
-    if not files:
-        response = "ℹ️ No allowed files found."
-    else:
-        response = "📁 <b>Allowed Files:</b>\n\n" + "\n".join(f"• {f}" for f in files)
+    token = remember_page_query(context, "list_files", {"prefix": prefix})
     try:
-        await update.message.reply_text(response, parse_mode=ParseMode.HTML)
+        await send_files_page(context, update.message.chat_id, token, 0)
     except Exception as e:
         logging.error(f"Error in list_files: {e}")
 
+@admin_only("❌ You do not have permission.")
+async def files_page(update: Update, context: CallbackContext) -> None:
+    """
+    Handle the previous/next buttons of /list_files.
+    """
+    query = update.callback_query
+    _, token, _, page = query.data.split(":")
+    if token not in context.user_data.get("page_queries", {}):
+        await query.answer("⌛ This result has expired. Please run the command again.", show_alert=True)
+        return
+    await query.answer()
+    try:
+        await send_files_page(context, query.message.chat_id, token, int(page))
+    except Exception as e:
+        logging.error(f"Error sending files page: {e}")
+
+@admin_only("❌ You do not have permission to access this command.")
 async def get_file_command(update: Update, context: CallbackContext) -> None:
     """
-    Send the requested file as a document (only allowed files).
+    Send the requested file as a document (only allowed files). Cataloged files
+    that were uploaded before are resent by file_id, without uploading them again.
     """
     if not update.message:
         return
-    if update.message.from_user.id not in admins:
-        await update.message.reply_text("❌ You do not have permission to access this command.")
-        return
     if not context.args:
         await update.message.reply_text("❌ Please provide the filename as an argument.")
         return
@@ -539,12 +5010,26 @@ async def get_file_command(update: Update, context: CallbackContext) -> None:
     if not is_allowed_file(filename):
         await update.message.reply_text("❌ The requested file is not allowed to be sent.")
         return
-    if not os.path.exists(filename):
-        await update.message.reply_text("❌ File not found.")
-        return
     try:
-        with open(filename, "rb") as f:
-            await update.message.reply_document(document=f)
+        if filename in WORKING_FILES:
+            entry = None
+            size = os.path.getsize(filename) if os.path.isfile(filename) else None
+        else:
+            entry = await file_catalog.lookup(filename)
+            size = entry.size if entry is not None else None
+        if size is None:
+            await update.message.reply_text("❌ File not found.")
+            return
+        if size > UPLOAD_MAX_BYTES and not (entry and entry.file_id):
+            await update.message.reply_text(
+                f"❌ The file is too large to send ({format_size(size)}; the limit is {format_size(UPLOAD_MAX_BYTES)})."
+            )
+            return
+        if entry is not None:
+            await file_catalog.send(update.message, entry)
+        else:
+            with open(filename, "rb") as f:
+                await update.message.reply_document(document=f, write_timeout=UPLOAD_TIMEOUT)
     except Exception as e:
         logging.error(f"Error sending file {filename}: {e}")
         await update.message.reply_text("❌ Error sending the file.")
@@ -568,46 +5053,832 @@ async def get_info(update: Update, context: CallbackContext) -> None:
         return
 
     try:
-        chat = await context.bot.get_chat(query)
-        info_text = "👤 <b>User Information:</b>\n\n"
-        info_text += f"👤 First Name: {chat.first_name}\n"
-        if chat.last_name:
-            info_text += f"👤 Last Name: {chat.last_name}\n"
-        if chat.username:
-            info_text += f"🔹 Username: @{chat.username}\n"
-        info_text += f"💡 ID: {chat.id}\n\n"
-        info_text += "ℹ️ Note: Only public information is available. If the user hasn't interacted with the bot, no additional info will be returned."
+        user = await resolver.resolve(context.bot, query)
+    except Exception as e:
+        await update.message.reply_text(f"❌ Error retrieving information: {e}")
+        return
+    if user is None:
+        await update.message.reply_text("❌ Chat not found. This may be because the user hasn't started a conversation with the bot or the username is incorrect.")
+        return
+
+    info_text = "👤 <b>User Information:</b>\n\n"
+    info_text += f"👤 First Name: {html.escape(user.first_name) if user.first_name else 'Unknown'}\n"
+    if user.last_name:
+        info_text += f"👤 Last Name: {html.escape(user.last_name)}\n"
+    if user.username:
+        info_text += f"🔹 Username: @{html.escape(user.username)}\n"
+    info_text += f"💡 ID: {user.id}\n\n"
+    info_text += "ℹ️ Note: Only public information is available. If the user hasn't interacted with the bot, no additional info will be returned."
+    try:
         await update.message.reply_text(info_text, parse_mode=ParseMode.HTML)
-    except BadRequest as e:
-        error_msg = str(e).lower()
-        if "chat not found" in error_msg:
-            await update.message.reply_text("❌ Chat not found. This may be because the user hasn't started a conversation with the bot or the username is incorrect.")
+    except Exception as e:
+        logging.error(f"Error in get_info: {e}")
+
+@admin_only("❌ You do not have permission to perform this action.")
+async def metrics_command(update: Update, context: CallbackContext) -> None:
+    """
+    Summarize the collected metrics (admin only): handler calls and latency,
+    database timings, write rate, errors and database size.
+    The full set is served on the local /metrics endpoint when METRICS_PORT is set.
+    """
+    if not update.message:
+        return
+    uptime = max(time.time() - metrics.started, 1.0)
+    sizes = db.file_sizes()
+
+    def latency(histogram: Histogram, bucket_counts: list) -> str:
+        p50 = histogram.quantile(0.50, bucket_counts) * 1000
+        p99 = histogram.quantile(0.99, bucket_counts) * 1000
+        return f"p50 {p50:.1f} ms, p99 {p99:.1f} ms"
+
+    text = (
+        f"📈 <b>Metrics</b>\n\n"
+        f"⏳ <b>Uptime:</b> {int(uptime) // 3600} hours, {int(uptime) % 3600 // 60} minutes\n"
+        f"📝 <b>Messages Written:</b> {writer.written} ({writer.written / uptime:.2f}/s), "
+        f"{writer.pending} pending, {writer.dropped} dropped\n"
+        f"📥 <b>Queued Updates:</b> {context.application.update_queue.qsize()}\n"
+        f"💾 <b>Database:</b> {sizes[('db',)] / 1048576:.1f} MB (WAL {sizes[('wal',)] / 1048576:.1f} MB)\n"
+    )
+    handler_rows = sorted(HANDLER_SECONDS.items(), key=lambda item: -item[1][2])
+    if handler_rows:
+        text += "\n⚙️ <b>Handlers:</b>\n"
+        for (name,), (bucket_counts, total, count) in handler_rows:
+            text += f"{html.escape(name)} - {count} calls, {latency(HANDLER_SECONDS, bucket_counts)}\n"
+    commits = DB_COMMIT_SECONDS.items()
+    if commits:
+        bucket_counts, total, count = commits[0][1]
+        text += f"\n🗄 <b>Batch Commits:</b> {count}, {latency(DB_COMMIT_SECONDS, bucket_counts)}\n"
+    db_rows = sorted(DB_SECONDS.items(), key=lambda item: -item[1][1])[:8]
+    if db_rows:
+        text += "\n🗄 <b>Database Calls (by total time):</b>\n"
+        for (kind, call), (bucket_counts, total, count) in db_rows:
+            text += f"{kind} {html.escape(call)} - {count} calls, {total:.2f}s total, {latency(DB_SECONDS, bucket_counts)}\n"
+    errors = ERRORS.items()
+    logged = LOG_MESSAGES.items()
+    if errors or logged:
+        text += "\n❗ <b>Errors:</b>\n"
+        for (source, exception), count in sorted(errors, key=lambda item: -item[1]):
+            text += f"{html.escape(source)}: {html.escape(exception)} - {count}\n"
+        for (level,), count in sorted(logged):
+            text += f"{level} log messages - {count}\n"
+
+    try:
+        await update.message.reply_text(text, parse_mode=ParseMode.HTML)
+    except Exception as e:
+        logging.error(f"Error sending metrics: {e}")
+
+async def dump_profile() -> str:
+    """
+    Write the collected profile to a new file in the file catalog and return its name.
+    """
+    name = f"profile_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{os.getpid()}.folded"
+    stacks = await asyncio.to_thread(profiler.dump, file_catalog.path(name))
+    await file_catalog.add([name])
+    logging.info(f"Profile with {stacks} stacks written to {name}.")
+    return name
+
+@admin_only("❌ You do not have permission to perform this action.")
+async def profile_command(update: Update, context: CallbackContext) -> None:
+    """
+    Control the profiler (admin only).
+    Usage: /profile                  show the sample rate and the hottest stacks
+           /profile on [fraction]    profile a fraction of updates (default 0.1), starting a new profile
+           /profile off              stop sampling, keeping what was collected
+           /profile dump             write the profile as folded stacks for /get_file
+    In multi-process mode this only affects the worker that handles the command.
+    """
+    if not update.message:
+        return
+    action = context.args[0].lower() if context.args else ""
+    try:
+        if action == "on":
+            try:
+                rate = float(context.args[1]) if len(context.args) > 1 else (PROFILE_SAMPLE_RATE or 0.1)
+            except ValueError:
+                rate = -1.0
+            if not 0 < rate <= 1:
+                await update.message.reply_text("❌ The fraction must be a number between 0 and 1, e.g. /profile on 0.05")
+                return
+            profiler.start(rate)
+            await update.message.reply_text(f"✅ Profiling {rate:.0%} of updates.")
+        elif action == "off":
+            profiler.rate = 0.0
+            await update.message.reply_text("✅ Profiling stopped. Use /profile dump to save what was collected.")
+        elif action == "dump":
+            if not profiler.samples:
+                await update.message.reply_text("ℹ️ Nothing has been profiled yet. Start with /profile on")
+                return
+            name = await dump_profile()
+            await update.message.reply_text(
+                f"✅ Profile saved as <code>{name}</code>.\nFetch it with /get_file {name} and open it with "
+                f"flamegraph.pl or speedscope.app (values are microseconds).",
+                parse_mode=ParseMode.HTML
+            )
+        elif action:
+            await update.message.reply_text("❌ Usage: /profile [on [fraction]|off|dump]")
         else:
-            await update.message.reply_text(f"❌ Error retrieving information: {e}")
+            since = datetime.fromtimestamp(profiler.started).strftime("%Y-%m-%d %H:%M:%S")
+            text = (
+                f"🔬 <b>Profiler</b>\n\n"
+                f"<b>Sample rate:</b> {profiler.rate:.0%}\n"
+                f"<b>Profiled calls:</b> {profiler.samples} since {since}\n"
+                f"<b>Slow queries:</b> {profiler.slow_queries} (over {PROFILE_SLOW_QUERY_MS:.0f} ms)\n"
+            )
+            top = profiler.top(10)
+            if top:
+                text += "\n🔥 <b>Hottest stacks (self time):</b>\n"
+                for stack, seconds in top:
+                    text += f"{seconds * 1000:.1f} ms - <code>{truncate_html(stack, 300)}</code>\n"
+            await update.message.reply_text(text, parse_mode=ParseMode.HTML)
     except Exception as e:
-        await update.message.reply_text(f"❌ Error retrieving information: {e}")
+        logging.error(f"Error in profile command: {e}")
+        await update.message.reply_text("❌ Error while handling the profiler.")
 
 # ---------------- Register Handlers ----------------
-bot.add_handler(CommandHandler("start", start))
-bot.add_handler(CommandHandler("help", help_command))
-bot.add_handler(CommandHandler("show_data", show_data))
-bot.add_handler(CommandHandler("reply", reply_command))
-bot.add_handler(CommandHandler("endreply", endreply_command))
-bot.add_handler(CommandHandler("add_admin", add_admin))
-bot.add_handler(CommandHandler("remove_admin", remove_admin))
-bot.add_handler(CommandHandler("list_admins", list_admins))
-bot.add_handler(CommandHandler("backup", backup_db))
-bot.add_handler(CommandHandler("restore", restore_db))
-bot.add_handler(CommandHandler("stats", stats))
-bot.add_handler(CommandHandler("list_files", list_files))
-bot.add_handler(CommandHandler("get_file", get_file_command))
-bot.add_handler(CommandHandler("get_info", get_info))
-bot.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+def instrument(handler):
+    """
+    Wrap handler.callback so every call is counted and timed under the
+    callback's name, and exceptions are counted by type before propagating
+    (except ApplicationHandlerStop, which only stops later handler groups).
+    Sampled updates are profiled (see Profiler).
+    """
+    callback = handler.callback
+    name = callback.__name__
+
+    @functools.wraps(callback)
+    async def timed(update: Update, context: CallbackContext):
+        if startup.waiting:
+            startup.first_update()
+        HANDLER_CALLS.inc(name)
+        started = time.perf_counter()
+        try:
+            with profiler.sample(name, update.update_id):
+                return await callback(update, context)
+        except ApplicationHandlerStop:
+            # Control flow (skip_handled_update dropping a duplicate), not an error.
+            raise
+        except Exception as e:
+            ERRORS.inc(name, type(e).__name__)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, name)
+
+    handler.callback = timed
+    return handler
+
+def register_handlers(application: Application) -> None:
+    """
+    Register all command, callback and message handlers on the application.
+    Every handler is instrumented for the metrics. Updates that were already
+    handled are stopped in group -1, before any other handler runs.
+    """
+    application.add_handler(instrument(TypeHandler(Update, skip_handled_update)), group=-1)
+    handlers = [
+        CommandHandler("start", start),
+        CommandHandler("help", help_command),
+        CommandHandler("show_data", show_data),
+        CallbackQueryHandler(show_data_page, pattern=r"^sd:"),
+        CommandHandler("search", search),
+        CallbackQueryHandler(search_page, pattern=r"^se:"),
+        CommandHandler("reply", reply_command),
+        CommandHandler("endreply", endreply_command),
+        CommandHandler("add_admin", add_admin),
+        CommandHandler("remove_admin", remove_admin),
+        CommandHandler("list_admins", list_admins),
+        CommandHandler("backup", backup_db),
+        CommandHandler("export", export_command),
+        CommandHandler("restore", restore_db),
+        MessageHandler(filters.Document.ALL & filters.CaptionRegex(r"^/restore(@\w+)?(\s|$)"), restore_db),
+        MessageHandler(filters.Document.ALL, restore_document),
+        CommandHandler("stats", stats),
+        CommandHandler("chart", chart_command),
+        CommandHandler("rebuild_stats", rebuild_stats_command),
+        CommandHandler("list_files", list_files),
+        CallbackQueryHandler(files_page, pattern=r"^lf:"),
+        CommandHandler("get_file", get_file_command),
+        CommandHandler("get_info", get_info),
+        CommandHandler("metrics", metrics_command),
+        CommandHandler("profile", profile_command),
+    ]
+    for handler in handlers:
+        application.add_handler(instrument(handler))
+    # Ingestion runs in its own group, so messages that also trigger a handler
+    # above (e.g. documents sent for /restore) are recorded as well.
+    ingest_handlers = [
+        MessageHandler((filters.UpdateType.MESSAGE | filters.UpdateType.CHANNEL_POST) & ~filters.COMMAND,
+                       handle_message),
+        MessageHandler(filters.UpdateType.EDITED, handle_edited_message),
+    ]
+    for handler in ingest_handlers:
+        application.add_handler(instrument(handler), group=1)
+    application.add_handler(instrument(TypeHandler(Update, finish_update)), group=2)
+
+# ---------------- Metrics Endpoint ----------------
+class MetricsServer:
+    """
+    Local HTTP server that serves metrics.render() on GET /metrics for
+    Prometheus to scrape. Disabled when port is 0.
+    """
+
+    def __init__(self, registry: MetricsRegistry, host: str, port: int) -> None:
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self._runner = None
+
+    async def _handle(self, request):
+        from aiohttp import web
+        return web.Response(
+            body=self.registry.render().encode(),
+            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+        )
+
+    async def start(self) -> None:
+        if not self.port or self._runner is not None:
+            return
+        try:
+            from aiohttp import web
+        except ImportError:
+            logging.warning("METRICS_PORT is set but aiohttp is not installed; the metrics endpoint is disabled.")
+            return
+        app = web.Application()
+        app.router.add_get("/metrics", self._handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        logging.info(f"Metrics endpoint listening on http://{self.host}:{self.port}/metrics")
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+metrics_server = MetricsServer(metrics, METRICS_HOST, METRICS_PORT)
+
+# ---------------- Webhook Server ----------------
+def create_webhook_app(application: Application, path: str, secret: str):
+    """
+    aiohttp application that accepts Telegram updates as JSON POSTs on path and
+    puts them on the Application's update queue. Requests without the matching
+    X-Telegram-Bot-Api-Secret-Token header are rejected when a secret is set.
+    GET /healthz reports the number of queued updates.
+    """
+    from aiohttp import web
+
+    async def receive_update(request):
+        if secret and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != secret:
+            return web.Response(status=403)
+        try:
+            data = await request.json()
+            update = Update.de_json(data, application.bot)
+        except Exception as e:
+            logging.error(f"Invalid webhook payload: {e}")
+            return web.Response(status=400)
+        await application.update_queue.put(update)
+        return web.Response()
+
+    async def health(request):
+        return web.json_response({"running": application.running, "queued_updates": application.update_queue.qsize()})
+
+    app = web.Application()
+    app.router.add_post(path, receive_update)
+    app.router.add_get("/healthz", health)
+    return app
+
+async def serve_webhook(application: Application, stop: asyncio.Event = None) -> None:
+    """
+    Serve updates from the local webhook server until stop is set (by default
+    on SIGINT/SIGTERM), then stop accepting requests and drain the queued
+    updates before shutting down.
+    """
+    from aiohttp import web
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    if WEBHOOK_URL and not isinstance(application.bot.request, OfflineRequest):
+        await application.bot.set_webhook(
+            url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET or None,
+            allowed_updates=Update.ALL_TYPES,
+        )
+    await application.start()
+
+    runner = web.AppRunner(create_webhook_app(application, WEBHOOK_PATH, WEBHOOK_SECRET))
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    logging.info(f"Webhook server listening on {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+
+    if stop is None:
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+    try:
+        await stop.wait()
+    finally:
+        logging.info("Stopping webhook server and draining pending updates...")
+        await runner.cleanup()
+        await application.stop()
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+def run_webhook(application: Application) -> None:
+    if importlib.util.find_spec("aiohttp") is None:
+        raise RuntimeError("Webhook mode requires the aiohttp package (pip install aiohttp).")
+    asyncio.run(serve_webhook(application))
+
+# ---------------- Multi-Process Mode ----------------
+def _ignore_signals() -> None:
+    """
+    Child processes are stopped by the supervisor through their channels, so
+    signals sent to the whole process group (Ctrl+C, a platform's SIGTERM) are
+    left to the supervisor.
+    """
+    for sig in (signal.SIGINT, signal.SIGTERM, signal.SIGHUP):
+        signal.signal(sig, signal.SIG_IGN)
+
+class Channel:
+    """
+    One-way channel between processes with a single consumer: a pipe, plus a
+    semaphore that bounds the number of unread items when size is given.
+    Unlike multiprocessing.Queue the consumer holds no lock while it waits, so
+    a consumer killed with SIGKILL leaves the channel, and the items it had not
+    read yet, to the process started in its place.
+    """
+
+    def __init__(self, context, size: int = None) -> None:
+        self.size = size
+        self._reader, self._writer = context.Pipe(duplex=False)
+        self._slots = context.BoundedSemaphore(size) if size else None
+        self._lock = threading.Lock()
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def fileno(self) -> int:
+        # Lets multiprocessing.connection.wait() watch several channels at once.
+        return self._reader.fileno()
+
+    def put(self, item, block: bool = True, timeout: float = None) -> None:
+        """
+        Send item, waiting for a free slot like queue.Queue.put (queue.Full when there is none).
+        """
+        payload = pickle.dumps(item)
+        if self._slots is not None and not self._slots.acquire(block, timeout):
+            raise queue.Full
+        with self._lock:
+            self._writer.send_bytes(payload)
+
+    def put_nowait(self, item) -> None:
+        self.put(item, block=False)
+
+    def get(self, timeout: float = None):
+        """
+        Receive the next item; raises queue.Empty if none arrives within timeout.
+        """
+        if not self._reader.poll(timeout):
+            raise queue.Empty
+        payload = self._reader.recv_bytes()
+        if self._slots is not None:
+            self._slots.release()
+        return pickle.loads(payload)
+
+    def qsize(self) -> int:
+        return self.size - self._slots.get_value() if self._slots is not None else 0
+
+def _next_item(source: Channel):
+    """
+    Blocking get that returns None (the stop signal) once the supervisor has died.
+    """
+    parent = multiprocessing.parent_process()
+    while True:
+        try:
+            return source.get(timeout=1)
+        except queue.Empty:
+            if parent is not None and not parent.is_alive():
+                return None
+
+class RemoteWriter:
+    """
+    Sends the database writes of a worker process to the writer process.
+    A call is pickled as (call_id, fn, args), so fn has to be a module-level
+    function or a method of a SharedInstance. Answers come back on the worker's
+    results channel and are matched to the waiting call by call_id. When the
+    writer does not answer within timeout the call raises
+    sqlite3.OperationalError, which callers already handle like a locked database.
+    """
+
+    def __init__(self, calls: Channel, results: Channel, timeout: float) -> None:
+        self.calls = calls
+        self.results = results
+        self.timeout = timeout
+        self._next_id = 0
+        self._waiting = {}
+        self._loop = None
+        self._thread = None
+
+    def _receive(self) -> None:
+        while True:
+            answer = self.results.get()
+            if answer is None:
+                return
+            self._loop.call_soon_threadsafe(self._resolve, *answer)
+
+    def _resolve(self, call_id: tuple, ok: bool, value) -> None:
+        future = self._waiting.pop(call_id, None)
+        if future is None or future.done():
+            # Answer to a call that already timed out.
+            return
+        if ok:
+            future.set_result(value)
+        else:
+            future.set_exception(value)
+
+    async def call(self, fn, args: tuple):
+        """
+        Run fn(conn, *args) on the writer process's DB writer thread and return its result.
+        """
+        self._next_id += 1
+        # The PID keeps answers meant for a previous worker from matching.
+        call_id = (os.getpid(), self._next_id)
+        future = self._loop.create_future()
+        self._waiting[call_id] = future
+        try:
+            try:
+                self.calls.put_nowait((call_id, fn, args))
+            except queue.Full:
+                await self._loop.run_in_executor(None, self.calls.put, (call_id, fn, args))
+            return await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            raise sqlite3.OperationalError(f"The writer process did not answer within {self.timeout}s.")
+        finally:
+            self._waiting.pop(call_id, None)
+
+    def start(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._thread = threading.Thread(target=self._receive, name="remote-writer", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        if self._thread is not None:
+            self.results.put(None)
+            self._thread.join()
+            self._thread = None
+
+async def serve_worker(application: Application, index: int, workers: int,
+                       updates: Channel, remote: RemoteWriter) -> None:
+    """
+    Run the handlers of a worker process on the updates the supervisor hands
+    it, one at a time and in the order received, until it gets the stop signal.
+    """
+    db.remote = remote
+    remote.start()
+    # Other chats' newest messages are written by other workers.
+    recent.serve_overall = False
+    update_tracker.key = UpdateTracker.worker_key(index, workers)
+    # Telegram's overall limit is shared by all workers.
+    global_rate = OUTBOUND_GLOBAL_RATE / workers
+    rate_limiter.global_bucket = TokenBucket(global_rate, max(global_rate, 1.0))
+    if METRICS_PORT:
+        metrics_server.port = METRICS_PORT + 1 + index
+    await application.initialize()
+    await application.post_init(application)
+    await application.start()
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            try:
+                data = updates.get(timeout=0)
+            except queue.Empty:
+                data = await loop.run_in_executor(None, _next_item, updates)
+            if data is None:
+                break
+            await application.process_update(Update.de_json(data, application.bot))
+    finally:
+        await application.stop()
+        await application.shutdown()
+        await application.post_shutdown(application)
+        remote.stop()
+        logging.info(f"Worker {index} stopped.")
+
+def run_worker_process(config: Config, index: int, workers: int, updates: Channel, calls: Channel,
+                       results: Channel) -> None:
+    _ignore_signals()
+    configure_logging()
+    apply_config(config)
+    application = build_application(config.token, OfflineRequest(config.token) if config.webhook_offline else None)
+    register_handlers(application)
+    remote = RemoteWriter(calls, results, WORKER_CALL_TIMEOUT)
+    asyncio.run(serve_worker(application, index, workers, updates, remote))
+
+async def _run_remote_call(call: tuple, results: Channel) -> None:
+    call_id, fn, args = call
+    try:
+        answer = (call_id, True, await db.write(fn, *args))
+    except Exception as e:
+        answer = (call_id, False, e)
+    loop = asyncio.get_running_loop()
+    try:
+        await loop.run_in_executor(None, results.put, answer)
+    except Exception as e:
+        await loop.run_in_executor(
+            None, results.put, (call_id, False, sqlite3.OperationalError(f"Result cannot be sent back: {e}"))
+        )
+
+async def serve_writer(workers: int, control: Channel, calls: list, results: list) -> None:
+    """
+    Run the writer process: every call sent by the workers goes to this
+    process's DB writer thread in the order it arrived, and the answer goes back
+    to the calling worker. The search index backfill and retention run here too,
+    so the database and the archives are only ever written by this process.
+    On the stop signal it finishes the calls it has already received; calls sent
+    after that wait in their channels for the next writer.
+    """
+    if METRICS_PORT:
+        metrics_server.port = METRICS_PORT + 1 + workers
+    await open_database()
+    fts_backfill.start()
+    retention.start()
+    await metrics_server.start()
+    startup.mark("ready")
+    logging.info(f"Writer process startup: {startup.summary()}")
+    loop = asyncio.get_running_loop()
+    parent = multiprocessing.parent_process()
+    running = set()
+    try:
+        while True:
+            ready = await loop.run_in_executor(None, multiprocessing.connection.wait, [control] + calls, 1)
+            if control in ready:
+                control.get(timeout=0)
+                break
+            if parent is not None and not parent.is_alive():
+                break
+            for channel in ready:
+                try:
+                    call = channel.get(timeout=0)
+                except Exception as e:
+                    logging.error(f"Discarding unreadable writer call: {e}")
+                    continue
+                task = asyncio.create_task(_run_remote_call(call, results[calls.index(channel)]))
+                running.add(task)
+                task.add_done_callback(running.discard)
+        await asyncio.gather(*running, return_exceptions=True)
+    finally:
+        await metrics_server.stop()
+        await retention.stop()
+        await fts_backfill.stop()
+        db.close()
+        archive_store.close()
+        logging.info("Writer process stopped.")
+
+def run_writer_process(config: Config, workers: int, control: Channel, calls: list, results: list) -> None:
+    _ignore_signals()
+    configure_logging()
+    apply_config(config)
+    asyncio.run(serve_writer(workers, control, calls, results))
+
+class Supervisor:
+    """
+    Multi-process mode, run from the process that receives updates: one writer
+    process owns the database and `workers` worker processes run the handlers.
+    Each update goes to worker chat_id % workers over a bounded channel, so a
+    chat is always handled by the same worker, in order, and its chat_data
+    lives in one place. When a worker's channel is full, dispatch waits; that
+    fills the receiver's bounded update queue, which stops polling (or holds
+    webhook responses) so the backlog stays with Telegram.
+    Children that die are started again and pick up the work still queued for
+    them. SIGHUP restarts them one at a time, each finishing the work already
+    queued for it first.
+    """
+
+    def __init__(self, config: Config, queue_size: int, stop_timeout: float) -> None:
+        self.config = config
+        self.workers = workers = config.worker_processes
+        self.stop_timeout = stop_timeout
+        # Spawned children import bot.py afresh instead of inheriting this
+        # process's threads, and set themselves up from config.
+        self._context = multiprocessing.get_context("spawn")
+        self.updates = [Channel(self._context, queue_size) for _ in range(workers)]
+        self.calls = [Channel(self._context, queue_size) for _ in range(workers)]
+        self.results = [Channel(self._context) for _ in range(workers)]
+        self.control = Channel(self._context, 1)
+        self.processes = {}
+        self._stopping = set()
+        self._monitor_task = None
+        self._restarting = False
+        # Metrics
+        self.dispatched = 0
+        self.stalls = 0
+        self.restarts = 0
+
+    @staticmethod
+    def _label(name) -> str:
+        return "Writer process" if name == "writer" else f"Worker {name}"
+
+    @staticmethod
+    def route(update: Update) -> int:
+        """
+        Chat the update belongs to (or its sender when there is no chat).
+        """
+        if update.effective_chat is not None:
+            return update.effective_chat.id
+        if update.effective_user is not None:
+            return update.effective_user.id
+        return 0
+
+    def _spawn(self, name) -> None:
+        if name == "writer":
+            target, args = run_writer_process, (self.config, self.workers, self.control, self.calls, self.results)
+        else:
+            target = run_worker_process
+            args = (self.config, name, self.workers, self.updates[name], self.calls[name], self.results[name])
+        process = self._context.Process(target=target, args=args, name=f"bot-{name}")
+        process.start()
+        self.processes[name] = process
+        logging.info(f"{self._label(name)} started (pid {process.pid}).")
+
+    async def _stop_process(self, name) -> None:
+        """
+        Send the stop signal behind the work already queued for the process and
+        wait for it to exit; kill it after stop_timeout.
+        """
+        process = self.processes[name]
+        self._stopping.add(name)
+        source = self.control if name == "writer" else self.updates[name]
+        loop = asyncio.get_running_loop()
+        if process.is_alive():
+            try:
+                await loop.run_in_executor(None, functools.partial(source.put, None, timeout=self.stop_timeout))
+            except queue.Full:
+                pass
+            await loop.run_in_executor(None, process.join, self.stop_timeout)
+        if process.is_alive():
+            # Children ignore SIGTERM, see _ignore_signals.
+            logging.warning(f"{self._label(name)} did not stop within {self.stop_timeout}s; killing it.")
+            process.kill()
+            await loop.run_in_executor(None, process.join)
+
+    async def dispatch(self, update: Update, context: CallbackContext) -> None:
+        index = self.route(update) % self.workers
+        data = update.to_dict()
+        self.dispatched += 1
+        try:
+            self.updates[index].put_nowait(data)
+        except queue.Full:
+            self.stalls += 1
+            started = time.monotonic()
+            await asyncio.get_running_loop().run_in_executor(None, self.updates[index].put, data)
+            waited = time.monotonic() - started
+            if waited >= 1:
+                logging.warning(f"Worker {index} is falling behind; waited {waited:.1f}s to hand over an update.")
+
+    async def _monitor(self) -> None:
+        while True:
+            await asyncio.sleep(1)
+            for name, process in list(self.processes.items()):
+                if name not in self._stopping and not process.is_alive():
+                    logging.error(f"{self._label(name)} exited with code {process.exitcode}; starting it again.")
+                    self.restarts += 1
+                    self._spawn(name)
+
+    async def restart(self) -> None:
+        """
+        Rolling restart: each worker in turn finishes the updates queued for it,
+        exits and is started again, then the writer does the same with the calls
+        it has received. Work for a process that is restarting waits in its channel.
+        """
+        if self._restarting:
+            return
+        self._restarting = True
+        logging.info("Restarting worker processes...")
+        try:
+            for name in list(range(self.workers)) + ["writer"]:
+                await self._stop_process(name)
+                self._spawn(name)
+                self._stopping.discard(name)
+                self.restarts += 1
+        finally:
+            self._restarting = False
+        logging.info("Rolling restart completed.")
+
+    async def start(self, application: Application) -> None:
+        metrics.callback("bot_update_queue_size", "Updates received but not yet dispatched.", application.update_queue.qsize)
+        metrics.callback(
+            "bot_worker_queue_size", "Updates waiting for each worker process.",
+            lambda: {(str(index),): channel.qsize() for index, channel in enumerate(self.updates)},
+            labels=("worker",)
+        )
+        metrics.callback("bot_updates_dispatched_total", "Updates handed to worker processes.",
+                         lambda: self.dispatched, "counter")
+        metrics.callback("bot_dispatch_stalls_total", "Dispatches that waited for a full worker queue.",
+                         lambda: self.stalls, "counter")
+        metrics.callback("bot_process_restarts_total", "Child processes started again.",
+                         lambda: self.restarts, "counter")
+        # The schema is brought up to date before any child can read the
+        # database; this process does not use it after that.
+        await open_database()
+        if update_tracker.acknowledge:
+            keys = [UpdateTracker.worker_key(index, self.workers) for index in range(self.workers)]
+            await update_tracker.acknowledge_offset(application.bot, keys)
+        db.close()
+        self._spawn("writer")
+        for index in range(self.workers):
+            self._spawn(index)
+        self._monitor_task = asyncio.create_task(self._monitor())
+        asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, lambda: application.create_task(self.restart()))
+        await metrics_server.start()
+        startup.mark("ready")
+        logging.info(f"Startup: {startup.summary()}")
+
+    async def stop(self, application: Application) -> None:
+        """
+        Stop the workers once their queued updates are handled, then the writer
+        once their last writes are in.
+        """
+        asyncio.get_running_loop().remove_signal_handler(signal.SIGHUP)
+        if self._monitor_task is not None:
+            self._monitor_task.cancel()
+            try:
+                await self._monitor_task
+            except asyncio.CancelledError:
+                pass
+            self._monitor_task = None
+        await asyncio.gather(*(self._stop_process(index) for index in range(self.workers)))
+        await self._stop_process("writer")
+        await metrics_server.stop()
+        logging.info(f"Supervisor stopped: dispatched={self.dispatched}, stalls={self.stalls}, restarts={self.restarts}")
+
+def build_receiver(token: str, supervisor: Supervisor, request: BaseRequest = None) -> Application:
+    """
+    Application for the receiving process in multi-process mode. Its only
+    handler passes every update to supervisor.dispatch, and its update queue is
+    bounded so a stalled dispatch holds back polling and webhook requests.
+    """
+    builder = (
+        Application.builder()
+        .token(token)
+        .update_queue(asyncio.Queue(maxsize=WORKER_QUEUE_SIZE))
+        .post_init(supervisor.start)
+        .post_shutdown(supervisor.stop)
+    )
+    if request is not None:
+        builder = builder.request(request).get_updates_request(request)
+    application = builder.build()
+    application.add_handler(instrument(TypeHandler(Update, supervisor.dispatch)))
+    return application
 
 # ---------------- Run Bot ----------------
-if __name__ == "__main__":
+def apply_config(config: Config) -> None:
+    """
+    Point the module-level services at config. Runs in every process before
+    its application starts.
+    """
+    db.path = config.db_path
+    admins.main_admin = config.main_admin
+    admins.initial = frozenset(config.admins) | {config.main_admin}
+    update_tracker.acknowledge = config.mode == "polling"
+
+def create_application(config: Config, request: BaseRequest = None) -> Application:
+    """
+    Application factory: the bot described by config, with its handlers
+    registered, or in multi-process mode the receiver that hands updates to the
+    worker processes. Nothing is opened or started until it is initialized.
+    request optionally replaces the HTTP backend (see OfflineRequest).
+    """
+    apply_config(config)
+    if request is None and config.webhook_offline:
+        request = OfflineRequest(config.token)
+    if config.worker_processes > 0:
+        supervisor = Supervisor(config, WORKER_QUEUE_SIZE, WORKER_STOP_TIMEOUT)
+        return build_receiver(config.token, supervisor, request)
+    application = build_application(config.token, request, config.concurrent_updates)
+    register_handlers(application)
+    return application
+
+def main() -> None:
+    configure_logging()
+    config = Config.from_env()
     try:
-        logging.info("Bot is running...")
-        bot.run_polling()
+        application = create_application(config)
+        if config.worker_processes > 0:
+            logging.info(f"Bot is running ({config.mode} mode, {config.worker_processes} worker processes)...")
+        else:
+            logging.info(f"Bot is running ({config.mode} mode)...")
+        if config.mode == "webhook":
+            run_webhook(application)
+        else:
+            application.run_polling()
     except Exception as e:
         logging.critical(f"Critical error: {e}")
+
+startup.mark("import")
+
+if __name__ == "__main__":
+    main()
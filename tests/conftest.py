@@ -0,0 +1,28 @@
+import os
+import sys
+import socket
+import tempfile
+
+# bot.py is a single module at the repository root.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+# bot.py reads its settings at import, so every test module shares them.
+WORK_DIR = tempfile.mkdtemp(prefix="bot_test_")
+os.environ.update({
+    "TOKEN": "123456:TEST",
+    "DB_PATH": os.path.join(WORK_DIR, "bot_data.db"),
+    "ARTIFACT_DIR": os.path.join(WORK_DIR, "artifacts"),
+    "BOT_MODE": "webhook",
+    "WEBHOOK_OFFLINE": "1",
+    "WEBHOOK_HOST": "127.0.0.1",
+    "WEBHOOK_SECRET": "test-secret",
+    "PORT": str(_free_port()),
+    # Progress replies are edited often; private chats are limited to 1 message/s otherwise.
+    "OUTBOUND_CHAT_RATE": "1000",
+    "OUTBOUND_GLOBAL_RATE": "1000",
+})
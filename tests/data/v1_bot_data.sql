@@ -0,0 +1,20 @@
+-- bot_data.db as written by the first release: no message_id, dates as
+-- "%Y-%m-%d %H:%M:%S" text in UTC, no user_version.
+CREATE TABLE messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER,
+    username TEXT,
+    chat_id INTEGER,
+    message TEXT,
+    date TEXT
+);
+INSERT INTO messages (user_id, username, chat_id, message, date) VALUES
+    (101, 'alice', -1001, 'hello', '2023-03-01 08:00:00'),
+    (102, 'bob', -1001, 'hi alice', '2023-03-01 08:00:05'),
+    (101, 'alice', -1001, 'ok', '2023-03-01 08:01:00'),
+    (101, 'alice', -1001, 'ok', '2023-03-01 08:01:00'),
+    (102, 'bob', -1001, 'ok', '2023-03-01 08:01:00'),
+    (103, NULL, -1002, 'temperature 25.5', '2023-03-02 23:59:59'),
+    (101, 'alice', -1002, 'see you', '2023-04-15 12:30:00'),
+    (104, 'dave', 104, 'private note', '2024-02-29 00:00:00'),
+    (102, 'bob', -1001, 'unparseable date', 'yesterday');
@@ -0,0 +1,51 @@
+"""
+The application factory: applications built one after another in the same
+process, each on its own event loop and with its own configuration.
+"""
+import os
+import json
+import asyncio
+import sqlite3
+
+from telegram import Update
+
+import bot
+
+WORK_DIR = os.path.dirname(os.environ["DB_PATH"])
+
+with open(os.path.join(os.path.dirname(__file__), "data", "updates.json")) as f:
+    RECORDED_UPDATES = json.load(f)
+
+async def _run_session(config: bot.Config) -> None:
+    application = bot.create_application(config, bot.OfflineRequest(config.token))
+    await application.initialize()
+    await application.post_init(application)
+    try:
+        for data in RECORDED_UPDATES:
+            await application.process_update(Update.de_json(data, application.bot))
+    finally:
+        await application.post_shutdown(application)
+        await application.shutdown()
+
+def _read(db_path: str, sql: str) -> list:
+    conn = sqlite3.connect(db_path)
+    try:
+        return conn.execute(sql).fetchall()
+    finally:
+        conn.close()
+
+def test_create_application_twice_in_one_process(monkeypatch):
+    monkeypatch.chdir(WORK_DIR)
+    base = bot.Config.from_env()._replace(worker_processes=0)
+    sessions = [
+        base._replace(db_path=os.path.join(WORK_DIR, "first.db"), main_admin=1, admins=frozenset({2})),
+        base._replace(db_path=os.path.join(WORK_DIR, "second.db"), main_admin=10, admins=frozenset({20, 30})),
+    ]
+    for config in sessions:
+        asyncio.run(_run_session(config))
+
+    for config in sessions:
+        stored = _read(config.db_path, "SELECT chat_id, message_id FROM messages ORDER BY id")
+        assert stored == [(-1001234567890, 101), (-1001234567890, 102), (200001, 7), (-1009876543210, 55)]
+        admins = {row[0] for row in _read(config.db_path, "SELECT user_id FROM admins")}
+        assert admins == config.admins | {config.main_admin}
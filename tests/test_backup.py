@@ -0,0 +1,88 @@
+"""
+/backup files: create_backup() writes a compressed, possibly split backup and
+assemble_backup() puts it back together for /restore.
+"""
+import os
+import random
+import sqlite3
+
+import pytest
+
+import bot
+
+def _database(path: str, rows: int) -> None:
+    rng = random.Random(1)
+    conn = sqlite3.connect(path)
+    try:
+        bot.init_db(conn, frozenset({1}))
+        with conn:
+            conn.executemany(
+                "INSERT INTO messages (user_id, username, chat_id, message_id, message, date) VALUES (?, ?, ?, ?, ?, ?)",
+                [(n % 7, f"user{n % 7}", -5, n, "%032x" % rng.getrandbits(128), 1700000000 + n) for n in range(rows)]
+            )
+    finally:
+        conn.close()
+
+def _messages(path: str) -> list:
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute("SELECT * FROM messages ORDER BY id").fetchall()
+    finally:
+        conn.close()
+
+def _compressions() -> list:
+    kinds = ["gzip"]
+    if bot.zstandard is not None:
+        kinds.append("zstd")
+    return kinds
+
+@pytest.mark.parametrize("compression", _compressions())
+def test_split_backup_round_trip(compression, tmp_path, monkeypatch):
+    monkeypatch.setattr(bot, "BACKUP_COMPRESSION", compression)
+    monkeypatch.setattr(bot, "BACKUP_PART_SIZE", 16 * 1024)
+    source = str(tmp_path / "bot_data.db")
+    _database(source, 2000)
+    out_dir = tmp_path / "out"
+    out_dir.mkdir()
+
+    manifest = bot.create_backup(source, "backup_test", str(out_dir))
+
+    assert len(manifest["parts"]) > 2
+    assert all(part["size"] <= 16 * 1024 for part in manifest["parts"])
+    files = {os.path.basename(path): path for path in manifest["files"]}
+    assert "backup_test.manifest.json" in files
+    assert bot.backup_files_complete(files)
+    restored = str(tmp_path / "restored.db")
+    bot.assemble_backup(files, restored)
+    assert _messages(restored) == _messages(source)
+
+def test_single_file_backup_round_trip(tmp_path):
+    source = str(tmp_path / "bot_data.db")
+    _database(source, 50)
+
+    manifest = bot.create_backup(source, "backup_small", str(tmp_path))
+
+    assert [os.path.basename(path) for path in manifest["files"]] == [manifest["name"]]
+    restored = str(tmp_path / "restored.db")
+    bot.assemble_backup({manifest["name"]: manifest["files"][0]}, restored)
+    assert _messages(restored) == _messages(source)
+
+def test_incomplete_split_backup_is_rejected(tmp_path, monkeypatch):
+    monkeypatch.setattr(bot, "BACKUP_PART_SIZE", 16 * 1024)
+    source = str(tmp_path / "bot_data.db")
+    _database(source, 2000)
+    manifest = bot.create_backup(source, "backup_test", str(tmp_path))
+    files = {os.path.basename(path): path for path in manifest["files"]}
+    missing = manifest["parts"][1]["name"]
+    del files[missing]
+
+    assert not bot.backup_files_complete(files)
+    with pytest.raises(ValueError, match=missing):
+        bot.assemble_backup(files, str(tmp_path / "restored.db"))
+
+    # A part cut short fails its checksum.
+    files[missing] = os.path.join(str(tmp_path), missing)
+    with open(files[missing], "r+b") as f:
+        f.truncate(100)
+    with pytest.raises(ValueError, match="Checksum mismatch"):
+        bot.assemble_backup(files, str(tmp_path / "restored.db"))
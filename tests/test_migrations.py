@@ -0,0 +1,123 @@
+"""
+Schema migrations from a database written by the first release, and /restore
+of such a database as a backup.
+"""
+import os
+import sqlite3
+from datetime import datetime, timezone
+
+import bot
+
+FIXTURE = os.path.join(os.path.dirname(__file__), "data", "v1_bot_data.sql")
+
+def _v1_database(path: str) -> None:
+    conn = sqlite3.connect(path)
+    try:
+        with open(FIXTURE) as f:
+            conn.executescript(f.read())
+    finally:
+        conn.close()
+
+def _v1_rows(path: str) -> list:
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute("SELECT id, user_id, username, chat_id, message, date FROM messages ORDER BY id").fetchall()
+    finally:
+        conn.close()
+
+def _restore(conn: sqlite3.Connection, backup: str) -> int:
+    select_columns, _ = bot.attach_backup(conn, backup, "restore_test")
+    inserted, after_id = 0, 0
+    try:
+        while True:
+            after_id, _, rows = bot.merge_backup_batch(conn, "restore_test", select_columns, after_id, 3)
+            if after_id is None:
+                return inserted
+            inserted += rows
+    finally:
+        bot.detach_backup(conn, "restore_test")
+
+def _epoch(text: str) -> int:
+    return int(datetime.strptime(text, "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc).timestamp())
+
+def test_v1_database_upgrades_to_the_current_schema(tmp_path):
+    path = str(tmp_path / "bot_data.db")
+    _v1_database(path)
+    before = _v1_rows(path)
+    conn = sqlite3.connect(path)
+    try:
+        bot.init_db(conn, frozenset({1, 2}))
+        assert conn.execute("PRAGMA user_version").fetchone()[0] == bot.SCHEMA_VERSION
+        after = conn.execute(
+            "SELECT id, user_id, username, chat_id, message_id, message, date FROM messages ORDER BY id"
+        ).fetchall()
+        # Every row keeps its id and values; parseable dates become epoch seconds.
+        assert len(after) == len(before) == 9
+        for old, new in zip(before, after):
+            row_id, user_id, username, chat_id, message, date = old
+            expected_date = date if date == "yesterday" else _epoch(date)
+            assert new == (row_id, user_id, username, chat_id, None, message, expected_date)
+
+        assert conn.execute("SELECT messages, users FROM totals").fetchone() == (9, 4)
+        assert conn.execute("SELECT msg_count FROM user_stats WHERE user_id = 101").fetchone()[0] == 4
+        assert conn.execute("SELECT msg_count FROM chat_stats WHERE chat_id = -1001").fetchone()[0] == 6
+        assert sorted(row[0] for row in conn.execute("SELECT user_id FROM admins")) == [1, 2]
+
+        # Rows from before the search index are indexed by the backfill.
+        pos, end = bot.FtsBackfill._progress(conn)
+        while pos < end:
+            pos, end = bot.fts_backfill._index_batch(conn)
+        rows = conn.execute("""
+            SELECT m.message FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid
+            WHERE messages_fts MATCH ?
+        """, (bot.build_fts_query(["alice"]),)).fetchall()
+        assert rows == [("hi alice",)]
+    finally:
+        conn.close()
+
+def test_repeated_legacy_messages_survive_upgrade_and_restore(tmp_path):
+    path = str(tmp_path / "bot_data.db")
+    _v1_database(path)
+    conn = sqlite3.connect(path)
+    try:
+        bot.init_db(conn, frozenset({1}))
+        repeats = conn.execute(
+            "SELECT COUNT(*) FROM messages WHERE user_id = 101 AND message = 'ok'"
+        ).fetchone()[0]
+        assert repeats == 2
+        # The database restored into itself: nothing is added.
+        assert _restore(conn, path) == 0
+    finally:
+        conn.close()
+
+    fresh = str(tmp_path / "fresh.db")
+    backup = str(tmp_path / "backup_v1.db")
+    _v1_database(backup)
+    conn = sqlite3.connect(fresh)
+    try:
+        bot.init_db(conn, frozenset({1}))
+        assert _restore(conn, backup) == 9
+        assert _restore(conn, backup) == 0
+        assert conn.execute("SELECT messages FROM totals").fetchone()[0] == 9
+    finally:
+        conn.close()
+
+def test_retention_leaves_unparseable_legacy_dates(tmp_path, monkeypatch):
+    monkeypatch.setattr(bot.archive_store, "directory", str(tmp_path / "archives"))
+    os.makedirs(bot.archive_store.directory)
+    path = str(tmp_path / "bot_data.db")
+    _v1_database(path)
+    conn = sqlite3.connect(path)
+    try:
+        bot.init_db(conn, frozenset({1}))
+        cutoff = int(datetime(2025, 1, 1, tzinfo=timezone.utc).timestamp())
+        archived = 0
+        while True:
+            moved = bot.retention._archive_batch(conn, cutoff)
+            if not moved:
+                break
+            archived += moved
+        assert archived == 8
+        assert conn.execute("SELECT message, date FROM messages").fetchall() == [("unparseable date", "yesterday")]
+    finally:
+        conn.close()
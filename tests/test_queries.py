@@ -0,0 +1,66 @@
+"""
+Read paths of /show_data and /search: keyset pages over the messages table
+and ranked full-text search.
+"""
+import sqlite3
+
+import pytest
+
+import bot
+
+@pytest.fixture
+def conn(tmp_path, monkeypatch):
+    # No archives: only the main database is read.
+    monkeypatch.setattr(bot.archive_store, "directory", str(tmp_path))
+    conn = sqlite3.connect(str(tmp_path / "bot_data.db"))
+    bot.init_db(conn, frozenset({1}))
+    words = ["hello world", "weather report", "hello again", "temperature 25.5", "good night"]
+    with conn:
+        conn.executemany(
+            "INSERT INTO messages (user_id, username, chat_id, message_id, message, date) VALUES (?, ?, ?, ?, ?, ?)",
+            [(100 + n % 3, f"user{n % 3}", -1 if n % 2 else -2, n, words[n % len(words)], 1700000000 + n * 60)
+             for n in range(1, 26)]
+        )
+    yield conn
+    conn.close()
+
+def _walk_older(conn, message_filters: dict, limit: int) -> list:
+    pages, before = [], None
+    while True:
+        rows, has_older, has_newer = bot.fetch_messages_page(conn, message_filters, before, None, limit)
+        pages.append(([row[0] for row in rows], has_older, has_newer))
+        if not has_older:
+            return pages
+        before = rows[-1][0]
+
+def test_keyset_pages_cover_every_row_once(conn):
+    pages = _walk_older(conn, {}, 10)
+    assert [ids for ids, _, _ in pages] == [list(range(25, 15, -1)), list(range(15, 5, -1)), list(range(5, 0, -1))]
+    assert [(has_older, has_newer) for _, has_older, has_newer in pages] == [(True, False), (True, True), (False, True)]
+
+    # Walking back: the page directly newer than the oldest page.
+    rows, has_older, has_newer = bot.fetch_messages_page(conn, {}, None, 5, 10)
+    assert [row[0] for row in rows] == list(range(15, 5, -1))
+    assert (has_older, has_newer) == (True, True)
+
+def test_keyset_pages_with_filters(conn):
+    pages = _walk_older(conn, {"chat": -1, "user": 101}, 2)
+    ids = [row_id for page, _, _ in pages for row_id in page]
+    expected = [n for n in range(25, 0, -1) if n % 2 and n % 3 == 1]
+    assert ids == expected
+
+def test_search_ranks_and_pages(conn):
+    query = bot.build_fts_query(["hello"])
+    first, has_more = bot.search_messages(conn, query, {}, 0, limit=5)
+    second, has_more_after = bot.search_messages(conn, query, {}, 1, limit=5)
+    found = [row[0] for row in first + second]
+    assert sorted(found) == [n for n in range(1, 26) if n % 5 in (0, 2)]
+    assert has_more and not has_more_after
+    assert all("hello" in row[4] for row in first + second)
+
+def test_search_with_filters_and_punctuation(conn):
+    rows, _ = bot.search_messages(conn, bot.build_fts_query(["temp*"]), {"chat": -2}, 0, limit=10)
+    assert sorted(row[0] for row in rows) == [8, 18]
+    # Quotes in a term cannot break the FTS5 query syntax.
+    rows, _ = bot.search_messages(conn, bot.build_fts_query(['"25.5']), {}, 0, limit=10)
+    assert sorted(row[0] for row in rows) == [3, 8, 13, 18, 23]
@@ -0,0 +1,32 @@
+"""
+Outbound rate limiting: token buckets and the limiter built from them.
+"""
+import asyncio
+
+import pytest
+
+import bot
+
+def test_bucket_spaces_reservations_by_its_rate():
+    bucket = bot.TokenBucket(2.0, 1.0)
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == pytest.approx(0.5, abs=0.01)
+    assert bucket.reserve() == pytest.approx(1.0, abs=0.01)
+
+@pytest.mark.parametrize("rate", [0, -1])
+def test_rate_of_zero_means_no_limit(rate):
+    bucket = bot.TokenBucket(rate, 1.0)
+    assert [bucket.reserve() for _ in range(100)] == [0] * 100
+    bucket.pause(5)
+    assert bucket.reserve() == pytest.approx(5, abs=0.1)
+
+def test_limiter_without_chat_limits():
+    limiter = bot.OutboundRateLimiter(0, 0, 0, max_retries=0)
+
+    async def send_many():
+        for chat_id in (1, -1):
+            for _ in range(20):
+                await asyncio.wait_for(limiter.acquire(chat_id), timeout=1)
+
+    asyncio.run(send_many())
+    assert limiter.queued == 0
@@ -0,0 +1,169 @@
+"""
+/restore of a backup taken before retention moved some of its messages into
+monthly archives: archived messages must not come back into the hot table.
+"""
+import os
+import time
+import asyncio
+import sqlite3
+
+import pytest
+from telegram import Update
+
+import bot
+
+WORK_DIR = os.path.dirname(os.environ["DB_PATH"])
+DAY = 86400
+
+def _backup(conn: sqlite3.Connection, path: str) -> None:
+    target = sqlite3.connect(path)
+    try:
+        conn.backup(target)
+    finally:
+        target.close()
+
+def _restore_update(application, user_id: int, file_id: str, update_id: int = 1) -> Update:
+    data = {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id, "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "Admin"},
+            "document": {"file_id": file_id, "file_unique_id": file_id, "file_name": "backup_test.db"},
+            "caption": "/restore",
+            "caption_entities": [{"type": "bot_command", "offset": 0, "length": 8}],
+        },
+    }
+    return Update.de_json(data, application.bot)
+
+async def _restore_after_retention(config: bot.Config, snapshot: str) -> tuple:
+    request = bot.OfflineRequest(config.token)
+    application = bot.create_application(config, request)
+    await application.initialize()
+    await application.post_init(application)
+    try:
+        now = int(time.time())
+        for row in [(7, "u7", -5, 1, "old one", now - 90 * DAY), (7, "u7", -5, 2, "old two", now - 80 * DAY),
+                    (8, "u8", -5, 3, "new", now - 100), (8, "u8", -5, None, "legacy old", now - 85 * DAY)]:
+            bot.writer.add(row)
+        await bot.writer.flush()
+        # The backup is taken while every message is still in the hot table.
+        await bot.db.read(_backup, snapshot)
+        assert await bot.retention.run() == 3
+        file_id = request.add_file(snapshot)
+        await application.process_update(_restore_update(application, config.main_admin, file_id))
+        totals = await bot.db.fetchone("SELECT messages FROM totals")
+        hot = await bot.db.fetchall("SELECT message FROM messages ORDER BY id")
+        return totals[0], [row[0] for row in hot]
+    finally:
+        await application.post_shutdown(application)
+        await application.shutdown()
+
+@pytest.mark.parametrize("compression", ["none", "gzip"])
+def test_restore_skips_archived_messages(compression, tmp_path, monkeypatch):
+    monkeypatch.chdir(WORK_DIR)
+    monkeypatch.setattr(bot.archive_store, "directory", str(tmp_path))
+    monkeypatch.setattr(bot.archive_store, "compression", compression)
+    monkeypatch.setattr(bot.retention, "compression", compression)
+    monkeypatch.setattr(bot.retention, "days", 30)
+    config = bot.Config.from_env()._replace(worker_processes=0, db_path=str(tmp_path / "bot_data.db"))
+
+    totals, hot = asyncio.run(_restore_after_retention(config, str(tmp_path / "snapshot.db")))
+
+    assert totals == 4
+    assert hot == ["new"]
+    # Scratch directories live under ARTIFACT_DIR and are removed afterwards.
+    for directory in (WORK_DIR, os.environ["ARTIFACT_DIR"]):
+        assert not [name for name in os.listdir(directory) if name.startswith("restore_")]
+
+def _backup_with(path: str, rows: list) -> None:
+    conn = sqlite3.connect(path)
+    try:
+        conn.execute("""
+            CREATE TABLE messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER, username TEXT, chat_id INTEGER, message_id INTEGER, message TEXT, date INTEGER
+            )
+        """)
+        with conn:
+            conn.executemany(
+                "INSERT INTO messages (user_id, username, chat_id, message_id, message, date) VALUES (?, ?, ?, ?, ?, ?)",
+                rows
+            )
+    finally:
+        conn.close()
+
+def test_overlapping_restores_on_one_connection(tmp_path):
+    now = int(time.time())
+    first, second = str(tmp_path / "first.db"), str(tmp_path / "second.db")
+    _backup_with(first, [(7, "u7", -5, message_id, f"first {message_id}", now) for message_id in range(1, 6)])
+    _backup_with(second, [(8, "u8", -6, message_id, f"second {message_id}", now) for message_id in range(1, 6)])
+    conn = sqlite3.connect(str(tmp_path / "bot_data.db"))
+    try:
+        bot.init_db(conn, frozenset({1}))
+        restores = {}
+        for path in (first, second):
+            schema = f"restore_{len(restores)}"
+            select_columns, _ = bot.attach_backup(conn, path, schema)
+            restores[schema] = [select_columns, 0, 0]
+        # Batches of the two restores interleave on the writer connection.
+        while restores:
+            for schema in list(restores):
+                select_columns, after_id, inserted = restores[schema]
+                last_id, _, added = bot.merge_backup_batch(conn, schema, select_columns, after_id, 2)
+                if last_id is None:
+                    bot.detach_backup(conn, schema)
+                    assert inserted == 5
+                    del restores[schema]
+                else:
+                    restores[schema] = [select_columns, last_id, inserted + added]
+        assert conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0] == 10
+        assert conn.execute("PRAGMA database_list").fetchall()[-1][1] in ("main", "temp")
+    finally:
+        conn.close()
+
+def _command_update(application, user_id: int, update_id: int, text: str) -> Update:
+    data = {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id, "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "Admin"},
+            "text": text,
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}],
+        },
+    }
+    return Update.de_json(data, application.bot)
+
+async def _restore_with_slow_download(config: bot.Config, backup: str) -> int:
+    request = bot.OfflineRequest(config.token)
+    application = bot.create_application(config, request)
+    await application.initialize()
+    await application.post_init(application)
+    try:
+        await application.process_update(_command_update(application, config.main_admin, 1, "/restore"))
+        document = _restore_update(application, config.main_admin, request.add_file(backup), update_id=2)
+        document.message._unfreeze()
+        document.message.caption = None
+        document.message.caption_entities = ()
+        await application.process_update(document)
+        return (await bot.db.fetchone("SELECT messages FROM totals"))[0]
+    finally:
+        await application.post_shutdown(application)
+        await application.shutdown()
+
+def test_restore_wait_does_not_time_out_during_a_download(tmp_path, monkeypatch):
+    monkeypatch.chdir(WORK_DIR)
+    monkeypatch.setattr(bot, "RESTORE_WAIT_TIMEOUT", 0.1)
+    download = bot.download_backup_document
+
+    async def slow_download(*args):
+        await asyncio.sleep(0.5)
+        return await download(*args)
+
+    monkeypatch.setattr(bot, "download_backup_document", slow_download)
+    backup = str(tmp_path / "backup_test.db")
+    _backup_with(backup, [(7, "u7", -5, message_id, "hi", int(time.time())) for message_id in range(1, 4)])
+    config = bot.Config.from_env()._replace(worker_processes=0, db_path=str(tmp_path / "bot_data.db"))
+
+    assert asyncio.run(_restore_with_slow_download(config, backup)) == 3
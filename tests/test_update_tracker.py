@@ -0,0 +1,63 @@
+"""
+UpdateTracker: which updates count as already handled, and how far the stored
+offset may move when updates finish out of order.
+"""
+from types import SimpleNamespace
+
+import bot
+
+def _update(update_id: int, message_id: int = None):
+    message = None
+    if message_id is not None:
+        message = SimpleNamespace(chat_id=-5, message_id=message_id)
+    return SimpleNamespace(update_id=update_id, message=message, channel_post=None)
+
+def _handle(tracker: bot.UpdateTracker, update_id: int, message_id: int = None) -> bool:
+    update = _update(update_id, message_id)
+    if not tracker.begin(update):
+        return False
+    tracker.end(update)
+    return True
+
+def test_out_of_order_completion_keeps_the_gap_open():
+    tracker = bot.UpdateTracker(window=100, gap_timeout=60)
+    tracker.floor = tracker.saved = 4
+    assert _handle(tracker, 5)
+    assert _handle(tracker, 7)
+    assert tracker.floor == 5
+    assert _handle(tracker, 6)
+    assert tracker.floor == 7
+    assert not _handle(tracker, 6)
+    assert not _handle(tracker, 7)
+    assert tracker.duplicates == 2
+
+def test_running_update_holds_back_the_floor():
+    tracker = bot.UpdateTracker(window=100, gap_timeout=60)
+    tracker.floor = 10
+    slow = _update(11)
+    assert tracker.begin(slow)
+    assert _handle(tracker, 12)
+    assert tracker.floor == 10
+    tracker.end(slow)
+    assert tracker.floor == 12
+
+def test_gap_is_skipped_after_the_timeout():
+    tracker = bot.UpdateTracker(window=100, gap_timeout=0)
+    tracker.floor = 10
+    # Update 11 went to another worker process.
+    assert _handle(tracker, 12)
+    assert tracker.floor == 12
+    assert tracker.pending_offset() == ("update_offset", 12)
+
+def test_first_update_without_stored_offset_does_not_drop_earlier_ids():
+    tracker = bot.UpdateTracker(window=100, gap_timeout=60)
+    assert _handle(tracker, 1001, message_id=2)
+    assert _handle(tracker, 1000, message_id=1)
+    assert not _handle(tracker, 1000, message_id=1)
+    assert tracker.floor == 1001
+
+def test_redelivery_under_a_new_update_id_is_dropped():
+    tracker = bot.UpdateTracker(window=100, gap_timeout=60)
+    tracker.floor = 10
+    assert _handle(tracker, 11, message_id=5)
+    assert not _handle(tracker, 13, message_id=5)
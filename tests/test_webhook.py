@@ -0,0 +1,83 @@
+"""
+Webhook mode against OfflineRequest: recorded updates are POSTed to the local
+aiohttp server the way Telegram would send them.
+"""
+import os
+import json
+import asyncio
+import sqlite3
+
+import pytest
+
+aiohttp = pytest.importorskip("aiohttp")
+
+import bot
+
+WORK_DIR = os.path.dirname(os.environ["DB_PATH"])
+PORT = int(os.environ["PORT"])
+SECRET = os.environ["WEBHOOK_SECRET"]
+
+with open(os.path.join(os.path.dirname(__file__), "data", "updates.json")) as f:
+    RECORDED_UPDATES = json.load(f)
+
+async def _wait_for_server(session, url: str) -> None:
+    for _ in range(100):
+        try:
+            async with session.get(url) as response:
+                if response.status == 200:
+                    return
+        except aiohttp.ClientConnectionError:
+            pass
+        await asyncio.sleep(0.05)
+    raise TimeoutError("webhook server did not start")
+
+async def _run_webhook() -> dict:
+    application = bot.create_application(bot.Config.from_env(), bot.OfflineRequest(os.environ["TOKEN"]))
+    stop = asyncio.Event()
+    server = asyncio.create_task(bot.serve_webhook(application, stop))
+    base = f"http://127.0.0.1:{PORT}"
+    statuses = {}
+    try:
+        async with aiohttp.ClientSession() as session:
+            await _wait_for_server(session, base + "/healthz")
+            headers = {"X-Telegram-Bot-Api-Secret-Token": SECRET}
+            async with session.post(base + bot.WEBHOOK_PATH, json=RECORDED_UPDATES[0],
+                                    headers={"X-Telegram-Bot-Api-Secret-Token": "wrong"}) as response:
+                statuses["wrong_secret"] = response.status
+            async with session.post(base + bot.WEBHOOK_PATH, json=RECORDED_UPDATES[0]) as response:
+                statuses["no_secret"] = response.status
+            async with session.post(base + bot.WEBHOOK_PATH, data=b"{not json",
+                                    headers={**headers, "Content-Type": "application/json"}) as response:
+                statuses["malformed"] = response.status
+            statuses["accepted"] = []
+            for update in RECORDED_UPDATES:
+                async with session.post(base + bot.WEBHOOK_PATH, json=update, headers=headers) as response:
+                    statuses["accepted"].append(response.status)
+    finally:
+        # Stop right after the last POST: queued updates must still be handled.
+        stop.set()
+        await asyncio.wait_for(server, timeout=30)
+    return statuses
+
+def test_webhook_accepts_recorded_updates_and_drains_on_stop(monkeypatch):
+    # Startup moves allowed files from the working directory into ARTIFACT_DIR.
+    monkeypatch.chdir(WORK_DIR)
+    statuses = asyncio.run(_run_webhook())
+
+    assert statuses["wrong_secret"] == 403
+    assert statuses["no_secret"] == 403
+    assert statuses["malformed"] == 400
+    assert statuses["accepted"] == [200] * len(RECORDED_UPDATES)
+
+    conn = sqlite3.connect(os.environ["DB_PATH"])
+    try:
+        stored = conn.execute("SELECT chat_id, message_id, message FROM messages ORDER BY id").fetchall()
+        versions = conn.execute("SELECT chat_id, message_id, message FROM message_versions").fetchall()
+        offset = conn.execute("SELECT value FROM meta WHERE key LIKE 'update_offset%'").fetchone()
+    finally:
+        conn.close()
+    assert [(chat_id, message_id) for chat_id, message_id, _ in stored] == [
+        (-1001234567890, 101), (-1001234567890, 102), (200001, 7), (-1009876543210, 55),
+    ]
+    assert (-1001234567890, 101, "temperature 25.5") in versions
+    assert offset is not None and int(offset[0]) == RECORDED_UPDATES[-1]["update_id"]
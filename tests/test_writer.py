@@ -0,0 +1,58 @@
+"""
+MessageWriter: batched inserts, and what happens to a batch when the
+database keeps failing.
+"""
+import asyncio
+import sqlite3
+
+import bot
+
+class FlakyDatabase:
+    """
+    Passes writes through to a Database after failing the first `failures`.
+    """
+
+    def __init__(self, db: bot.Database, failures: int) -> None:
+        self.db = db
+        self.failures = failures
+
+    async def write(self, fn, *args):
+        if self.failures:
+            self.failures -= 1
+            raise sqlite3.OperationalError("database is locked")
+        return await self.db.write(fn, *args)
+
+def _row(message_id: int) -> tuple:
+    return (7, "u7", -5, message_id, f"message {message_id}", 1700000000 + message_id)
+
+async def _run(tmp_path, failures: int, max_retries: int, max_pending: int = 100, rows: int = 3) -> tuple:
+    db = bot.Database(str(tmp_path / "bot_data.db"))
+    try:
+        await db.write(bot.init_db, frozenset({1}))
+        writer = bot.MessageWriter(FlakyDatabase(db, failures), batch_size=100, flush_interval=1,
+                                   max_pending=max_pending, max_retries=max_retries)
+        for message_id in range(1, rows + 1):
+            writer.add(_row(message_id))
+        for _ in range(failures + 1):
+            await writer.flush()
+        stored = await db.fetchone("SELECT COUNT(*) FROM messages")
+        return writer, stored[0]
+    finally:
+        db.close()
+
+def test_failed_batch_is_retried(tmp_path):
+    writer, stored = asyncio.run(_run(tmp_path, failures=2, max_retries=2))
+    assert stored == 3
+    assert (writer.written, writer.retried, writer.dropped, writer.flushes) == (3, 6, 0, 1)
+    assert writer.pending == 0
+
+def test_batch_is_dropped_after_max_retries(tmp_path):
+    writer, stored = asyncio.run(_run(tmp_path, failures=3, max_retries=2))
+    assert stored == 0
+    assert (writer.written, writer.retried, writer.dropped) == (0, 6, 3)
+    assert writer.pending == 0
+
+def test_full_queue_drops_new_rows(tmp_path):
+    writer, stored = asyncio.run(_run(tmp_path, failures=0, max_retries=0, max_pending=2, rows=5))
+    assert stored == 2
+    assert (writer.written, writer.dropped) == (2, 3)